@@ -0,0 +1,342 @@
+"""Microbenchmarks for the hot primitives: color math, LightSection,
+Scheduler, tick/second conversions, note dispatch and PlayMidiTask event
+lookup.
+
+Cases run at several sizes to show how each subsystem scales. Results are
+compared against a JSON baseline from an earlier run, flagging anything
+that got slower by more than a threshold (the exit code is 1 if anything
+regressed). Baselines are machine specific, so they aren't checked in.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.microbenchmarks            # compare (or create)
+    python -m benchmarks.microbenchmarks --save     # overwrite baseline
+    python -m benchmarks.microbenchmarks scheduler  # only matching cases
+"""
+from benchmarks import stubs
+stubs.install()
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import platform  # noqa: E402
+import sys  # noqa: E402
+import timeit  # noqa: E402
+
+import numpy  # noqa: E402
+
+from color import make_color  # noqa: E402
+from light_engine.light_effect import Gradient  # noqa: E402
+from light_engine.light_effect import LightEffectTask  # noqa: E402
+from light_engine.light_effect import LightSection  # noqa: E402
+from light_engine.light_effect import SolidColor  # noqa: E402
+from light_engine.note_dispatch import NoteDispatchTable  # noqa: E402
+from midi.conversions import convert_to_seconds  # noqa: E402
+from midi.conversions import convert_to_seconds_array  # noqa: E402
+from midi.conversions import convert_to_ticks  # noqa: E402
+from midi.conversions import convert_to_ticks_array  # noqa: E402
+from midi.message import MidiMessage  # noqa: E402
+from midi.player import PlayMidiTask  # noqa: E402
+from scheduler.scheduler import Scheduler  # noqa: E402
+from scheduler.scheduler import Task  # noqa: E402
+
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(__file__),
+                                     "baseline.json")
+
+SIZES = (10, 100, 1000, 10000)
+
+# same tempo settings as the looper
+TEMPO = 550000
+TICKS_PER_BEAT = 50
+
+
+class _IdleTask(Task):
+    """ Task that does nothing, to measure scheduler overhead alone """
+
+    def start(self):
+        pass
+
+    def tick(self, time):
+        pass
+
+    def is_finished(self, time):
+        return False
+
+
+class _SilentMidiOut:
+    """ Stands in for the MidiMonitor a PlayMidiTask sends notes to """
+
+    def send_midi_message(self, message):
+        pass
+
+
+def _colors(count):
+    return [make_color(index % 256, (index * 7) % 256, (index * 13) % 256,
+                       (index * 17) % 256) for index in range(count)]
+
+
+def color_make(size):
+    def run():
+        for index in range(size):
+            make_color(index % 256, 20, 30)
+    return run
+
+
+def color_with_alpha(size):
+    colors = _colors(size)
+
+    def run():
+        for color in colors:
+            color.with_alpha(0.5)
+    return run
+
+
+def color_blended_with(size):
+    colors = _colors(size)
+    background = make_color(0, 0, 70)
+
+    def run():
+        for color in colors:
+            color.blended_with(background)
+    return run
+
+
+def gradient_effect(size):
+    effect = Gradient(color1=make_color(0, 0, 70), color2=make_color(0, 70, 0))
+    gradients = [index / size for index in range(size)]
+
+    def run():
+        for gradient in gradients:
+            effect.get_color(0.3, gradient)
+    return run
+
+
+def light_section_create(size):
+    positions = range(size)
+
+    def run():
+        LightSection(positions)
+    return run
+
+
+def light_section_gradient_range(size):
+    section = LightSection(range(size))
+
+    def run():
+        section.positions_in_gradient_range(0.25, 0.5)
+    return run
+
+
+def light_section_merge_all(size):
+    sections = [LightSection(range(start, start + 10))
+                for start in range(0, size, 10)]
+
+    def run():
+        LightSection.merge_all(sections)
+    return run
+
+
+def _scheduler_with_tasks(size):
+    scheduler = Scheduler()
+    scheduler.start()
+    for _ in range(size):
+        scheduler.add(_IdleTask())
+    return scheduler
+
+
+def scheduler_add_remove(size):
+    scheduler = _scheduler_with_tasks(size)
+    task = _IdleTask()
+
+    def run():
+        # removing the newest task scans every other one first
+        scheduler.add(task)
+        scheduler.remove(task)
+    return run
+
+
+def scheduler_add_unique_tag(size):
+    scheduler = _scheduler_with_tasks(size)
+    task = _IdleTask()
+
+    def run():
+        # replaces the previous task with this tag
+        scheduler.add(task, unique_tag="tag")
+    return run
+
+
+def scheduler_tick(size):
+    scheduler = _scheduler_with_tasks(size)
+    return scheduler.tick
+
+
+def note_dispatch(size):
+    """ New tasks for size notes (of a show's 128 note map) """
+    note_map = {
+        (pitch, 1): LightEffectTask(SolidColor(make_color(220, 200, 60)),
+                                    LightSection([pitch]), 0.15, None)
+        for pitch in range(128)}
+    table = NoteDispatchTable.compile(note_map)
+    pitches = [index % 128 for index in range(size)]
+
+    def run():
+        for pitch in pitches:
+            table.new_task(pitch, 1)
+    return run
+
+
+def conversions(size):
+    times = [index * 0.001 for index in range(size)]
+
+    def run():
+        for time in times:
+            convert_to_seconds(
+                convert_to_ticks(time, TEMPO, TICKS_PER_BEAT),
+                TEMPO, TICKS_PER_BEAT)
+    return run
+
+
+def conversions_array(size):
+    times = numpy.arange(size) * 0.001
+
+    def run():
+        convert_to_seconds_array(
+            convert_to_ticks_array(times, TEMPO, TICKS_PER_BEAT),
+            TEMPO, TICKS_PER_BEAT)
+    return run
+
+
+def play_midi_lookup(size):
+    """ A PlayMidiTask with one chord on every one of size ticks, ticked
+    through the whole thing """
+    events_by_tick = {
+        tick: [MidiMessage.note_on(1, 60 + interval, 100)
+               for interval in (0, 4, 7)]
+        for tick in range(size)}
+    task = PlayMidiTask(events_by_tick, _SilentMidiOut(), TEMPO,
+                        TICKS_PER_BEAT)
+    times = [convert_to_seconds(tick, TEMPO, TICKS_PER_BEAT)
+             for tick in range(size)]
+
+    def run():
+        task.start()
+        for time in times:
+            task.tick(time)
+    return run
+
+
+# (name, case, sizes): case(size) sets up and returns the function to time
+CASES = [
+    ("color.make_color", color_make, (1000,)),
+    ("color.with_alpha", color_with_alpha, (1000,)),
+    ("color.blended_with", color_blended_with, (1000,)),
+    ("light_effect.Gradient.get_color", gradient_effect, (1000,)),
+    ("LightSection()", light_section_create, SIZES),
+    ("LightSection.positions_in_gradient_range",
+     light_section_gradient_range, SIZES),
+    ("LightSection.merge_all", light_section_merge_all, SIZES),
+    ("Scheduler.add+remove", scheduler_add_remove, SIZES),
+    ("Scheduler.add(unique_tag)", scheduler_add_unique_tag, SIZES),
+    ("Scheduler.tick", scheduler_tick, SIZES),
+    ("NoteDispatchTable.new_task", note_dispatch, (1000,)),
+    ("convert_to_ticks+convert_to_seconds", conversions, (1000,)),
+    ("convert_to_ticks_array+convert_to_seconds_array", conversions_array,
+     (1000, 100000)),
+    ("PlayMidiTask.tick", play_midi_lookup, (100, 1000, 10000)),
+]
+
+
+def run_cases(name_filter=None, min_time=0.2, repeat=3):
+    """ Time every case (whose name contains name_filter), returns
+    {"name[size]": best seconds per call} """
+    results = {}
+    for name, case, sizes in CASES:
+        if name_filter and name_filter.lower() not in name.lower():
+            continue
+        for size in sizes:
+            timer = timeit.Timer(case(size))
+            number, _ = timer.autorange()
+            number = max(1, int(number * min_time / 0.2))
+            best = min(timer.repeat(repeat=repeat, number=number)) / number
+            key = "{}[{}]".format(name, size)
+            results[key] = best
+            print("{:<50} {:>12.2f} us".format(key, best * 1e6))
+            sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Print how results changed since baseline, returns the names that
+    got slower by more than threshold (a fraction, e.g. 0.2 for 20%) """
+    regressions = []
+    print("\nchange since baseline:")
+    for key, seconds in results.items():
+        baseline_seconds = baseline.get(key)
+        if baseline_seconds is None:
+            print("{:<50} {:>12}".format(key, "new"))
+            continue
+        change = seconds / baseline_seconds - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        elif change < -threshold:
+            flag = "  improved"
+        print("{:<50} {:>+11.1f}%{}".format(key, change * 100, flag))
+    return regressions
+
+
+def load_baseline(file_name):
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as baseline_file:
+        return json.load(baseline_file)["results"]
+
+
+def save_baseline(file_name, results):
+    baseline = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(file_name, "w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+    print("\nsaved baseline to " + file_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run microbenchmarks and check them against a baseline")
+    parser.add_argument("filter", nargs="?",
+                        help="only run cases whose name contains this")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_FILE,
+                        help="baseline JSON file to compare against")
+    parser.add_argument("--save", action='store_true',
+                        help="save these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown (as a fraction) that counts as a "
+                        "regression")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="rough seconds to spend timing each case")
+    args = parser.parse_args()
+
+    results = run_cases(args.filter, min_time=args.min_time)
+
+    baseline = load_baseline(args.baseline)
+    if args.save or baseline is None:
+        if baseline is not None:
+            # keep baselines of cases that weren't run this time
+            baseline.update(results)
+            results = baseline
+        save_baseline(args.baseline, results)
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("\n{} case(s) regressed by more than {:.0f}%".format(
+            len(regressions), args.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import random
+
+# Synthetic piano playing for benchmarks
+
+PATTERNS = ("chords", "glissando", "pedal", "mixed")
+
+SUSTAIN_PEDAL = 64
+
+
+def generate_midi_load(midi_message, pattern, notes_per_second, duration,
+                       channel=1, lowest_pitch=36, highest_pitch=96,
+                       note_length=0.25, seed=0):
+    """Timed MIDI messages imitating (hard) playing, sorted by time.
+
+    Args:
+        midi_message: MidiMessage class to create messages with (rtmidi's
+            or a stand-in).
+        pattern: 'chords' (4 note chords), 'glissando' (fast runs up and
+            down the keyboard), 'pedal' (random notes with the sustain pedal
+            pressed and released every second) or 'mixed' (all of the
+            above, alternating every couple of seconds).
+        notes_per_second: number of note ons per second.
+        duration: seconds of playing.
+        note_length: seconds each note is held.
+
+    Returns:
+        list of (seconds from start, message)
+    """
+    if pattern not in PATTERNS:
+        raise ValueError("unknown pattern: " + pattern)
+
+    rng = random.Random(seed)
+    events = []
+
+    def play(start, pitch):
+        velocity = rng.randint(40, 127)
+        events.append((start, midi_message.noteOn(channel, pitch, velocity)))
+        events.append((start + note_length,
+                       midi_message.noteOff(channel, pitch)))
+
+    pitch_count = highest_pitch - lowest_pitch + 1
+    gap = 1.0 / notes_per_second
+    note_index = 0
+    start = 0.0
+    while start < duration:
+        current_pattern = pattern
+        if pattern == "mixed":
+            current_pattern = PATTERNS[int(start / 2) % 3]
+
+        if current_pattern == "chords":
+            # every 4th note time strikes a whole chord at once
+            if note_index % 4 == 0:
+                root = rng.randrange(lowest_pitch, highest_pitch - 7)
+                for interval in (0, 4, 7, 12):
+                    play(start, min(root + interval, highest_pitch))
+        elif current_pattern == "glissando":
+            # up then down the keyboard, one key per note
+            position = note_index % (2 * pitch_count)
+            if position >= pitch_count:
+                position = 2 * pitch_count - 1 - position
+            play(start, lowest_pitch + position)
+        else:
+            play(start, rng.randint(lowest_pitch, highest_pitch))
+            if note_index % max(1, int(notes_per_second)) == 0:
+                # press the pedal for the first half of every second
+                events.append((start, midi_message.controllerEvent(
+                    channel, SUSTAIN_PEDAL, 127)))
+                events.append((start + 0.5, midi_message.controllerEvent(
+                    channel, SUSTAIN_PEDAL, 0)))
+
+        note_index += 1
+        start = note_index * gap
+
+    events.sort(key=lambda event: event[0])
+    return events
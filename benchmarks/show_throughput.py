@@ -0,0 +1,210 @@
+"""End-to-end throughput benchmark.
+
+Feeds synthetic MIDI into a real show (SomethingJustLikeThisShow with a
+started looper) and runs the same main loop as lightful.py, with rtmidi
+and the Arduino serial port replaced by the fakes in benchmarks.stubs and
+a silent metronome. Reports frames per second, CPU time per frame and
+note-to-photon latency percentiles.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.show_throughput --pattern mixed --notes-per-second 40
+"""
+from benchmarks import stubs
+stubs.install()
+
+import argparse  # noqa: E402
+import logging  # noqa: E402
+import time  # noqa: E402
+
+from benchmarks.midi_load import PATTERNS  # noqa: E402
+from benchmarks.midi_load import generate_midi_load  # noqa: E402
+from latency import note_latency  # noqa: E402
+from light_engine.pixel_layout import DEFAULT_LAYOUT_FILE  # noqa: E402
+from light_engine.pixel_layout import PixelLayout  # noqa: E402
+from lightful import create_pixel_adapter  # noqa: E402
+from lightful import tick_main_loop  # noqa: E402
+from midi.looper import MidiLooper  # noqa: E402
+from midi.metronome_audio import NullAudioBackend  # noqa: E402
+from midi.metronome_audio import metronome_audio  # noqa: E402
+from midi.monitor import MidiMonitor  # noqa: E402
+from profiler import span_profiler  # noqa: E402
+from scheduler.scheduler import Scheduler  # noqa: E402
+from shows.something_just_like_this_show import \
+    SomethingJustLikeThisShow  # noqa: E402
+
+logger = logging.getLogger("global")
+
+
+def run_benchmark(pattern="mixed", notes_per_second=20, duration=10,
+                  num_loops=0, layout_file=DEFAULT_LAYOUT_FILE,
+                  num_serial_ports=1, baud_rate=1000000, loop_sleep=0.001):
+    """Play duration seconds of synthetic MIDI through the app.
+
+    Args:
+        num_loops: number of looper channels to record (one measure each,
+            from the start of the synthetic playing) and play back on top.
+        num_serial_ports: number of simulated Arduinos to split the pixels
+            over.
+        loop_sleep: sleep per main loop pass (lightful.py sleeps 1ms).
+
+    Returns:
+        dict of results (see print_results)
+    """
+    layout = PixelLayout.load(layout_file)
+    num_pixels = layout.num_pixels
+
+    midi_monitor = MidiMonitor()
+    midi_monitor.start()
+    midi_scheduler = Scheduler(name="midi scheduler")
+    midi_scheduler.start()
+    animation_scheduler = Scheduler(name="animation scheduler")
+    animation_scheduler.start()
+
+    if num_serial_ports == 1:
+        serial_port_specs = ["fake0"]
+    else:
+        step = -(-num_pixels // num_serial_ports)
+        serial_port_specs = [
+            "fake{}:{}-{}".format(index, start, min(start + step, num_pixels))
+            for index, start in enumerate(range(0, num_pixels, step))]
+    pixel_adapter = create_pixel_adapter(serial_port_specs, num_pixels,
+                                         baud_rate=baud_rate)
+    pixel_adapter.start()
+
+    lights_show = SomethingJustLikeThisShow(
+        animation_scheduler, pixel_adapter, midi_monitor, layout)
+    # same looper settings as the loop mode keyboard shortcut
+    metronome_audio.use(NullAudioBackend())
+    looper = MidiLooper(tempo=550000, ticks_per_beat=50, beats_per_measure=8,
+                        midi_monitor=midi_monitor,
+                        midi_scheduler=midi_scheduler)
+    looper.start()
+    lights_show.looper = looper
+
+    events = generate_midi_load(stubs.FakeMidiMessage, pattern,
+                                notes_per_second, duration)
+    loop_channels = list(range(2, 2 + num_loops))
+    seconds_per_measure = looper.seconds_per_measure()
+
+    frames = 0
+    frame_cpu_times = []
+    max_task_count = 0
+    event_index = 0
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    while True:
+        now = time.perf_counter() - start_time
+        if now >= duration:
+            break
+
+        # record the first measures into looper channels, one per channel
+        if loop_channels:
+            channel = loop_channels[0]
+            measure = channel - 2
+            if looper.is_recording(channel) and \
+                    now >= (measure + 1) * seconds_per_measure:
+                looper.save_record(channel)
+                loop_channels.pop(0)
+            elif not looper.has_been_recorded(channel) and \
+                    now >= measure * seconds_per_measure:
+                looper.record(time.time(), channel)
+                looper.play(channel)
+
+        # 'play' everything that's due
+        while event_index < len(events) and events[event_index][0] <= now:
+            stubs.pending_messages.append(events[event_index][1])
+            event_index += 1
+
+        cpu_time = time.process_time()
+        if tick_main_loop(midi_scheduler, midi_monitor, animation_scheduler,
+                          pixel_adapter):
+            frames += 1
+            frame_cpu_times.append(time.process_time() - cpu_time)
+        max_task_count = max(max_task_count,
+                             len(animation_scheduler.task_wrappers))
+
+        if loop_sleep:
+            time.sleep(loop_sleep)
+
+    elapsed = time.perf_counter() - start_time
+    cpu_time = time.process_time() - start_cpu_time
+    pixel_adapter.stop()
+
+    frame_cpu_times.sort()
+    return {
+        "notes": sum(1 for _, message in events if message.isNoteOn()),
+        "frames": frames,
+        "fps": frames / elapsed,
+        "cpu_per_frame": cpu_time / max(frames, 1),
+        "frame_cpu_percentiles": [
+            _percentile(frame_cpu_times, percent) for percent in (50, 95, 99)]
+        if frame_cpu_times else None,
+        "latency_percentiles": note_latency.percentiles(),
+        "max_task_count": max_task_count,
+        "bytes_written": sum(port.bytes_written
+                             for port in stubs.serial_ports),
+    }
+
+
+def print_results(results):
+    print("notes played:        {}".format(results["notes"]))
+    print("frames:              {} ({:.1f} fps)".format(
+        results["frames"], results["fps"]))
+    print("cpu per frame:       {:.3f} ms (whole loop, all systems)".format(
+        results["cpu_per_frame"] * 1000))
+    if results["frame_cpu_percentiles"]:
+        print("frame cpu p50/95/99: {:.3f} / {:.3f} / {:.3f} ms".format(
+            *[value * 1000 for value in results["frame_cpu_percentiles"]]))
+    if results["latency_percentiles"]:
+        print("latency p50/95/99:   {:.2f} / {:.2f} / {:.2f} ms".format(
+            *[value * 1000 for value in results["latency_percentiles"]]))
+    else:
+        print("latency:             no notes made it to the lights")
+    print("max animation tasks: {}".format(results["max_task_count"]))
+    print("serial bytes sent:   {}".format(results["bytes_written"]))
+
+
+def _percentile(sorted_values, percent):
+    """ Nearest-rank percentile of an already sorted list """
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark a show end to end with synthetic MIDI")
+    parser.add_argument("--pattern", choices=PATTERNS, default="mixed")
+    parser.add_argument("--notes-per-second", type=float, default=20)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--loops", type=int, default=0,
+                        help="number of looper channels to record and play "
+                        "back on top of the live playing")
+    parser.add_argument("--layout", default=DEFAULT_LAYOUT_FILE)
+    parser.add_argument("--serialports", type=int, default=1,
+                        help="number of simulated Arduinos")
+    parser.add_argument("--baudrate", type=int, default=1000000)
+    parser.add_argument("--no-sleep", action='store_true',
+                        help="don't sleep between main loop passes")
+    parser.add_argument("--trace",
+                        help="also write a Chrome trace of the main loop "
+                        "spans to this file")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s-%(levelname)s-%(message)s')
+    span_profiler.enabled = args.trace is not None
+
+    results = run_benchmark(
+        pattern=args.pattern, notes_per_second=args.notes_per_second,
+        duration=args.seconds, num_loops=args.loops, layout_file=args.layout,
+        num_serial_ports=args.serialports, baud_rate=args.baudrate,
+        loop_sleep=0 if args.no_sleep else 0.001)
+    print_results(results)
+
+    if args.trace:
+        span_profiler.export_chrome_trace(args.trace)
+
+
+if __name__ == '__main__':
+    main()
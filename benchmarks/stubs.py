@@ -0,0 +1,254 @@
+import struct
+import sys
+import time
+import types
+from collections import deque
+
+from light_engine import serial_protocol
+
+# Stand-ins for the hardware facing modules (rtmidi, serial) so the real
+# app can be benchmarked without a piano or Arduino. Call install() before
+# importing anything from the app. (The metronome is silenced with
+# metronome_audio's null backend instead.)
+
+
+class FakeMidiMessage:
+    """ Minimal pyrtmidi MidiMessage: note on/off and controller events.
+    Channels are 1-based like pyrtmidi's """
+
+    NOTE_OFF = 0x80
+    NOTE_ON = 0x90
+    CONTROLLER = 0xB0
+
+    NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A",
+                  "A#", "B"]
+
+    def __init__(self, kind=None, channel=1, data1=0, data2=0):
+        self.kind = kind
+        self.channel = channel
+        self.data1 = data1
+        self.data2 = data2
+
+    def __str__(self):
+        return "<FakeMidiMessage {:#x} ch{} {} {}>".format(
+            self.kind or 0, self.channel, self.data1, self.data2)
+
+    @staticmethod
+    def noteOn(channel, note, velocity):
+        return FakeMidiMessage(FakeMidiMessage.NOTE_ON, channel, note,
+                               velocity)
+
+    @staticmethod
+    def noteOff(channel, note):
+        return FakeMidiMessage(FakeMidiMessage.NOTE_OFF, channel, note, 0)
+
+    @staticmethod
+    def controllerEvent(channel, controller, value):
+        return FakeMidiMessage(FakeMidiMessage.CONTROLLER, channel,
+                               controller, value)
+
+    @staticmethod
+    def getMidiNoteName(note):
+        return FakeMidiMessage.NOTE_NAMES[note % 12] + str(note // 12 - 1)
+
+    def isNoteOn(self):
+        return self.kind == self.NOTE_ON and self.data2 > 0
+
+    def isNoteOff(self):
+        return self.kind == self.NOTE_OFF or \
+            (self.kind == self.NOTE_ON and self.data2 == 0)
+
+    def isController(self):
+        return self.kind == self.CONTROLLER
+
+    def getChannel(self):
+        return self.channel
+
+    def setChannel(self, channel):
+        self.channel = channel
+
+    def getNoteNumber(self):
+        return self.data1
+
+    def getVelocity(self):
+        return self.data2
+
+    def multiplyVelocity(self, amount):
+        self.data2 = max(1, min(127, int(round(self.data2 * amount))))
+
+    def getControllerNumber(self):
+        return self.data1
+
+    def getControllerValue(self):
+        return self.data2
+
+
+class FakeRtMidiIn:
+    """ MIDI input without ports, reading from the module level
+    pending_messages queue instead """
+
+    def getPortCount(self):
+        return 0
+
+    def openPort(self, port):
+        pass
+
+    def closePort(self):
+        pass
+
+    def getPortName(self, port):
+        return "fake midi in"
+
+    def getMessage(self, timeout_ms=0):
+        if pending_messages:
+            return pending_messages.popleft()
+        return None
+
+
+class FakeRtMidiOut:
+    """ MIDI output counting what would have been sent to the piano """
+
+    def __init__(self):
+        self.sent_count = 0
+
+    def openPort(self, port):
+        pass
+
+    def sendMessage(self, message):
+        self.sent_count += 1
+
+
+# messages waiting to be read by any FakeRtMidiIn
+pending_messages = deque()
+
+
+class FakeArduinoSerial:
+    """A serial port with a simulated Arduino on the other end.
+
+    Speaks the same startup protocol and frame formats as the real firmware
+    (see serial_protocol), and acks each frame once it would have finished
+    arriving at baud_rate and been shown on the strip (~30us per pixel).
+    Framed acks report the frame's simulated arrival time, so note-to-photon
+    latency includes the time on the wire.
+
+    Attributes:
+        frames_received: number of frames decoded.
+        bytes_written: number of bytes the adapter has sent.
+    """
+
+    MICROSECONDS_PER_PIXEL = 30
+
+    def __init__(self, port, baudrate=115200, capabilities=None,
+                 max_chunk_pixels=128):
+        self.port = port
+        self.baudrate = baudrate
+        self.is_open = True
+        self.frames_received = 0
+        self.bytes_written = 0
+        if capabilities is None:
+            capabilities = serial_protocol.SUPPORTED_CAPABILITIES
+        self.__output = bytearray(serial_protocol.setup_message(
+            capabilities, max_chunk_pixels))
+        # (time.perf_counter() when ready, bytes) to send back
+        self.__scheduled_output = deque()
+        self.__handshake = bytearray()
+        self.__num_pixels = None
+        self.__is_framed = False
+        self.__frame_decoder = None
+        self.__busy_until = 0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    @property
+    def in_waiting(self):
+        now = time.perf_counter()
+        while self.__scheduled_output and \
+                self.__scheduled_output[0][0] <= now:
+            self.__output.extend(self.__scheduled_output.popleft()[1])
+        return len(self.__output)
+
+    def read(self, size=1):
+        self.in_waiting
+        data = bytes(self.__output[:size])
+        del self.__output[:size]
+        return data
+
+    def readline(self):
+        self.in_waiting
+        end = self.__output.find(b"\n") + 1 or len(self.__output)
+        return self.read(end)
+
+    def write(self, data):
+        data = bytes(data)
+        self.bytes_written += len(data)
+        if self.__num_pixels is None:
+            self.__read_handshake(data)
+            return len(data)
+
+        # bytes arrive one after another at ~10 bits per byte
+        now = time.perf_counter()
+        arrival_time = max(now, self.__busy_until) + \
+            len(data) * 10.0 / self.baudrate
+        self.__busy_until = arrival_time
+        frames = self.__frame_decoder.feed(data)
+        if not self.__is_framed:
+            frames = [(None, frame) for frame in frames]
+        for sequence, _ in frames:
+            self.frames_received += 1
+            ready_time = arrival_time + \
+                self.__num_pixels * self.MICROSECONDS_PER_PIXEL * 1e-6
+            if self.__is_framed:
+                ack = serial_protocol.encode_packet(
+                    serial_protocol.PACKET_ACK, sequence,
+                    struct.pack(
+                        serial_protocol.ACK_BODY_FORMAT, arrival_time))
+            else:
+                ack = b"\n"
+            self.__scheduled_output.append((ready_time, ack))
+        return len(data)
+
+    def __read_handshake(self, data):
+        self.__handshake.extend(data)
+        if len(self.__handshake) < serial_protocol.HANDSHAKE_SIZE:
+            return
+        _, num_pixels, capabilities = serial_protocol.decode_handshake(
+            bytes(self.__handshake[:serial_protocol.HANDSHAKE_SIZE]))
+        self.__num_pixels = num_pixels
+        self.__is_framed = bool(
+            capabilities & serial_protocol.CAPABILITY_FRAMED)
+        if self.__is_framed:
+            self.__frame_decoder = serial_protocol.FramedFrameDecoder(
+                num_pixels)
+        else:
+            self.__frame_decoder = serial_protocol.ChunkedFrameDecoder(
+                num_pixels)
+        self.__output.extend(b"\n")  # got your message!
+
+
+# every FakeArduinoSerial opened, in order
+serial_ports = []
+
+
+def _open_serial(port, baudrate=115200, **kwargs):
+    serial_port = FakeArduinoSerial(port, baudrate)
+    serial_ports.append(serial_port)
+    return serial_port
+
+
+def install():
+    """ Replace rtmidi and serial with the fakes above. Must run
+    before the app's modules are imported """
+    rtmidi = types.ModuleType("rtmidi")
+    rtmidi.MidiMessage = FakeMidiMessage
+    rtmidi.RtMidiIn = FakeRtMidiIn
+    rtmidi.RtMidiOut = FakeRtMidiOut
+    sys.modules["rtmidi"] = rtmidi
+
+    serial = types.ModuleType("serial")
+    serial.Serial = _open_serial
+    sys.modules["serial"] = serial
+
@@ -1,44 +1,119 @@
 import logging
-
-try:
-    unicode
-    _unicode = True
-except NameError:
-    _unicode = False
+import queue
+import threading
+import time
 
 # log handling in curses
 
 
+class CursesLogWriter:
+    """Writes log lines to a curses window from a dedicated thread.
+
+    Log records are only formatted and queued on the caller's thread (e.g.
+    the main loop). The writer thread drains the queue in batches and
+    refreshes the screen at most refresh_rate times per second, so a burst
+    of logs costs the main loop next to nothing. If the queue fills up
+    (more logs than the screen can keep up with), new lines are dropped and
+    counted rather than blocking, and the count is shown on screen.
+
+    curses isn't thread safe, so any other use of the screen (e.g. getch)
+    should hold screen_lock.
+
+    Attributes:
+        dropped_count: total number of log lines dropped.
+        screen_lock: lock held while the writer touches the screen.
+    """
+
+    def __init__(self, screen, refresh_rate=10, max_queue_size=2000):
+        self.screen = screen
+        self.refresh_rate = refresh_rate
+        self.screen_lock = threading.Lock()
+        self.dropped_count = 0
+        self.__queue = queue.Queue(max_queue_size)
+        self.__reported_dropped_count = 0
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="curses log writer")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """ Stop the writer thread once it has written everything queued """
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def write(self, message):
+        """ Queue a line for writing. Never blocks """
+        try:
+            self.__queue.put_nowait(message)
+        except queue.Full:
+            self.dropped_count += 1
+
+    def queue_depth(self):
+        return self.__queue.qsize()
+
+    def __run(self):
+        min_refresh_interval = 1.0 / self.refresh_rate
+        while self.__running or not self.__queue.empty():
+            try:
+                first = self.__queue.get(timeout=min_refresh_interval)
+            except queue.Empty:
+                continue
+            refresh_start = time.time()
+            try:
+                self.__write_batch([first] + self.__drain())
+            except Exception:  # noqa
+                # keep the writer alive, there's nowhere else to log to
+                pass
+
+            # cap the refresh rate, letting more lines pile up meanwhile
+            remaining = min_refresh_interval - (time.time() - refresh_start)
+            if remaining > 0 and self.__running:
+                time.sleep(remaining)
+
+    def __drain(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self.__queue.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def __write_batch(self, messages):
+        dropped_count = self.dropped_count
+        if dropped_count != self.__reported_dropped_count:
+            messages.append("[{} log lines dropped]".format(
+                dropped_count - self.__reported_dropped_count))
+            self.__reported_dropped_count = dropped_count
+
+        with self.screen_lock:
+            for message in messages:
+                text = "\n%s" % message
+                try:
+                    self.screen.addstr(text)
+                except UnicodeEncodeError:
+                    self.screen.addstr(text.encode("UTF-8"))
+            self.screen.refresh()
+
+
 class CursesLogHandler(logging.Handler):
+    """ Log handler sending formatted records to a CursesLogWriter """
 
-    def __init__(self, screen):
+    def __init__(self, log_writer):
         logging.Handler.__init__(self)
-        self.screen = screen
+        self.log_writer = log_writer
 
     def emit(self, record):
         try:
-            msg = self.format(record)
-            screen = self.screen
-            fs = "\n%s"
-            if not _unicode:  # if no unicode support...
-                screen.addstr(fs % msg)
-                screen.refresh()
-            else:
-                try:
-                    if (isinstance(msg, unicode)):  # noqa
-                        ufs = u'\n%s'
-                        try:
-                            screen.addstr(ufs % msg)
-                            screen.refresh()
-                        except UnicodeEncodeError:
-                            screen.addstr((ufs % msg).encode(unicode))  # noqa
-                            screen.refresh()
-                    else:
-                        screen.addstr(fs % msg)
-                        screen.refresh()
-                except UnicodeError:
-                    screen.addstr(fs % msg.encode("UTF-8"))
-                    screen.refresh()
+            self.log_writer.write(self.format(record))
         except (KeyboardInterrupt, SystemExit):
             raise
         except:  # noqa
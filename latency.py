@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from array import array
+
+from profiler import span_profiler
+
+logger = logging.getLogger("global")
+
+"""Note-to-photon latency: the delay between a key press arriving over MIDI
+and the first pixel update that shows it.
+
+Each incoming MIDI message is stamped with its arrival time. While the
+message is being dispatched to observers (e.g. the show's received_midi),
+any task added to a scheduler is tagged with it. The first animation frame
+that ticks the task marks the message as rendered, the pixel adapter's
+write marks it as sent, and the controller's ack (which the virtual client
+stamps with its own frame arrival time) completes it. With several outputs
+(e.g. a MultiPixelAdapter's controllers), every output that has written a
+frame gets each rendered message, and the message completes with the last
+of their acks.
+"""
+
+# histogram bucket upper bounds in milliseconds (last bucket catches the
+# rest)
+LATENCY_BUCKETS_MS = (1, 2, 4, 8, 16, 32, 64, 128, 256, float("inf"))
+
+STAGES = ("to task", "to frame", "to write", "to arrival", "to ack")
+
+
+class _NoteEvent:
+    """ Timestamps (time.perf_counter() seconds) of one MIDI message on its
+    way to the lights """
+
+    __slots__ = ('arrival_time', 'task_time', 'render_time', 'write_time',
+                 'pending_outputs')
+
+    def __init__(self, arrival_time):
+        self.arrival_time = arrival_time
+        self.task_time = None
+        self.render_time = None
+        self.write_time = None  # the last output's write
+        self.pending_outputs = 0  # outputs yet to ack it
+
+
+class NoteLatencyTracker:
+    """Tracks note-to-photon latency through the app (see above).
+
+    Completed latencies go into a histogram and a ring buffer of recent
+    values for percentiles, and are recorded as profiler spans ('note
+    latency' plus one label per stage) whenever the span profiler is on.
+
+    Attributes:
+        enabled: whether MIDI messages are being tracked.
+        histogram: counts per LATENCY_BUCKETS_MS bucket.
+    """
+
+    def __init__(self, capacity=4096):
+        self.enabled = True
+        self.histogram = [0] * len(LATENCY_BUCKETS_MS)
+        self.__capacity = capacity
+        self.__recent = array("d", [0.0] * capacity)
+        self.__count = 0
+
+        self.__current_event = None
+        # rendered events not written yet, by output (id). Events rendered
+        # before any output wrote a frame go to the first one that does
+        self.__rendered_events_by_output = {}
+        self.__unclaimed_events = []
+        self.__written_events_by_output = {}
+        # writes/acks may come from output worker threads
+        self.__lock = threading.Lock()
+
+    def midi_received(self, arrival_time):
+        """ A MIDI message is about to be dispatched to observers. Returns
+        the message being dispatched before it (if observers are sending
+        MIDI themselves), to pass back to midi_dispatched """
+        previous_event = self.__current_event
+        if self.enabled:
+            self.__current_event = _NoteEvent(arrival_time)
+        return previous_event
+
+    def midi_dispatched(self, previous_event=None):
+        """ All observers have handled the current MIDI message """
+        self.__current_event = previous_event
+
+    def task_added(self):
+        """ Called when a scheduler adds a task. Returns the MIDI message
+        event the task was spawned by (None if it wasn't spawned by one) """
+        event = self.__current_event
+        if event is not None and event.task_time is None:
+            event.task_time = time.perf_counter()
+        return event
+
+    def tasks_rendered(self, events):
+        """ Tasks spawned by events were ticked into a frame """
+        now = time.perf_counter()
+        with self.__lock:
+            outputs_events = self.__rendered_events_by_output.values()
+            for event in events:
+                if event.render_time is not None:
+                    continue
+                event.render_time = now
+                if not outputs_events:
+                    self.__unclaimed_events.append(event)
+                    continue
+                event.pending_outputs = len(outputs_events)
+                for output_events in outputs_events:
+                    output_events.append(event)
+                    if len(output_events) > self.__capacity:
+                        # an output that stopped writing, don't pile up
+                        del output_events[0]
+
+    def frame_written(self, output):
+        """ output (e.g. a pixel adapter) sent the latest frame """
+        with self.__lock:
+            events = self.__rendered_events_by_output.get(id(output))
+            if events is None:
+                # first frame from this output
+                events = self.__unclaimed_events
+                self.__unclaimed_events = []
+                for event in events:
+                    event.pending_outputs = 1
+            if events:
+                self.__rendered_events_by_output[id(output)] = []
+                now = time.perf_counter()
+                for event in events:
+                    event.write_time = now
+                self.__written_events_by_output.setdefault(
+                    id(output), []).extend(events)
+            else:
+                self.__rendered_events_by_output[id(output)] = events
+
+    def frame_acked(self, output, arrival_time=None):
+        """ output's controller acknowledged the frame, optionally reporting
+        when (in time.perf_counter() seconds) the frame arrived """
+        with self.__lock:
+            events = self.__written_events_by_output.pop(id(output), None)
+            if not events:
+                return
+            completed_events = []
+            for event in events:
+                event.pending_outputs -= 1
+                if event.pending_outputs == 0:
+                    completed_events.append(event)
+        ack_time = time.perf_counter()
+        for event in completed_events:
+            self.__record(event, arrival_time, ack_time)
+
+    def percentiles(self, percents=(50, 95, 99)):
+        """ Recent total latency percentiles in seconds (None if nothing's
+        been recorded) """
+        count = min(self.__count, self.__capacity)
+        if count == 0:
+            return None
+        values = sorted(self.__recent[:count])
+        return [values[int(round(percent / 100.0 * (count - 1)))]
+                for percent in percents]
+
+    def log_report(self):
+        percentiles = self.percentiles()
+        if percentiles is None:
+            logger.info("note latency: no notes tracked yet")
+            return
+        logger.info("note latency p50 / p95 / p99: %.1f / %.1f / %.1f ms" %
+                    tuple(p * 1000 for p in percentiles))
+        low = 0
+        for high, count in zip(LATENCY_BUCKETS_MS, self.histogram):
+            logger.info(" {:>4}-{:<4} ms: {}".format(low, high, count))
+            low = high
+
+    def __record(self, event, arrival_time, ack_time):
+        total = ack_time - event.arrival_time
+        self.__recent[self.__count % self.__capacity] = total
+        self.__count += 1
+        total_ms = total * 1000
+        for index, bucket in enumerate(LATENCY_BUCKETS_MS):
+            if total_ms <= bucket:
+                self.histogram[index] += 1
+                break
+
+        if not span_profiler.enabled:
+            return
+        span_profiler.record("note latency", event.arrival_time, total)
+        stage_times = (event.arrival_time, event.task_time,
+                       event.render_time, event.write_time, arrival_time,
+                       ack_time)
+        previous = event.arrival_time
+        for stage, stage_time in zip(STAGES, stage_times[1:]):
+            if stage_time is None:
+                continue
+            span_profiler.record("note latency " + stage, previous,
+                                 stage_time - previous)
+            previous = stage_time
+
+
+# shared tracker for the whole app (see span_profiler)
+note_latency = NoteLatencyTracker()
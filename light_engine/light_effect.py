@@ -5,6 +5,7 @@ import time
 from abc import abstractmethod
 
 from lightful_tasks import RepeatingTask
+from midi.message import NOTE_OFF
 from scheduler.scheduler import Task
 
 logger = logging.getLogger("global")
@@ -230,6 +231,7 @@ class MidiOffTask(Task):
         self.pitch = pitch
         self.__midi_monitor = midi_monitor
         self.__note_duration = None  # TBD once note off is received
+        self.__ended = False
 
     def start(self):
         self.task.start()
@@ -245,13 +247,19 @@ class MidiOffTask(Task):
             self.task.tick(time - self.__note_duration)
 
     def is_finished(self, time):
+        if self.__ended:
+            return True
         if not self.__note_duration:
             return False
         else:
             return self.task.is_finished(time - self.__note_duration)
 
-    def received_midi(self, rtmidi_message):
-        if (rtmidi_message.isNoteOff() and
-                rtmidi_message.getNoteNumber() == self.pitch):
+    def end(self):
+        """ Finish now, e.g. if the note off never arrived """
+        self.__ended = True
+        self.__midi_monitor.unregister(self)
+
+    def received_midi(self, message):
+        if message.kind == NOTE_OFF and message.data1 == self.pitch:
             self.__note_duration = time.time() - self.__start_time
             self.__midi_monitor.unregister(self)
@@ -0,0 +1,161 @@
+import logging
+import socket
+import time
+from array import array
+from collections import deque
+
+import numpy
+
+from latency import note_latency
+from light_engine import network_protocol
+from light_engine.pixel_adapter import PixelAdapter
+from metrics import metrics
+
+logger = logging.getLogger("global")
+
+
+class NetworkPixelAdapter(PixelAdapter):
+    """Sends frames to network pixel controllers over UDP using E1.31 or
+    Art-Net (see network_protocol).
+
+    The framebuffer is split into universes of PIXELS_PER_UNIVERSE pixels,
+    each sent as one UDP packet. The socket is non-blocking: if the OS send
+    buffer fills up mid-frame, the rest of the frame's packets are queued
+    and sent on later ready_for_push() checks instead of blocking the main
+    loop, and no new frame is taken until they're out.
+
+    Attributes:
+        packets_sent: number of universe packets sent so far.
+        packets_dropped: number of packets that failed to send.
+        frames_pushed: number of frames pushed so far.
+    """
+
+    def __init__(self, host, num_pixels, protocol=network_protocol.E131,
+                 port=None, first_universe=1):
+        """
+        Args:
+            host: address of the pixel controller. For E1.31, None sends
+                each universe to its standard multicast group instead.
+            protocol: network_protocol.E131 or network_protocol.ARTNET.
+            port: UDP port, defaults to the protocol's standard port.
+            first_universe: universe number of the first pixels.
+        """
+        self.num_pixels = num_pixels
+        self.protocol = protocol
+        self.name = "{}:{}".format(protocol, host or "multicast")
+        self.__port = port or network_protocol.default_port(protocol)
+
+        # same int32 per pixel framebuffer as ArduinoPixelAdapter
+        self.__pixel_array = array("i", ([0] * num_pixels))
+        # little-endian int32 bytes are B, G, R, unused: view them as RGB
+        # channels without copying
+        self.__rgb_view = numpy.frombuffer(
+            self.__pixel_array, dtype=numpy.uint8).reshape(-1, 4)[:, 2::-1]
+
+        # (universe, destination, first pixel, last pixel) for each packet
+        self.__universes = []
+        pixels_per_universe = network_protocol.PIXELS_PER_UNIVERSE
+        for index, start in enumerate(range(0, num_pixels,
+                                            pixels_per_universe)):
+            universe = first_universe + index
+            if host is None and protocol == network_protocol.E131:
+                destination = network_protocol.e131_multicast_address(
+                    universe)
+            else:
+                destination = host
+            self.__universes.append((
+                universe, (destination, self.__port),
+                start, min(start + pixels_per_universe, num_pixels)))
+
+        self.__socket = None
+        self.__pending_packets = deque()
+        self.__sequence = 0
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        self.frames_pushed = 0
+
+        self.__frames_pushed_metric = metrics.counter(
+            "lightful_output_frames_pushed_total",
+            "Frames sent to a pixel output", output=self.name)
+        self.__bytes_sent_metric = metrics.counter(
+            "lightful_output_bytes_sent_total",
+            "Bytes sent to a pixel output", output=self.name)
+        metrics.counter_function(
+            "lightful_output_packets_dropped_total",
+            "Network packets that failed to send",
+            lambda: self.packets_dropped, output=self.name)
+
+    def start(self):
+        if self.__socket is None:
+            self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__socket.setblocking(False)
+            logger.info("{} output open on port {} ({} universes)".format(
+                self.protocol, self.__port, len(self.__universes)))
+
+    def stop(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+            self.__pending_packets.clear()
+            logger.info(self.protocol + " output closed!")
+
+    def get_color(self, position):
+        return self.__pixel_array[position]
+
+    def set_color(self, position, color):
+        # don't need the alpha here, and the alpha confuses the signed-ness
+        self.__pixel_array[position] = color.with_alpha(0)
+
+    def wait_for_ready_state(self):
+        """ Block until every packet of the last frame has been sent """
+        while not self.ready_for_push():
+            # the socket's send buffer only drains so fast, don't spin on it
+            time.sleep(0.001)
+
+    def ready_for_push(self):
+        if self.__pending_packets:
+            self.__send_pending_packets()
+        return not self.__pending_packets
+
+    def push_pixels(self):
+        if self.__socket is None:
+            logger.error("Trying to send pixels when output isn't open!")
+            return
+
+        if not self.ready_for_push():
+            return
+
+        # E1.31 reserves sequence 0 as 'no sequence'
+        self.__sequence = self.__sequence % 255 + 1
+        rgb = self.__rgb_view.tobytes()
+        for universe, destination, start, end in self.__universes:
+            channels = rgb[start * network_protocol.CHANNELS_PER_PIXEL:
+                           end * network_protocol.CHANNELS_PER_PIXEL]
+            packet = network_protocol.encode_packet(
+                self.protocol, universe, self.__sequence, channels)
+            self.__pending_packets.append((packet, destination))
+        self.frames_pushed += 1
+        self.__frames_pushed_metric.inc()
+        self.__send_pending_packets()
+
+        # UDP has no acks, so the frame counts as shown once it's sent
+        note_latency.frame_written(self)
+        note_latency.frame_acked(self)
+
+    def __send_pending_packets(self):
+        while self.__pending_packets:
+            packet, destination = self.__pending_packets[0]
+            try:
+                self.__socket.sendto(packet, destination)
+            except BlockingIOError:
+                return  # send buffer is full, try again next time
+            except OSError as error:
+                # e.g. controller unreachable. UDP is lossy anyway, so drop
+                # the packet rather than stall the show
+                logger.error("failed to send " + self.protocol +
+                             " packet: " + str(error))
+                self.packets_dropped += 1
+            else:
+                self.packets_sent += 1
+                self.__bytes_sent_metric.inc(len(packet))
+            self.__pending_packets.popleft()
@@ -0,0 +1,132 @@
+import struct
+import uuid
+
+"""Network lighting protocols for driving pixel controllers over UDP.
+
+Pixels are sent as DMX512 style universes of channel data (one byte per
+channel, three channels per RGB pixel, so 170 pixels per universe), each
+universe in its own UDP packet:
+
+E1.31 (streaming ACN, sACN): ANSI E1.31 data packets (root, framing and DMP
+    layers followed by up to 512 channels), sent to port 5568.
+Art-Net: ArtDmx packets (header followed by up to 512 channels), sent to
+    port 6454.
+"""
+
+E131 = "e131"
+ARTNET = "artnet"
+
+E131_PORT = 5568
+ARTNET_PORT = 6454
+
+MAX_CHANNELS_PER_UNIVERSE = 512
+CHANNELS_PER_PIXEL = 3
+PIXELS_PER_UNIVERSE = MAX_CHANNELS_PER_UNIVERSE // CHANNELS_PER_PIXEL
+
+_E131_ACN_IDENTIFIER = b"ASC-E1.17\x00\x00\x00"
+_E131_ROOT_VECTOR = 0x00000004
+_E131_FRAMING_VECTOR = 0x00000002
+_E131_DMP_VECTOR = 0x02
+_E131_PRIORITY = 100
+# preamble size, postamble size, ACN identifier, root flags/length, root
+# vector, CID, framing flags/length, framing vector, source name, priority,
+# sync address, sequence, options, universe, DMP flags/length, DMP vector,
+# address type, first address, address increment, property value count,
+# DMX start code
+_E131_HEADER_FORMAT = ">HH12sHI16sHI64sBHBBHHBBHHHB"
+_E131_HEADER_SIZE = struct.calcsize(_E131_HEADER_FORMAT)
+_E131_ROOT_LAYER_START = 16
+_E131_FRAMING_LAYER_START = 38
+_E131_DMP_LAYER_START = 115
+_E131_FLAGS = 0x7000
+
+_ARTNET_ID = b"Art-Net\x00"
+_ARTNET_OPCODE_DMX = 0x5000
+_ARTNET_PROTOCOL_VERSION = 14
+# id, opcode (little-endian), protocol version, sequence, physical port,
+# universe (little-endian sub-uni then net), data length
+_ARTNET_HEADER_FORMAT = "<8sH"
+_ARTNET_DMX_FORMAT = ">HBB"
+_ARTNET_HEADER_SIZE = 18
+
+
+class NetworkProtocolError(Exception):
+    """ Raised for packets that don't decode as the expected protocol """
+    pass
+
+
+def default_port(protocol):
+    return E131_PORT if protocol == E131 else ARTNET_PORT
+
+
+def e131_multicast_address(universe):
+    """ Standard multicast group for an E1.31 universe """
+    return "239.255.{}.{}".format(universe >> 8, universe & 0xFF)
+
+
+def encode_e131_packet(universe, sequence, channels, source_name=b"lightful",
+                       cid=uuid.UUID(int=0).bytes):
+    length = _E131_HEADER_SIZE + len(channels)
+    header = struct.pack(
+        _E131_HEADER_FORMAT,
+        0x0010, 0x0000, _E131_ACN_IDENTIFIER,
+        _E131_FLAGS | (length - _E131_ROOT_LAYER_START), _E131_ROOT_VECTOR,
+        cid,
+        _E131_FLAGS | (length - _E131_FRAMING_LAYER_START),
+        _E131_FRAMING_VECTOR, source_name, _E131_PRIORITY, 0, sequence, 0,
+        universe,
+        _E131_FLAGS | (length - _E131_DMP_LAYER_START), _E131_DMP_VECTOR,
+        0xa1, 0, 1, len(channels) + 1, 0)
+    return header + bytes(channels)
+
+
+def decode_e131_packet(data):
+    """ Decode an E1.31 data packet into (universe, sequence, channels) """
+    if len(data) < _E131_HEADER_SIZE:
+        raise NetworkProtocolError("E1.31 packet too short")
+    fields = struct.unpack_from(_E131_HEADER_FORMAT, data)
+    if fields[2] != _E131_ACN_IDENTIFIER or fields[4] != _E131_ROOT_VECTOR:
+        raise NetworkProtocolError("not an E1.31 packet")
+    sequence, universe, value_count = fields[11], fields[13], fields[19]
+    channels = data[_E131_HEADER_SIZE:_E131_HEADER_SIZE + value_count - 1]
+    return universe, sequence, channels
+
+
+def encode_artnet_packet(universe, sequence, channels):
+    if len(channels) % 2:
+        channels = bytes(channels) + b"\x00"  # length must be even
+    return (struct.pack(_ARTNET_HEADER_FORMAT, _ARTNET_ID,
+                        _ARTNET_OPCODE_DMX) +
+            struct.pack(_ARTNET_DMX_FORMAT, _ARTNET_PROTOCOL_VERSION,
+                        sequence, 0) +
+            struct.pack("<H", universe) +
+            struct.pack(">H", len(channels)) +
+            bytes(channels))
+
+
+def decode_artnet_packet(data):
+    """ Decode an ArtDmx packet into (universe, sequence, channels) """
+    if len(data) < _ARTNET_HEADER_SIZE:
+        raise NetworkProtocolError("Art-Net packet too short")
+    artnet_id, opcode = struct.unpack_from(_ARTNET_HEADER_FORMAT, data)
+    if artnet_id != _ARTNET_ID or opcode != _ARTNET_OPCODE_DMX:
+        raise NetworkProtocolError("not an ArtDmx packet")
+    _, sequence, _ = struct.unpack_from(_ARTNET_DMX_FORMAT, data, 10)
+    universe, = struct.unpack_from("<H", data, 14)
+    length, = struct.unpack_from(">H", data, 16)
+    return universe, sequence, data[_ARTNET_HEADER_SIZE:
+                                    _ARTNET_HEADER_SIZE + length]
+
+
+def encode_packet(protocol, universe, sequence, channels):
+    if protocol == E131:
+        return encode_e131_packet(universe, sequence, channels)
+    return encode_artnet_packet(universe, sequence, channels)
+
+
+def decode_packet(data):
+    """ Decode either protocol's packet into (universe, sequence,
+    channels) """
+    if data.startswith(_ARTNET_ID):
+        return decode_artnet_packet(data)
+    return decode_e131_packet(data)
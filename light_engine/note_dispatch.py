@@ -0,0 +1,88 @@
+import logging
+
+logger = logging.getLogger("global")
+
+"""Note to light effect dispatch.
+
+Shows map notes to light effect tasks (see a show's note_map). Compiled
+into a NoteDispatchTable when the show loads, every (channel, pitch) has a
+slot in a flat 16x128 list holding the prebuilt task's class and
+attributes plus its scheduler tag, so handling a note on is one list index
+and creating the task from its attributes: no dict lookups, key tuples or
+copy.copy on the way from note to light.
+"""
+
+CHANNELS = 16
+PITCHES = 128
+
+
+class NoteDispatchTable:
+    """ Task templates by MIDI channel (1-16) and pitch """
+
+    def __init__(self):
+        # (task class, task attributes, unique tag) or None, by
+        # (channel - 1) * PITCHES + pitch
+        self.__entries = [None] * (CHANNELS * PITCHES)
+
+    @classmethod
+    def compile(cls, note_map, unique_tag=None):
+        """ Table for a show's note map, keyed by pitch (for notes on any
+        channel) or by (pitch, channel). unique_tag(pitch, channel), if
+        given, is the scheduler tag of each note's tasks """
+        table = cls()
+        for key, task in note_map.items():
+            if isinstance(key, tuple):
+                pitch, channel = key
+                channels = [channel]
+            else:
+                pitch = key
+                channels = range(1, CHANNELS + 1)
+            for channel in channels:
+                tag = None if unique_tag is None else unique_tag(pitch,
+                                                                 channel)
+                table.set(pitch, task, channel, unique_tag=tag)
+        return table
+
+    def set(self, pitch, task, channel=None, unique_tag=None):
+        """ Play a copy of task for pitch on channel (or every channel).
+        task is copied as it is now, later changes to it aren't seen """
+        entry = (type(task), dict(vars(task)), unique_tag)
+        channels = [channel] if channel is not None else \
+            range(1, CHANNELS + 1)
+        for channel in channels:
+            self.__entries[_index(pitch, channel)] = entry
+
+    def remove(self, pitch, channel=None):
+        channels = [channel] if channel is not None else \
+            range(1, CHANNELS + 1)
+        for channel in channels:
+            self.__entries[_index(pitch, channel)] = None
+
+    def new_task(self, pitch, channel):
+        """ A new task for a note (a shallow copy of its template) and its
+        unique tag, or None if nothing is mapped to it """
+        entry = self.__entries[_index(pitch, channel)]
+        if entry is None:
+            return None
+        task_class, attributes, unique_tag = entry
+        task = task_class.__new__(task_class)
+        task.__dict__.update(attributes)
+        return task, unique_tag
+
+    def dispatch(self, scheduler, pitch, channel):
+        """ Schedule a note's task, if anything is mapped to it. Returns
+        the task """
+        new_task = self.new_task(pitch, channel)
+        if new_task is None:
+            return None
+        task, unique_tag = new_task
+        scheduler.add(task, unique_tag=unique_tag)
+        return task
+
+
+def _index(pitch, channel):
+    """ Slot of a note. Channels wrap the way MidiMessage's do (e.g. 0 is
+    16), so lookups find what set stored """
+    if not 0 <= pitch < PITCHES:
+        raise ValueError("pitch out of range: " + str(pitch))
+    return ((channel - 1) & 0x0F) * PITCHES + pitch
@@ -1,18 +1,82 @@
 import logging
 import os
+import struct
 import time
+from abc import ABC
+from abc import abstractmethod
 from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 import serial
 
+from latency import note_latency
+from light_engine import serial_protocol
+from metrics import metrics
+
 logger = logging.getLogger("global")
 
 
-class ArduinoPixelAdapter:
+class PixelAdapter(ABC):
+    """Output for a string of pixels.
+
+    Shows and light effects set colors on the adapter's framebuffer, and the
+    main loop pushes the framebuffer out to the lights whenever the adapter
+    is ready for another frame.
+
+    Attributes:
+        num_pixels: number of pixel positions in the framebuffer.
+    """
+
+    @abstractmethod
+    def start(self):
+        """Open (or re-open) the connection to the lights"""
+        pass
+
+    @abstractmethod
+    def stop(self):
+        """Close the connection to the lights"""
+        pass
+
+    @abstractmethod
+    def get_color(self, position):
+        """Color (int32, see color.py) currently set for a position"""
+        pass
+
+    @abstractmethod
+    def set_color(self, position, color):
+        """Set the color for a position, sent on the next push"""
+        pass
+
+    @abstractmethod
+    def ready_for_push(self):
+        """Whether the output can take another frame without blocking"""
+        pass
+
+    @abstractmethod
+    def push_pixels(self):
+        """Send the framebuffer to the lights"""
+        pass
+
+    @abstractmethod
+    def wait_for_ready_state(self):
+        """Block until the output is ready for another frame"""
+        pass
+
+
+class ArduinoPixelAdapter(PixelAdapter):
     """simple interface for setting NeoPixel lights via Arduino"""
 
-    def __init__(self, serial_port_id, baud_rate, num_pixels):
+    def __init__(self, serial_port_id, baud_rate, num_pixels,
+                 ack_timeout=None):
+        """
+        Args:
+            ack_timeout: with the framed protocol, seconds to wait for a
+                frame's ack before giving up on it and sending the next
+                frame. Defaults to a generous multiple of the time it takes
+                to send a frame at baud_rate.
+        """
         self.num_pixels = num_pixels
+        self.name = serial_port_id
 
         # array of pixels, each pixel being represented by an Int32 for R, G,
         # and B (and 8 empty bits on top)
@@ -23,22 +87,67 @@ class ArduinoPixelAdapter:
 
         # NOTE: the act of setting up serial reboots the remote Arduino, so we
         # want to have the Arduino initiate contact once it's been fully booted
+        # (see serial_protocol for the protocol itself)
         waiting = self.__serial.readline()
-
-        # TODO: Document controller/arduino protocol here
-        # TODO: Check that it's a specific message?
         logger.info("log 'setup' message: " + str(waiting))
+        self.protocol_version, capabilities, self.__max_chunk_pixels = \
+            serial_protocol.parse_setup_message(waiting)
 
-        logger.info("sending num_pixel value to Arduino: " + str(num_pixels))
-        self.__serial.write(num_pixels.to_bytes(1, byteorder='little'))
+        if self.protocol_version == 1:
+            if num_pixels > serial_protocol.MAX_PIXELS_VERSION_1:
+                raise serial_protocol.ProtocolError(
+                    "Arduino firmware only supports up to " +
+                    str(serial_protocol.MAX_PIXELS_VERSION_1) +
+                    " pixels, update it to drive " + str(num_pixels))
+            self.__capabilities = 0
+            logger.info("sending num_pixel value to Arduino: " +
+                        str(num_pixels))
+            self.__serial.write(num_pixels.to_bytes(1, byteorder='little'))
+        else:
+            self.__capabilities = \
+                capabilities & serial_protocol.SUPPORTED_CAPABILITIES
+            logger.info("sending v{} handshake to Arduino: {} pixels, "
+                        "capabilities {}".format(
+                            serial_protocol.PROTOCOL_VERSION, num_pixels,
+                            self.__capabilities))
+            self.__serial.write(serial_protocol.encode_handshake(
+                num_pixels, self.__capabilities))
 
         # wait for next line
         self.__serial.readline()
 
         logger.info("Serial open, handshake complete!")
 
+        self.__is_framed = bool(
+            self.__capabilities & serial_protocol.CAPABILITY_FRAMED)
+        self.__packet_decoder = serial_protocol.PacketDecoder()
+        self.__sequence = 0
+        if ack_timeout is None:
+            # ~10 bits on the wire per byte
+            frame_seconds = num_pixels * serial_protocol.BYTES_PER_PIXEL * \
+                10.0 / baud_rate
+            ack_timeout = 0.05 + 4 * frame_seconds
+        self.__ack_timeout = ack_timeout
+        self.ack_timeouts = 0
+
+        self.__frames_pushed_metric = metrics.counter(
+            "lightful_output_frames_pushed_total",
+            "Frames sent to a pixel output", output=self.name)
+        self.__bytes_sent_metric = metrics.counter(
+            "lightful_output_bytes_sent_total",
+            "Bytes sent to a pixel output", output=self.name)
+        self.__ack_timeouts_metric = metrics.counter(
+            "lightful_serial_ack_timeouts_total",
+            "Frames never acked by an Arduino", output=self.name)
+        self.__ack_latency_metric = metrics.histogram(
+            "lightful_serial_ack_latency_seconds",
+            "Time from writing a frame to an Arduino until its ack",
+            output=self.name)
+
         # ready for next push
         self.__ready_for_push = True
+        self.__push_time = None
+        self.last_ack_latency = None
 
     def start(self):
         if not self.__serial.is_open:
@@ -57,6 +166,11 @@ class ArduinoPixelAdapter:
         # don't need the alpha here, and the alpha confuses the signed-ness
         self.__pixel_array[position] = color.with_alpha(0)
 
+    def load_frame(self, pixel_array, offset=0):
+        """ Copy this adapter's share of a larger framebuffer, starting at
+        'offset', into the pixels to push next """
+        self.__pixel_array[:] = pixel_array[offset:offset + self.num_pixels]
+
     def int32(self, x):
         if x > 0xFFFFFFFF:
             raise OverflowError
@@ -67,8 +181,8 @@ class ArduinoPixelAdapter:
 
     def wait_for_ready_state(self):
         """ Block and wait for arduino to send back message """
-        while not self.ready_for_push:
-            self.check_for_ready_state()
+        while not self.ready_for_push():
+            self.check_for_push_received_message()
             time.sleep(0.01)
 
     def ready_for_push(self):
@@ -78,16 +192,205 @@ class ArduinoPixelAdapter:
     def check_for_push_received_message(self):
         # if ready_for_push is false it means we're waiting for arduino
         # response
-        if not self.__ready_for_push and self.__serial.in_waiting > 0:
+        if self.__ready_for_push:
+            return
+        if self.__is_framed:
+            self.__check_for_framed_ack()
+        elif self.__serial.in_waiting > 0:
             # any response will do for now -- Arduino just sends a single
             # newline back
             self.__serial.readline()
+            self.__ack_received()
+
+    def __check_for_framed_ack(self):
+        if self.__serial.in_waiting > 0:
+            data = self.__serial.read(self.__serial.in_waiting)
+            for packet_type, sequence, body in \
+                    self.__packet_decoder.feed(data):
+                if (packet_type == serial_protocol.PACKET_ACK and
+                        sequence == self.__sequence):
+                    arrival_time = None
+                    if len(body) == serial_protocol.ACK_BODY_SIZE:
+                        arrival_time, = struct.unpack(
+                            serial_protocol.ACK_BODY_FORMAT, body)
+                    self.__ack_received(arrival_time)
+                    return
+
+        if time.time() - self.__push_time > self.__ack_timeout:
+            # frame or its ack got lost/corrupted, resync by moving on to
+            # the next frame
+            self.ack_timeouts += 1
+            self.__ack_timeouts_metric.inc()
+            logger.warning("no ack for frame " + str(self.__sequence) +
+                           ", resyncing (" + str(self.ack_timeouts) +
+                           " timeouts so far)")
             self.__ready_for_push = True
 
+    def __ack_received(self, arrival_time=None):
+        self.__ready_for_push = True
+        self.last_ack_latency = time.time() - self.__push_time
+        self.__ack_latency_metric.observe(self.last_ack_latency)
+        note_latency.frame_acked(self, arrival_time)
+
     def push_pixels(self):
         if not self.__serial.is_open:
             logger.error("Trying to send serial when serial isn't open!")
 
         if self.ready_for_push():
-            self.__serial.write(self.__pixel_array)
+            if self.__is_framed:
+                self.__sequence = (self.__sequence + 1) % 256
+                data = serial_protocol.encode_framed_frame(
+                    self.__pixel_array, self.__sequence,
+                    self.__max_chunk_pixels)
+            elif self.__capabilities & serial_protocol.CAPABILITY_CHUNKED:
+                data = serial_protocol.encode_chunked_frame(
+                    self.__pixel_array, self.__max_chunk_pixels)
+            else:
+                data = self.__pixel_array
+            self.__serial.write(data)
+            self.__frames_pushed_metric.inc()
+            self.__bytes_sent_metric.inc(memoryview(data).nbytes)
+            self.__push_time = time.time()
             self.__ready_for_push = False  # now wait for next received message
+            note_latency.frame_written(self)
+
+
+class _Output:
+    """State for one of the controllers driven by a MultiPixelAdapter.
+
+    Attributes:
+        adapter: adapter for the controller.
+        offset: first position of the logical framebuffer the controller
+            drives.
+        pending_push: future for a push in progress (None if idle).
+        frames_pushed: number of frames sent to the controller.
+        frames_skipped: number of frames the controller missed because it
+            was still busy with (or waiting on an ack for) a previous one.
+        push_errors: number of pushes that failed (e.g. the controller was
+            unplugged).
+    """
+
+    def __init__(self, adapter, offset):
+        self.adapter = adapter
+        self.offset = offset
+        self.pending_push = None
+        self.frames_pushed = 0
+        self.frames_skipped = 0
+        self.push_errors = 0
+
+    def is_idle(self):
+        return self.pending_push is None or self.pending_push.done()
+
+
+class MultiPixelAdapter(PixelAdapter):
+    """Drives several controllers as one logical strip of pixels.
+
+    Positions of the logical framebuffer are split into consecutive ranges,
+    each driven by its own adapter (e.g. one Arduino per serial port). Pushes
+    are written to all controllers concurrently and each controller's ack is
+    tracked separately, so a slow strip only drops its own frames instead of
+    stalling the rest.
+    """
+
+    def __init__(self, adapters_by_range):
+        """
+        Args:
+            adapters_by_range: list of (positions, adapter) pairs, e.g.
+                [(range(0, 300), adapter1), (range(300, 600), adapter2)].
+                Each adapter's num_pixels must match its range.
+        """
+        self.__outputs = []
+        for positions, adapter in adapters_by_range:
+            if len(positions) != adapter.num_pixels:
+                raise ValueError(
+                    "positions " + str(positions) + " don't match adapter "
+                    "with " + str(adapter.num_pixels) + " pixels")
+            output = _Output(adapter, positions[0])
+            self.__outputs.append(output)
+            metrics.counter_function(
+                "lightful_output_frames_skipped_total",
+                "Frames a pixel output missed because it was still busy",
+                lambda output=output: output.frames_skipped,
+                output=adapter.name)
+            metrics.counter_function(
+                "lightful_output_push_errors_total",
+                "Pushes to a pixel output that failed",
+                lambda output=output: output.push_errors,
+                output=adapter.name)
+        self.num_pixels = max(positions[-1] + 1
+                              for positions, _ in adapters_by_range)
+
+        # the single logical framebuffer that gets split between outputs
+        self.__pixel_array = array("i", ([0] * self.num_pixels))
+
+        # one worker per output so each controller's (blocking) serial write
+        # happens in parallel
+        self.__executor = ThreadPoolExecutor(
+            max_workers=len(self.__outputs))
+
+    def start(self):
+        for output in self.__outputs:
+            output.adapter.start()
+
+    def stop(self):
+        for output in self.__outputs:
+            output.pending_push = _wait_for_push(output.pending_push)
+            output.adapter.stop()
+
+    def get_color(self, position):
+        return self.__pixel_array[position]
+
+    def set_color(self, position, color):
+        # don't need the alpha here, and the alpha confuses the signed-ness
+        self.__pixel_array[position] = color.with_alpha(0)
+
+    def wait_for_ready_state(self):
+        """ Block and wait for every controller to be ready """
+        for output in self.__outputs:
+            output.pending_push = _wait_for_push(output.pending_push)
+            output.adapter.wait_for_ready_state()
+
+    def ready_for_push(self):
+        """ Ready as soon as any one controller can take a new frame """
+        return any(self.__is_output_ready(output)
+                   for output in self.__outputs)
+
+    def push_pixels(self):
+        """ Push the latest frame to every controller that's ready for it """
+        for output in self.__outputs:
+            if not self.__is_output_ready(output):
+                output.frames_skipped += 1
+                continue
+            output.adapter.load_frame(self.__pixel_array, output.offset)
+            output.pending_push = self.__executor.submit(
+                output.adapter.push_pixels)
+            output.frames_pushed += 1
+
+    def output_stats(self):
+        """ Per controller (frames pushed, frames skipped, last ack latency)
+        """
+        return [(output.frames_pushed, output.frames_skipped,
+                 output.adapter.last_ack_latency)
+                for output in self.__outputs]
+
+    def __is_output_ready(self, output):
+        # only poll the adapter for its ack once the write has finished so
+        # the adapter's serial port is never used by two threads at once
+        if not output.is_idle():
+            return False
+        if output.pending_push is not None:
+            # finished: report a failed push (once) instead of dropping it
+            error = output.pending_push.exception()
+            output.pending_push = None
+            if error is not None:
+                output.push_errors += 1
+                logger.error("push to " + output.adapter.name + " failed: " +
+                             str(error))
+        return output.adapter.ready_for_push()
+
+
+def _wait_for_push(future):
+    """ Wait for a push future (if any) to complete """
+    if future is not None:
+        future.result()
+    return None
@@ -0,0 +1,154 @@
+import json
+import logging
+import math
+
+import numpy
+
+from light_engine.light_effect import LightSection
+
+logger = logging.getLogger("global")
+
+DEFAULT_LAYOUT_FILE = "media/layouts/hanging_door.json"
+
+
+class PixelLayout:
+    """Physical layout of the pixels in an installation.
+
+    A layout maps pixel positions (a pixel's index in the data sent to the
+    controller) to 2D/3D coordinates. Layout files are JSON made up of named
+    strips whose pixels are evenly spaced between a start and end coordinate:
+    {
+        "num_pixels": 100,
+        "strips": [
+            {"name": "row1", "positions": [10, 29],
+             "start": [0, 0, 0], "end": [0, 19, 0]},
+            {"name": "row2", "positions": [49, 30],
+             "start": [1, 0, 0], "end": [1, 19, 0]}
+        ]
+    }
+    'positions' is an inclusive range and may run backwards (e.g. for strips
+    wired in a serpentine). Pixels not covered by any strip (e.g. dead
+    pixels) have no coordinates and are ignored by geometry lookups.
+
+    Geometry fields (distance from center, angle around center, projections
+    along a direction) are computed once for all pixels so radial and
+    directional effects can look gradients up instead of redoing the math
+    every tick.
+
+    Attributes:
+        num_pixels: total number of pixels driven by the controller.
+        coordinates: (num_pixels, 3) array of coordinates, NaN for pixels
+            that aren't part of any strip.
+        mapped_positions: array of positions that have coordinates, in
+            strip order.
+        center: center point of all mapped pixels.
+        distance_field: per position distance from center, normalized to
+            0..1 (NaN for unmapped positions).
+        angle_field: per position angle around center in the xy plane,
+            normalized to 0..1 (NaN for unmapped positions).
+    """
+
+    def __init__(self, num_pixels, strips):
+        self.num_pixels = num_pixels
+        self.coordinates = numpy.full((num_pixels, 3), numpy.nan)
+        self.__positions_by_strip = {}
+
+        for strip in strips:
+            first, last = strip["positions"]
+            step = 1 if last >= first else -1
+            positions = list(range(first, last + step, step))
+            start = _as_3d(strip["start"])
+            end = _as_3d(strip["end"])
+
+            if len(positions) > 1:
+                steps = numpy.linspace(0, 1, len(positions))[:, numpy.newaxis]
+            else:
+                steps = numpy.zeros((1, 1))
+            self.coordinates[positions] = start + (end - start) * steps
+            self.__positions_by_strip[strip["name"]] = positions
+
+        self.mapped_positions = numpy.array(
+            [p for positions in self.__positions_by_strip.values()
+             for p in positions], dtype=int)
+
+        mapped_coordinates = self.coordinates[self.mapped_positions]
+        self.center = mapped_coordinates.mean(axis=0)
+
+        offsets = self.coordinates - self.center
+        distances = numpy.linalg.norm(offsets, axis=1)
+        self.distance_field = distances / _nonzero(
+            numpy.nanmax(distances))
+
+        angles = numpy.arctan2(offsets[:, 1], offsets[:, 0])
+        self.angle_field = numpy.mod(angles, 2 * math.pi) / (2 * math.pi)
+
+        self.__directional_fields = {}
+
+    @classmethod
+    def load(cls, file_name):
+        """ Load a layout from a JSON layout file """
+        with open(file_name) as layout_file:
+            description = json.load(layout_file)
+        layout = cls(description["num_pixels"], description["strips"])
+        logger.info("loaded pixel layout '{}' ({} pixels, {} mapped)".format(
+            description.get("name", file_name), layout.num_pixels,
+            len(layout.mapped_positions)))
+        return layout
+
+    def strip_names(self):
+        return list(self.__positions_by_strip.keys())
+
+    def section(self, strip_name):
+        """ LightSection for a named strip, with gradients running from the
+        strip's start coordinate to its end coordinate """
+        return LightSection(self.__positions_by_strip[strip_name])
+
+    def directional_field(self, direction):
+        """ Per position projection along 'direction' (e.g. (0, 1, 0) for
+        bottom to top), normalized to 0..1 over mapped pixels. Fields are
+        cached per direction """
+        direction = tuple(_as_3d(direction))
+        field = self.__directional_fields.get(direction)
+        if field is None:
+            unit = numpy.array(direction) / _nonzero(
+                numpy.linalg.norm(direction))
+            projection = self.coordinates.dot(unit)
+            low = numpy.nanmin(projection)
+            field = (projection - low) / _nonzero(
+                numpy.nanmax(projection) - low)
+            self.__directional_fields[direction] = field
+        return field
+
+    def radial_section(self, section=None):
+        """ LightSection whose gradients are distance from the layout's
+        center (0 at the center, 1 at the furthest pixel) """
+        return self.__section_with_field(section, self.distance_field)
+
+    def angular_section(self, section=None):
+        """ LightSection whose gradients are the angle around the layout's
+        center (one full turn ranges from 0 to 1) """
+        return self.__section_with_field(section, self.angle_field)
+
+    def directional_section(self, direction, section=None):
+        """ LightSection whose gradients sweep along 'direction' """
+        return self.__section_with_field(
+            section, self.directional_field(direction))
+
+    def __section_with_field(self, section, field):
+        if section is None:
+            positions = self.mapped_positions
+        else:
+            positions = numpy.array(section.positions, dtype=int)
+        # plain python floats keep per-pixel effect math fast
+        return LightSection(positions.tolist(), field[positions].tolist())
+
+
+def _as_3d(coordinate):
+    """ Pad 2D coordinates with z = 0 """
+    coordinate = list(coordinate) + [0] * (3 - len(coordinate))
+    return numpy.array(coordinate, dtype=float)
+
+
+def _nonzero(value):
+    """ Avoid dividing by zero for degenerate layouts (e.g. a single pixel) """
+    return value if value else 1.0
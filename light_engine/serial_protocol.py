@@ -0,0 +1,335 @@
+import binascii
+import struct
+
+"""Serial protocol spoken between the controller (ArduinoPixelAdapter) and
+the microcontroller driving the pixels (an Arduino or VirtualArduinoClient).
+
+Version 1 (legacy firmware):
+    1. microcontroller boots and sends any line, e.g. "I'm ready!\\n"
+    2. controller sends the pixel count as a single byte (max 255 pixels)
+    3. microcontroller replies with "\\n"
+    4. each frame is a raw dump of num_pixels * 4 bytes (little-endian
+       int32 per pixel: B, G, R, unused), acked by "\\n"
+
+Version 2:
+    1. microcontroller boots and sends its setup line:
+       "LIGHTFUL <version> <capabilities> <max_chunk_pixels>\\n"
+    2. controller sends a handshake (see HANDSHAKE_FORMAT): magic b"LF",
+       protocol version, pixel count (uint16, so up to 65535 pixels) and
+       the capabilities both sides support
+    3. microcontroller replies with "\\n"
+    4. with CAPABILITY_CHUNKED, each frame is sent as a series of chunks of
+       at most max_chunk_pixels pixels. Each chunk is a header (see
+       CHUNK_HEADER_FORMAT: first pixel offset and pixel count) followed by
+       the chunk's pixels (4 bytes each, as in version 1). The frame is
+       acked by "\\n" once the chunk ending at the last pixel arrives.
+       Chunks let firmware with little RAM write each chunk straight into
+       its pixel buffer instead of holding the whole frame.
+    5. with CAPABILITY_FRAMED, everything after the handshake is sent as
+       packets, in both directions. A packet is a header (see
+       PACKET_HEADER_FORMAT: packet type, sequence number, body length),
+       the body and a CRC-16 of header and body, COBS encoded (so the
+       packet contains no zero bytes) and terminated by a zero byte.
+       Frames are sent as PACKET_FRAME_CHUNK packets (body: chunk header
+       and pixels as above) all sharing the frame's sequence number, and
+       are acked by a PACKET_ACK carrying the same sequence number. The
+       ack's body may optionally hold the time the frame arrived (see
+       ACK_BODY_FORMAT, a time.perf_counter() timestamp), which the virtual
+       client sends for latency tracking.
+       A corrupted or lost byte only costs the packet it's in: the reader
+       drops it and resynchronizes on the next zero byte, and the
+       controller stops waiting for an ack after a timeout. This is what
+       makes running at 1-2 Mbaud safe.
+"""
+
+PROTOCOL_VERSION = 2
+
+SETUP_MESSAGE_PREFIX = b"LIGHTFUL"
+
+# capability flags (bitwise or'ed together)
+CAPABILITY_CHUNKED = 0x01
+CAPABILITY_FRAMED = 0x02
+SUPPORTED_CAPABILITIES = CAPABILITY_CHUNKED | CAPABILITY_FRAMED
+
+HANDSHAKE_MAGIC = b"LF"
+# magic, version, num_pixels, capabilities
+HANDSHAKE_FORMAT = "<2sBHB"
+HANDSHAKE_SIZE = struct.calcsize(HANDSHAKE_FORMAT)
+
+# pixel offset, pixel count
+CHUNK_HEADER_FORMAT = "<HH"
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER_FORMAT)
+
+BYTES_PER_PIXEL = 4
+
+# packet type, sequence number, body length
+PACKET_HEADER_FORMAT = "<BBH"
+PACKET_HEADER_SIZE = struct.calcsize(PACKET_HEADER_FORMAT)
+PACKET_CHECKSUM_FORMAT = "<H"
+PACKET_CHECKSUM_SIZE = struct.calcsize(PACKET_CHECKSUM_FORMAT)
+PACKET_DELIMITER = b"\x00"
+
+PACKET_FRAME_CHUNK = 1
+PACKET_ACK = 2
+
+# frame arrival time
+ACK_BODY_FORMAT = "<d"
+ACK_BODY_SIZE = struct.calcsize(ACK_BODY_FORMAT)
+
+# keep chunk packet bodies within the 16 bit body length
+MAX_FRAMED_CHUNK_PIXELS = (0xFFFF - CHUNK_HEADER_SIZE) // BYTES_PER_PIXEL
+# worst case size of an encoded packet, anything longer is garbage
+MAX_ENCODED_PACKET_SIZE = (PACKET_HEADER_SIZE + 0xFFFF +
+                           PACKET_CHECKSUM_SIZE) * 255 // 254 + 2
+
+MAX_PIXELS_VERSION_1 = 255
+MAX_PIXELS = 0xFFFF
+
+
+class ProtocolError(Exception):
+    """ Raised when the two sides of the serial protocol disagree """
+    pass
+
+
+def setup_message(capabilities, max_chunk_pixels):
+    """ Setup line a version 2 microcontroller sends once it has booted """
+    return SETUP_MESSAGE_PREFIX + " {} {} {}\n".format(
+        PROTOCOL_VERSION, capabilities, max_chunk_pixels).encode()
+
+
+def parse_setup_message(line):
+    """ Parse a microcontroller's setup line into (version, capabilities,
+    max_chunk_pixels). Lines from legacy firmware parse as version 1 """
+    if not line.startswith(SETUP_MESSAGE_PREFIX):
+        return 1, 0, 0
+    try:
+        _, version, capabilities, max_chunk_pixels = line.split()
+        return int(version), int(capabilities), int(max_chunk_pixels)
+    except ValueError:
+        raise ProtocolError("malformed setup message: " + str(line))
+
+
+def encode_handshake(num_pixels, capabilities):
+    if num_pixels > MAX_PIXELS:
+        raise ProtocolError("protocol supports at most " + str(MAX_PIXELS) +
+                            " pixels, got " + str(num_pixels))
+    return struct.pack(HANDSHAKE_FORMAT, HANDSHAKE_MAGIC, PROTOCOL_VERSION,
+                       num_pixels, capabilities)
+
+
+def decode_handshake(data):
+    """ Decode a handshake into (version, num_pixels, capabilities) """
+    magic, version, num_pixels, capabilities = struct.unpack(
+        HANDSHAKE_FORMAT, data)
+    if magic != HANDSHAKE_MAGIC:
+        raise ProtocolError("unexpected handshake: " + str(data))
+    return version, num_pixels, capabilities
+
+
+def encode_chunked_frame(pixel_bytes, max_chunk_pixels):
+    """ Split a frame's pixel bytes (any buffer, e.g. the adapter's int32
+    pixel array) into header-prefixed chunks """
+    pixel_bytes = memoryview(pixel_bytes).cast("B")
+    num_pixels = len(pixel_bytes) // BYTES_PER_PIXEL
+    chunk_bytes = max_chunk_pixels * BYTES_PER_PIXEL
+    chunks = []
+    for offset in range(0, num_pixels, max_chunk_pixels):
+        count = min(max_chunk_pixels, num_pixels - offset)
+        start = offset * BYTES_PER_PIXEL
+        chunks.append(struct.pack(CHUNK_HEADER_FORMAT, offset, count))
+        chunks.append(pixel_bytes[start:start + chunk_bytes])
+    return b"".join(chunks)
+
+
+class ChunkedFrameDecoder:
+    """Reassembles frames from a stream of chunked frame bytes.
+
+    Bytes can be fed in however they arrive from serial (partial chunks,
+    several chunks at once); complete frames come out the other end.
+    """
+
+    def __init__(self, num_pixels):
+        self.num_pixels = num_pixels
+        self.__buffer = bytearray()
+        self.__frame = bytearray(num_pixels * BYTES_PER_PIXEL)
+
+    def feed(self, data):
+        """ Add received bytes, returns a list of completed frames (as
+        bytes of num_pixels * 4 pixel data) """
+        self.__buffer.extend(data)
+        frames = []
+        while len(self.__buffer) >= CHUNK_HEADER_SIZE:
+            offset, count = struct.unpack_from(CHUNK_HEADER_FORMAT,
+                                               self.__buffer)
+            chunk_end = CHUNK_HEADER_SIZE + count * BYTES_PER_PIXEL
+            if len(self.__buffer) < chunk_end:
+                break  # wait for the rest of the chunk
+
+            if offset + count > self.num_pixels:
+                raise ProtocolError("chunk at " + str(offset) + " with " +
+                                    str(count) + " pixels overflows frame")
+            start = offset * BYTES_PER_PIXEL
+            self.__frame[start:start + count * BYTES_PER_PIXEL] = \
+                self.__buffer[CHUNK_HEADER_SIZE:chunk_end]
+            del self.__buffer[:chunk_end]
+
+            if offset + count == self.num_pixels:
+                frames.append(bytes(self.__frame))
+        return frames
+
+
+def cobs_encode(data):
+    """ Consistent overhead byte stuffing: re-encode data so it contains no
+    zero bytes (at a cost of about one byte per 254) """
+    encoded = bytearray()
+    for segment in bytes(data).split(b"\x00"):
+        while len(segment) >= 0xFE:
+            encoded.append(0xFF)
+            encoded += segment[:0xFE]
+            segment = segment[0xFE:]
+        encoded.append(len(segment) + 1)
+        encoded += segment
+    return bytes(encoded)
+
+
+def cobs_decode(data):
+    """ Reverse of cobs_encode """
+    decoded = bytearray()
+    index = 0
+    length = len(data)
+    while index < length:
+        code = data[index]
+        end = index + code
+        if code == 0 or end > length:
+            raise ProtocolError("invalid COBS data")
+        decoded += data[index + 1:end]
+        index = end
+        if code < 0xFF and index < length:
+            decoded.append(0)
+    return bytes(decoded)
+
+
+def encode_packet(packet_type, sequence, body=b""):
+    """ Frame a packet body (see CAPABILITY_FRAMED) """
+    packet = struct.pack(PACKET_HEADER_FORMAT, packet_type, sequence,
+                         len(body)) + bytes(body)
+    checksum = struct.pack(PACKET_CHECKSUM_FORMAT,
+                           binascii.crc_hqx(packet, 0xFFFF))
+    return cobs_encode(packet + checksum) + PACKET_DELIMITER
+
+
+def encode_framed_frame(pixel_bytes, sequence, max_chunk_pixels):
+    """ A frame as a series of PACKET_FRAME_CHUNK packets """
+    pixel_bytes = memoryview(pixel_bytes).cast("B")
+    num_pixels = len(pixel_bytes) // BYTES_PER_PIXEL
+    max_chunk_pixels = min(max_chunk_pixels or num_pixels,
+                           MAX_FRAMED_CHUNK_PIXELS)
+    packets = []
+    for offset in range(0, num_pixels, max_chunk_pixels):
+        count = min(max_chunk_pixels, num_pixels - offset)
+        start = offset * BYTES_PER_PIXEL
+        body = struct.pack(CHUNK_HEADER_FORMAT, offset, count) + \
+            pixel_bytes[start:start + count * BYTES_PER_PIXEL]
+        packets.append(encode_packet(PACKET_FRAME_CHUNK, sequence, body))
+    return b"".join(packets)
+
+
+class PacketDecoder:
+    """Splits a byte stream into packets (see CAPABILITY_FRAMED).
+
+    Packets that fail to decode (bad COBS, length or checksum, e.g. because
+    a byte was lost) are dropped and counted, and decoding carries on from
+    the next delimiter.
+
+    Attributes:
+        dropped_packets: number of corrupted packets dropped so far.
+    """
+
+    def __init__(self):
+        self.__buffer = bytearray()
+        self.dropped_packets = 0
+
+    def feed(self, data):
+        """ Add received bytes, returns a list of complete packets as
+        (packet type, sequence number, body) tuples """
+        self.__buffer.extend(data)
+        *complete, remainder = self.__buffer.split(PACKET_DELIMITER)
+        if len(remainder) > MAX_ENCODED_PACKET_SIZE:
+            # never going to see a delimiter for this, drop it
+            remainder = bytearray()
+            self.dropped_packets += 1
+        self.__buffer = remainder
+
+        packets = []
+        for encoded in complete:
+            if not encoded:
+                continue  # back to back delimiters (e.g. after a resync)
+            try:
+                packets.append(self.__decode(encoded))
+            except (ProtocolError, struct.error):
+                self.dropped_packets += 1
+        return packets
+
+    def __decode(self, encoded):
+        packet = cobs_decode(encoded)
+        checksum_start = len(packet) - PACKET_CHECKSUM_SIZE
+        checksum, = struct.unpack_from(PACKET_CHECKSUM_FORMAT, packet,
+                                       checksum_start)
+        if binascii.crc_hqx(packet[:checksum_start], 0xFFFF) != checksum:
+            raise ProtocolError("packet checksum mismatch")
+        packet_type, sequence, length = struct.unpack_from(
+            PACKET_HEADER_FORMAT, packet)
+        if PACKET_HEADER_SIZE + length != checksum_start:
+            raise ProtocolError("packet length mismatch")
+        return packet_type, sequence, packet[PACKET_HEADER_SIZE:
+                                             checksum_start]
+
+
+class FramedFrameDecoder:
+    """Reassembles frames from framed PACKET_FRAME_CHUNK packets.
+
+    A frame is complete once chunks covering every pixel have arrived in
+    order with the same sequence number. If a chunk goes missing, the
+    partial frame is abandoned and decoding resyncs on the next frame.
+    """
+
+    def __init__(self, num_pixels):
+        self.num_pixels = num_pixels
+        self.__packet_decoder = PacketDecoder()
+        self.__frame = bytearray(num_pixels * BYTES_PER_PIXEL)
+        self.__sequence = None
+        self.__next_offset = 0
+
+    @property
+    def dropped_packets(self):
+        return self.__packet_decoder.dropped_packets
+
+    def feed(self, data):
+        """ Add received bytes, returns a list of completed frames as
+        (sequence number, pixel bytes) tuples """
+        frames = []
+        for packet_type, sequence, body in self.__packet_decoder.feed(data):
+            if packet_type != PACKET_FRAME_CHUNK:
+                continue
+            offset, count = struct.unpack_from(CHUNK_HEADER_FORMAT, body)
+            pixels = body[CHUNK_HEADER_SIZE:]
+
+            if sequence != self.__sequence:
+                # start of a new frame (drops any incomplete one)
+                self.__sequence = sequence
+                self.__next_offset = 0
+            if (offset != self.__next_offset or
+                    offset + count > self.num_pixels or
+                    len(pixels) != count * BYTES_PER_PIXEL):
+                # missing chunk, wait for the next frame
+                self.__next_offset = None
+                continue
+
+            start = offset * BYTES_PER_PIXEL
+            self.__frame[start:start + len(pixels)] = pixels
+            self.__next_offset = offset + count
+
+            if self.__next_offset == self.num_pixels:
+                frames.append((sequence, bytes(self.__frame)))
+                self.__next_offset = None
+        return frames
@@ -0,0 +1,114 @@
+import logging
+import socket
+import time
+
+from light_engine import network_protocol
+
+logger = logging.getLogger("global")
+
+
+class VirtualNetworkReceiver:
+    """ A fake network pixel controller: listens for E1.31/Art-Net packets
+    from a NetworkPixelAdapter and decodes them back into frames. Stands in
+    for real controllers when testing, optionally drawing frames in a
+    VirtualNeopixelWindow.
+
+    Attributes:
+        colors: latest (r, g, b) color for every pixel.
+        packets_received: number of universe packets decoded.
+        packets_invalid: number of packets that failed to decode.
+        frames_received: number of completed frames (a frame is complete
+            when its last universe arrives).
+    """
+
+    def __init__(self, num_pixels, protocol=network_protocol.E131,
+                 host="127.0.0.1", port=None, first_universe=1,
+                 layout=None):
+        """
+        Args:
+            layout: PixelLayout to draw frames with. Without a layout,
+                frames are decoded but not drawn.
+        """
+        self.num_pixels = num_pixels
+        self.protocol = protocol
+        self.__address = (host, port or network_protocol.default_port(
+            protocol))
+        self.__first_universe = first_universe
+        self.__last_universe = first_universe + \
+            (num_pixels - 1) // network_protocol.PIXELS_PER_UNIVERSE
+        self.__layout = layout
+        self.__socket = None
+        self.virtualpixelwindow = None
+
+        self.colors = [(0, 0, 0)] * num_pixels
+        self.packets_received = 0
+        self.packets_invalid = 0
+        self.frames_received = 0
+
+    def start(self):
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__socket.bind(self.__address)
+        self.__socket.setblocking(False)
+        logger.info("virtual {} receiver listening on {}".format(
+            self.protocol, self.__address))
+
+        if self.__layout is not None:
+            import lightful_windows
+            self.virtualpixelwindow = lightful_windows.VirtualNeopixelWindow(
+                1200, 800)
+            self.virtualpixelwindow.start(self.__layout)
+
+    def stop(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+        if self.virtualpixelwindow is not None:
+            self.virtualpixelwindow.close()
+
+    def tick(self):
+        """ Decode all waiting packets, returns the number of frames
+        completed """
+        frames = 0
+        while True:
+            try:
+                data = self.__socket.recv(65536)
+            except BlockingIOError:
+                break
+
+            try:
+                universe, _, channels = network_protocol.decode_packet(data)
+            except network_protocol.NetworkProtocolError:
+                self.packets_invalid += 1
+                continue
+            self.packets_received += 1
+
+            if not (self.__first_universe <= universe <=
+                    self.__last_universe):
+                continue  # not for us
+            self.__update_colors(universe, channels)
+            if universe == self.__last_universe:
+                frames += 1
+                self.frames_received += 1
+                self.__draw()
+
+        time.sleep(0.001)
+        return frames
+
+    def __update_colors(self, universe, channels):
+        channels_per_pixel = network_protocol.CHANNELS_PER_PIXEL
+        first_pixel = (universe - self.__first_universe) * \
+            network_protocol.PIXELS_PER_UNIVERSE
+        count = min(len(channels) // channels_per_pixel,
+                    self.num_pixels - first_pixel)
+        self.colors[first_pixel:first_pixel + count] = [
+            tuple(channels[i:i + channels_per_pixel])
+            for i in range(0, count * channels_per_pixel, channels_per_pixel)
+        ]
+
+    def __draw(self):
+        if self.virtualpixelwindow is None:
+            return
+        import lightful_windows
+        self.virtualpixelwindow.update_with_colors(self.colors)
+        lightful_windows.tick()
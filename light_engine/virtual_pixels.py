@@ -2,14 +2,17 @@ import lightful_windows
 import logging
 import os
 import pty
+import struct
 import time
 
+from light_engine import serial_protocol
+
 logger = logging.getLogger("global")
 
 class VirtualArduinoClient:
     """ A fake arduino client that runs on a separate thread"""
 
-    def __init__(self, num_pixels):
+    def __init__(self, layout):
 
         # open a pseudoterminal, where master translates to our local serial
         # and slave is the virtual arduino
@@ -18,15 +21,20 @@ class VirtualArduinoClient:
         os.set_blocking(self.__master, False)
         self.__serial_reader = os.fdopen(self.__master, "rb")
         self.__serial_writer = os.fdopen(self.__master, "wb")
-        # todo: remove this and determine num_pixels from the protocol itself
-        # instead
-        self.__num_pixels = num_pixels
+        self.__layout = layout
+        # the adapter tells us the real pixel count in its handshake
+        self.__num_pixels = layout.num_pixels
+        # largest chunk we pretend our microcontroller can buffer
+        self.__max_chunk_pixels = 128
+        self.__frame_decoder = None
+        # time.perf_counter() when the latest frame arrived
+        self.last_frame_arrival_time = None
 
     def start(self):
         # open virtual window
         self.virtualpixelwindow = lightful_windows.VirtualNeopixelWindow(
             1200, 800)
-        self.virtualpixelwindow.start()
+        self.virtualpixelwindow.start(self.__layout)
 
         ## MICROCONTROLLER STARTUP PROTOCOL
 
@@ -34,15 +42,28 @@ class VirtualArduinoClient:
         # beginning setup protocol
         time.sleep(0.05)
         logger.info("sending message")
-        # communication protocol is currently kind of.. handwavy
-        self.__write_to_master("I'm ready! hit me with some setup calls!\n")
-        time.sleep(0.05)  # wait for setup calls
-        response_bytes = self.__serial_reader.readline()
-        num_pixels = ord(response_bytes)
+        self.__serial_writer.write(serial_protocol.setup_message(
+            serial_protocol.SUPPORTED_CAPABILITIES, self.__max_chunk_pixels))
+        self.__serial_writer.flush()
+        handshake = self.__read_exactly(serial_protocol.HANDSHAKE_SIZE)
+        version, num_pixels, capabilities = \
+            serial_protocol.decode_handshake(handshake)
+        logger.info("virtual arduino handshake: v{}, {} pixels, "
+                    "capabilities {}".format(version, num_pixels,
+                                             capabilities))
         if num_pixels != self.__num_pixels:
             logger.error(
-                "mismatch between initialization num_pixels and actual"
+                "mismatch between layout num_pixels and actual "
                 "num_pixels sent over serial setup")
+        self.__num_pixels = num_pixels
+        self.__is_framed = bool(
+            capabilities & serial_protocol.CAPABILITY_FRAMED)
+        if self.__is_framed:
+            self.__frame_decoder = serial_protocol.FramedFrameDecoder(
+                num_pixels)
+        else:
+            self.__frame_decoder = serial_protocol.ChunkedFrameDecoder(
+                num_pixels)
 
         self.__write_to_master("\n")  # got your message!
 
@@ -54,6 +75,17 @@ class VirtualArduinoClient:
     def port_id(self):
         return os.ttyname(self.__slave)
 
+    def __read_exactly(self, num_bytes):
+        """ Block until num_bytes have been read from serial """
+        data = bytearray()
+        while len(data) < num_bytes:
+            chunk = self.__serial_reader.read(num_bytes - len(data))
+            if chunk:
+                data.extend(chunk)
+            else:
+                time.sleep(0.001)
+        return bytes(data)
+
     def __write_to_master(self, string):
         if string[-1] != '\n':
             logger.error(
@@ -65,8 +97,19 @@ class VirtualArduinoClient:
     def tick(self):
         """Virtual Arduino 'tick' polling for and updating for serial input."""
 
-        line = self.__serial_reader.read(self.__num_pixels * 4)
-        if line:
+        data = self.__serial_reader.read(65536)
+        if data:
+            arrival_time = time.perf_counter()
+            frames = self.__frame_decoder.feed(data)
+        else:
+            frames = []
+
+        if not self.__is_framed:
+            # unframed frames have no sequence number
+            frames = [(None, frame) for frame in frames]
+
+        for sequence, frame in frames:
+            self.last_frame_arrival_time = arrival_time
             """we should simulate the delay of the Arduino actually setting
             the neopixels. According to docs: 'One pixel requires 24 bits
             (8 bits each for red, green blue) — 30 microseconds.'
@@ -74,10 +117,10 @@ class VirtualArduinoClient:
             time.sleep(0.000030 * self.__num_pixels)
 
             color_array = []
-            for i in range(int(len(line) / 4)):
+            for i in range(int(len(frame) / 4)):
                 i = i * 4
                 # little-endian so reverse
-                color_array.append((line[i + 2], line[i + 1], line[i]))
+                color_array.append((frame[i + 2], frame[i + 1], frame[i]))
 
             self.virtualpixelwindow.update_with_colors(color_array)
 
@@ -85,6 +128,14 @@ class VirtualArduinoClient:
             # directly. figure out why!
             lightful_windows.tick()
 
-            self.__write_to_master("\n")  # got your message!
+            # got your message! (reporting when it arrived)
+            if self.__is_framed:
+                self.__serial_writer.write(serial_protocol.encode_packet(
+                    serial_protocol.PACKET_ACK, sequence,
+                    struct.pack(serial_protocol.ACK_BODY_FORMAT,
+                                arrival_time)))
+                self.__serial_writer.flush()
+            else:
+                self.__write_to_master("\n")
 
         time.sleep(0.001)
@@ -7,22 +7,42 @@ from multiprocessing import Process
 from multiprocessing import Queue
 
 from curses_log_handler import CursesLogHandler
+from curses_log_handler import CursesLogWriter
 from keyboard_monitor import KeyboardMonitor
+from light_engine.network_pixel_adapter import NetworkPixelAdapter
 from light_engine.pixel_adapter import ArduinoPixelAdapter
+from light_engine.pixel_adapter import MultiPixelAdapter
+from light_engine.pixel_layout import DEFAULT_LAYOUT_FILE
+from light_engine.pixel_layout import PixelLayout
 from lightful_shortcuts import LightfulKeyboardShortcuts
+from metrics import MetricsServer
+from metrics import metrics
+from midi.metronome_audio import BACKEND_NAMES
+from midi.metronome_audio import create_audio_backend
+from midi.metronome_audio import metronome_audio
 from midi.monitor import MidiMonitor
-from profiler import Profiler
+from midi.recording_writer import recover_recordings
+from profiler import span_profiler
 from scheduler.scheduler import Scheduler
+from task_watchdog import TaskWatchdog
 from shows.hanging_door_lights_show import HangingDoorLightsShow
 from shows.something_just_like_this_show import SomethingJustLikeThisShow
+from status_pane import STATUS_PANE_HEIGHT
+from status_pane import StatusPane
 
 logger = logging.getLogger("global")
 prefixless_logger = logging.getLogger("prefixless")
 
-# set up curses for async keyboard input
-stdscr = curses.initscr()
-curses.noecho()
-stdscr.nodelay(1)  # set getch() non-blocking
+frames_rendered_metric = metrics.counter(
+    "lightful_frames_rendered_total", "Frames rendered and pushed")
+frames_skipped_metric = metrics.counter(
+    "lightful_frames_skipped_total",
+    "Main loop passes that skipped rendering because the pixel output was "
+    "still busy with the previous frame")
+frame_seconds_metric = metrics.histogram(
+    "lightful_frame_seconds", "Time to render and push a frame",
+    buckets=(0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.033, 0.066, 0.1,
+             0.25))
 
 pixel_adapter = None
 lights_show = None
@@ -31,14 +51,25 @@ midi_monitor = None
 
 
 def main_loop(window):
-    # set up curses window (similar to a regular terminal window except it
-    # allows for non-blocking keyboard input)
-    curses_window = window
+    # set up curses windows (similar to a regular terminal window except it
+    # allows for non-blocking keyboard input): a status pane on top and a
+    # scrolling log below it
+    height, width = window.getmaxyx()
+    status_window = curses.newwin(STATUS_PANE_HEIGHT, width, 0, 0)
+    curses_window = curses.newwin(height - STATUS_PANE_HEIGHT, width,
+                                  STATUS_PANE_HEIGHT, 0)
     curses_window.scrollok(1)
+    curses_window.nodelay(1)  # set getch() non-blocking for async keyboard
+    # input
 
-    # set up logging
+    # set up logging. log lines are written to the window by a dedicated
+    # writer thread so logging never blocks the main loop on curses
+    log_writer = CursesLogWriter(curses_window)
+    log_writer.start()
     logger.setLevel(logging.DEBUG)
-    handler = CursesLogHandler(curses_window)
+    status_pane = StatusPane(status_window, metrics, log_writer.screen_lock)
+    status_pane.start()
+    handler = CursesLogHandler(log_writer)
     # todo, add function name here?
     formatter = logging.Formatter(
         '%(asctime)s,%(msecs)03d-%(levelname)s-%(message)s',
@@ -47,66 +78,145 @@ def main_loop(window):
     handler.setFormatter(formatter)
     logger.handlers = [handler]
 
-    prefixless_handler = CursesLogHandler(curses_window)
+    prefixless_handler = CursesLogHandler(log_writer)
     prefixless_logger.setLevel(logging.INFO)
     prefixless_logger.handlers = [prefixless_handler]
 
     prefixless_logger.info("~^~^~Welcome to the Lightful Controller~^~^~\n")
     prefixless_logger.info("Setting up program...\n")
 
+    # recordings interrupted by a crash are saved from their journals
+    recover_recordings()
+
     # parse command line options
     parser = argparse.ArgumentParser(
         description="Lightful Piano Controller Script")
     parser.add_argument("--virtualpixels", action='store_true')
+    parser.add_argument("--layout", default=DEFAULT_LAYOUT_FILE,
+                        help="JSON file describing the physical pixel layout")
+    parser.add_argument("--serialport", action='append',
+                        help="serial port of an Arduino, optionally followed "
+                        "by the pixel positions it drives, e.g. "
+                        "/dev/tty.usbmodem1411:0-300. Repeat to drive "
+                        "several controllers in parallel")
+    parser.add_argument("--baudrate", type=int, default=115200,
+                        help="serial baud rate. Firmware speaking the framed "
+                        "protocol can safely run at 1000000-2000000")
+    parser.add_argument("--output", choices=["serial", "e131", "artnet"],
+                        default="serial",
+                        help="send pixels to Arduinos over serial, or to "
+                        "network pixel controllers over E1.31/Art-Net")
+    parser.add_argument("--profile", action='store_true',
+                        help="record main loop spans and periodically log "
+                        "their percentiles")
+    parser.add_argument("--max-task-age", type=float, default=300,
+                        help="seconds after which a task (other than "
+                        "long-running ones like background layers) is "
+                        "reported as possibly stuck")
+    parser.add_argument("--reap-stuck-tasks", action='store_true',
+                        help="end and remove tasks older than "
+                        "--max-task-age instead of just reporting them")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics over HTTP on this "
+                        "port")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="address to serve metrics on (0.0.0.0 for all "
+                        "interfaces)")
+    parser.add_argument("--host",
+                        help="address of the network pixel controller (E1.31 "
+                        "without a host multicasts each universe)")
+    parser.add_argument("--audio", choices=BACKEND_NAMES, default="auto",
+                        help="where metronome clicks go: macOS audio "
+                        "(appkit), nowhere (null), or a WAV file (file). "
+                        "auto is appkit where available")
+    parser.add_argument("--audio-file", default="metronome_clicks.wav",
+                        help="WAV file for --audio file, written on quit")
     args = parser.parse_args()
 
+    # physical layout of the pixels, shared by the show and the virtual
+    # pixel window
+    layout = PixelLayout.load(args.layout)
+
+    metronome_audio.use(create_audio_backend(args.audio, args.audio_file))
+
     # set up Midi listener
     global midi_monitor
     midi_monitor = MidiMonitor()
     midi_monitor.start()
 
     # set up scheduler for midi events
-    midi_scheduler = Scheduler()
+    midi_scheduler = Scheduler(name="midi scheduler")
     midi_scheduler.start()
 
     # set up scheduler for animations, effects, etc.
-    animation_scheduler = Scheduler()
+    animation_scheduler = Scheduler(name="animation scheduler")
     animation_scheduler.start()
 
     # set up and connect to NeoPixel adapter (or local virtual simulator)
     global pixel_adapter
-    num_pixels = 100
-    serial_port_id = '/dev/tty.usbmodem1411'  # TODO: make configurable
+    num_pixels = layout.num_pixels
+    serial_port_specs = args.serialport or ['/dev/tty.usbmodem1411']
+    host = args.host
     if args.virtualpixels:
         multiprocessing.set_start_method('spawn')
         logger.info("using simulated arduino/neopixels handled on separate process")
         render_queue = Queue()
-        render_process = Process(target=render_process_loop, args=(render_queue, num_pixels))
+        render_process = Process(target=render_process_loop,
+                                 args=(render_queue, args.layout, args.output))
         render_process.daemon = True
         render_process.start()
-        # render loop expected to give us the port on which its listening for
-        # arduino serial messages
+        # render loop expected to give us the port (or address) on which its
+        # listening for arduino serial (or network) messages
         logger.info("GETTING")
-        serial_port_id = render_queue.get()
-        logger.info("YAH GOT VIRTUAL PORT!!: " + serial_port_id)
-
-    pixel_adapter = ArduinoPixelAdapter(
-        serial_port_id=serial_port_id, baud_rate=115200, num_pixels=num_pixels)
+        virtual_port_id = render_queue.get()
+        logger.info("YAH GOT VIRTUAL PORT!!: " + virtual_port_id)
+        serial_port_specs = [virtual_port_id]
+        host = virtual_port_id
+
+    if args.output == "serial":
+        pixel_adapter = create_pixel_adapter(serial_port_specs, num_pixels,
+                                             baud_rate=args.baudrate)
+    else:
+        pixel_adapter = NetworkPixelAdapter(host, num_pixels,
+                                            protocol=args.output)
     pixel_adapter.start()
 
     # create show
     global lights_show
     # lights_show = hanging_door_lights_show.HangingDoorLightsShow(
-    #     animation_scheduler, pixel_adapter, midi_monitor)
+    #     animation_scheduler, pixel_adapter, midi_monitor, layout)
     lights_show = SomethingJustLikeThisShow(
-        animation_scheduler, pixel_adapter, midi_monitor
+        animation_scheduler, pixel_adapter, midi_monitor, layout
     )
 
+    # publish metrics. values that already live elsewhere are only read
+    # when scraped
+    for scheduler in [midi_scheduler, animation_scheduler]:
+        metrics.gauge_function(
+            "lightful_scheduler_tasks", "Tasks in a scheduler",
+            lambda scheduler=scheduler: len(scheduler.task_wrappers),
+            scheduler=scheduler.name)
+    metrics.gauge_function("lightful_log_queue_depth",
+                           "Log lines waiting to be written to the screen",
+                           log_writer.queue_depth)
+    metrics.counter_function("lightful_log_lines_dropped_total",
+                             "Log lines dropped because the screen couldn't "
+                             "keep up", lambda: log_writer.dropped_count)
+    if args.metrics_port is not None:
+        MetricsServer(metrics, args.metrics_port,
+                      host=args.metrics_host).start()
+
+    # keep an eye out for tasks piling up over long sessions
+    task_watchdog = TaskWatchdog([midi_scheduler, animation_scheduler],
+                                 max_task_age=args.max_task_age,
+                                 reap=args.reap_stuck_tasks)
+
     # create keyboard monitor
     keyboard_monitor = KeyboardMonitor()
     keyboard_shortcuts = LightfulKeyboardShortcuts(
         keyboard_monitor, pixel_adapter,
-        lights_show, midi_monitor, animation_scheduler, midi_scheduler
+        lights_show, midi_monitor, animation_scheduler, midi_scheduler,
+        task_watchdog=task_watchdog
     )
     keyboard_shortcuts.register_shortcuts()
 
@@ -114,64 +224,114 @@ def main_loop(window):
     prefixless_logger.info("\nKeyboard Shortcuts:")
     prefixless_logger.info(keyboard_shortcuts.shortcuts_description())
 
-    profiler = Profiler()
-    # set to True to enable time profile logs of main run loop
-    profiler.enabled = False
+    # set --profile to enable time profile logs of main run loop (can also
+    # be toggled with a keyboard shortcut)
+    span_profiler.enabled = args.profile
 
     while True:
         """The main loop gives every system in this app a chance to
         perform any necessary actions"""
-        profiler.avg("loop start")
+        with span_profiler.span("loop"):
+            tick_main_loop(midi_scheduler, midi_monitor, animation_scheduler,
+                           pixel_adapter)
+
+            with span_profiler.span("character read"):
+                # never wait on the log writer or status pane: if they're
+                # drawing, read the key on a later pass
+                if log_writer.screen_lock.acquire(blocking=False):
+                    try:
+                        character = curses_window.getch()
+                    finally:
+                        log_writer.screen_lock.release()
+                    keyboard_monitor.notify_key_press(character)
+
+        span_profiler.maybe_log_report()
+        task_watchdog.maybe_check()
+
+        # sleep at least a short time to allow any other threads to do
+        # their stuff (though we currently don't have any)
+        time.sleep(0.001)
 
-        midi_scheduler.tick()
 
-        profiler.avg("midi scheduler tick")
+def tick_main_loop(midi_scheduler, midi_monitor, animation_scheduler,
+                   pixel_adapter):
+    """One pass of the main loop over MIDI and lights (everything but
+    keyboard input). Returns whether a frame was rendered and pushed"""
+    with span_profiler.span("midi scheduler tick"):
+        midi_scheduler.tick()
 
-        # listen for any new midi input
+    # listen for any new midi input
+    with span_profiler.span("midi listen"):
         midi_monitor.listen_loop()
-        profiler.avg("midi listen")
 
-        # Pixel push protocol involves data transfer over serial. Instead
-        # of blocking the main loop on serial I/O, we just skip animation
-        # rendering and serial push if previous serial push hasn't completed
-        if pixel_adapter.ready_for_push():
-            # tick animation scheduler to update pixels
+    # Pixel push protocol involves data transfer over serial. Instead of
+    # blocking the main loop on serial I/O, we just skip animation rendering
+    # and serial push if previous serial push hasn't completed
+    if not pixel_adapter.ready_for_push():
+        frames_skipped_metric.inc()
+        return False
+
+    frame_start = time.perf_counter()
+    with span_profiler.span("frame"):
+        # tick animation scheduler to update pixels
+        with span_profiler.span("animation scheduler"):
             animation_scheduler.tick()
-            profiler.avg("animation scheduler")
 
-            # push latest pixel state
+        # push latest pixel state
+        with span_profiler.span("pixel push"):
             pixel_adapter.push_pixels()
-            profiler.avg("pixel push")
-
-        character = stdscr.getch()
-        keyboard_monitor.notify_key_press(character)
-
-        profiler.avg("character read")
-
-        # sleep at least a short time to allow any other threads to do
-        # their stuff (though we currently don't have any)
-        time.sleep(0.001)
-
-
-def render_process_loop(queue, num_pixels):
+    frames_rendered_metric.inc()
+    frame_seconds_metric.observe(time.perf_counter() - frame_start)
+    return True
+
+
+def create_pixel_adapter(serial_port_specs, num_pixels, baud_rate=115200):
+    """Create the adapter for one or more Arduinos. Each spec is a serial
+    port id optionally followed by ':start-end' pixel positions; a single
+    port without positions drives all pixels"""
+    if len(serial_port_specs) == 1 and ':' not in serial_port_specs[0]:
+        return ArduinoPixelAdapter(serial_port_id=serial_port_specs[0],
+                                   baud_rate=baud_rate, num_pixels=num_pixels)
+
+    adapters_by_range = []
+    for spec in serial_port_specs:
+        serial_port_id, _, position_range = spec.rpartition(':')
+        start, end = position_range.split('-')
+        positions = range(int(start), int(end))
+        logger.info("pixels " + str(positions) + " on " + serial_port_id)
+        adapter = ArduinoPixelAdapter(serial_port_id=serial_port_id,
+                                      baud_rate=baud_rate,
+                                      num_pixels=len(positions))
+        adapters_by_range.append((positions, adapter))
+    return MultiPixelAdapter(adapters_by_range)
+
+
+def render_process_loop(queue, layout_file_name, output="serial"):
     """The render process loop gives all rendering logic time to perform
     any necessary actions and draws (and communication with the main
     process)"""
-    from light_engine.virtual_pixels import VirtualArduinoClient
-    import lightful_windows
-    virtual_client = VirtualArduinoClient(num_pixels=num_pixels)
-
-    # send the virtual serial port id we opened back to the main thread
-    # so it can connect
-    virtual_port_id = virtual_client.port_id()
-    queue.put(virtual_port_id)
+    layout = PixelLayout.load(layout_file_name)
+
+    if output == "serial":
+        from light_engine.virtual_pixels import VirtualArduinoClient
+        virtual_client = VirtualArduinoClient(layout=layout)
+
+        # send the virtual serial port id we opened back to the main thread
+        # so it can connect
+        queue.put(virtual_client.port_id())
+    else:
+        from light_engine.virtual_network_receiver import \
+            VirtualNetworkReceiver
+        virtual_client = VirtualNetworkReceiver(
+            layout.num_pixels, protocol=output, layout=layout)
+        queue.put("127.0.0.1")
 
     virtual_client.start()
 
     # render process loop
     while True:
-        # tick the virtual Arduino client to respond to any serial input
-        # from the main process
+        # tick the virtual client to respond to any serial (or network)
+        # input from the main process
         virtual_client.tick()
 
 if __name__ == '__main__':
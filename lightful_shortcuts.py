@@ -1,18 +1,31 @@
 import logging
 import time
+from concurrent.futures import ProcessPoolExecutor
 from threading import Timer
 
-import rtmidi
-
-from midi.editor import MidiEditor
-from midi.editor import RangeVelocityFilter
+from midi_batch import DEFAULT_CHAINS
+from midi_batch import process_file
 from midi.looper import MidiLooper
+from midi.message import MidiMessage
 from midi.metronome import MetronomeTask
+from midi.metronome_audio import metronome_audio
 from midi.player import PlayMidiTask
 from midi.recorder import MidiRecorder
+from midi.recording_writer import recording_writer
+from midi.transport import TempoMap
+from midi.transport import Transport
+from latency import note_latency
+from profile_capture import profile_capture
+from profiler import span_profiler
+from task_watchdog import MemorySnapshots
 
 logger = logging.getLogger("global")
 
+# tempo settings of loop mode, which the session's transport starts at
+LOOP_TEMPO = 550000
+LOOP_TICKS_PER_BEAT = 50
+LOOP_BEATS_PER_MEASURE = 8
+
 
 class LightfulKeyboardShortcuts:
     """ App-specific keyboard shortcuts """
@@ -20,17 +33,27 @@ class LightfulKeyboardShortcuts:
     # to not just be keyboard toggled
     def __init__(self, keyboard_monitor, pixel_adapter,
                  lights_show, midi_monitor, animation_scheduler,
-                 midi_scheduler):
+                 midi_scheduler, task_watchdog=None):
         self.keyboard_monitor = keyboard_monitor
         self.pixel_adapter = pixel_adapter
         self.lights_show = lights_show
         self.midi_monitor = midi_monitor
         self.animation_scheduler = animation_scheduler
         self.midi_scheduler = midi_scheduler
+        self.task_watchdog = task_watchdog
+        self.memory_snapshots = MemorySnapshots()
 
         self.midi_recorder = None
         self.looper_midi_recorders = None
         self.midi_looper = None
+        self.__edit_executor = None  # started on first use
+
+        # one clock for the session, shared by the looper, the metronome
+        # and playback
+        self.transport = Transport(
+            TempoMap(LOOP_TEMPO, LOOP_TICKS_PER_BEAT),
+            beats_per_measure=LOOP_BEATS_PER_MEASURE)
+        self.transport.start()
 
     def register_shortcuts(self):
         k = self.keyboard_monitor
@@ -63,6 +86,8 @@ class LightfulKeyboardShortcuts:
                             self.toggle_channel_6)
         l.register_callback('7', "(7) record/play/pause channel 7",
                             self.toggle_channel_7)
+        l.register_callback('o', "(o)verdub the last recorded channel, or "
+                            "stop overdubbing", self.toggle_overdub)
         l.register_callback('r', "(r)ecord MIDI input to a save file, or "
                                "if a file is recording, then save recording",
                                self.toggle_looper_record_midi_file)
@@ -71,17 +96,39 @@ class LightfulKeyboardShortcuts:
         k.register_callback('b', "(b)eep (local speakers)",
                                self.add_metronome)
         k.register_callback('e', "(e)dit MIDI file", self.edit_midi_file)
+        k.register_callback('s', "(s)pan profiler on/off (saves a Chrome "
+                               "trace when turned off)",
+                               self.toggle_span_profiler)
+        k.register_callback('t', "(t)ask costs: start timing scheduled "
+                               "tasks, or report the most expensive ones",
+                               self.report_task_costs)
+        k.register_callback('n', "(n)ote-to-photon latency report",
+                               note_latency.log_report)
+        k.register_callback('f', "(f)lamegraph capture on/off: samples the "
+                               "main loop's stack, saved as collapsed stacks",
+                               self.toggle_profile_capture)
+        k.register_callback('F', "(F)lamegraph capture plus cProfile on/off "
+                               "(also saves pstats, slower while on)",
+                               self.toggle_cprofile_capture)
+        if self.task_watchdog is not None:
+            k.register_callback('w', "(w)atchdog report: task counts by "
+                                   "type and how they've grown",
+                                   self.task_watchdog.log_report)
+        k.register_callback('m', "(m)emory snapshot: starts tracemalloc, "
+                               "then logs what grew since the last snapshot",
+                               self.memory_snapshots.snapshot)
         k.register_callback('q', "(q)uit", self.exit_app)
  
     def begin_loop_mode(self):
         if self.midi_looper is not None:
             return
         self.midi_looper = MidiLooper(
-            tempo=550000,
-            ticks_per_beat=50,
-            beats_per_measure=8,
+            tempo=LOOP_TEMPO,
+            ticks_per_beat=LOOP_TICKS_PER_BEAT,
+            beats_per_measure=LOOP_BEATS_PER_MEASURE,
             midi_monitor=self.midi_monitor,
-            midi_scheduler=self.midi_scheduler
+            midi_scheduler=self.midi_scheduler,
+            transport=self.transport
         )
         self.midi_looper.start()
 
@@ -133,6 +180,19 @@ class LightfulKeyboardShortcuts:
             logger.info("channel {} playing".format(channel))
             looper.play(channel)
 
+    def toggle_overdub(self):
+        looper = self.midi_looper
+        channel = looper.current_channel
+        if not looper.has_been_recorded(channel):
+            logger.info("nothing recorded to overdub yet")
+        elif looper.is_recording(channel):
+            logger.info("channel {} playing".format(channel))
+            looper.save_record(channel)
+        else:
+            logger.info("channel {} overdubbing".format(channel))
+            looper.overdub(channel)
+            looper.play(channel)
+
     def shortcuts_description(self):
         descriptions = self.keyboard_monitor.descriptions_by_key.values()
         return '\n'.join(descriptions)
@@ -141,6 +201,8 @@ class LightfulKeyboardShortcuts:
         self.lights_show.clear_lights()
         self.pixel_adapter.stop()
         self.midi_monitor.stop()
+        recording_writer.stop()  # finish saving stopped recordings
+        metronome_audio.close()
         exit()
 
     # TODO: recording/playing seem like they deserve being in a dedicated
@@ -180,30 +242,58 @@ class LightfulKeyboardShortcuts:
         """ play recorded midi file """
         self.play_midi_task = PlayMidiTask.withfile("recording1.mid",
                                                     midi_monitor=self.midi_monitor,
-                                                    ticks_per_beat=50)
+                                                    ticks_per_beat=LOOP_TICKS_PER_BEAT,
+                                                    transport=self.transport)
         # reset lights show so that we always start any lights show
         # state, e.g. animations, at t=0 when recording starts
         self.lights_show.reset_lights()
         self.midi_scheduler.add(self.play_midi_task)
 
     def send_special_keyboard_event(self):
-        self.midi_monitor.send_midi_message(rtmidi.MidiMessage().noteOff(0, 0))
+        self.midi_monitor.send_midi_message(MidiMessage.note_off(0, 0))
 
     def add_metronome(self):
         self.metronome_task = MetronomeTask(500000, 50, 8)
         self.midi_scheduler.add(self.metronome_task)
 
     def edit_midi_file(self):
-        editor = MidiEditor("recording1.mid", "recording1_baseline.mid")
-        velocity_filter = RangeVelocityFilter(range(0, 70), 0)
-        editor.apply_filter(velocity_filter)
-        editor.save()
-
-        editor = MidiEditor("recording1.mid", "recording1_melody.mid")
-        velocity_filter = RangeVelocityFilter(range(70, 255), 0)
-        editor.apply_filter(velocity_filter)
-        editor.save()
-        logger.info("write successful!")
+        """ split the recording into baseline/melody files (see
+        midi_batch.py) in a worker process, so the show keeps running """
+        if self.__edit_executor is None:
+            self.__edit_executor = ProcessPoolExecutor(max_workers=1)
+        future = self.__edit_executor.submit(process_file, "recording1.mid",
+                                             DEFAULT_CHAINS)
+        future.add_done_callback(_log_edit_result)
+        logger.info("editing recording1.mid in the background")
+
+    def toggle_span_profiler(self):
+        """ start recording spans, or stop and save them as a Chrome trace
+        """
+        if not span_profiler.enabled:
+            span_profiler.clear()
+            span_profiler.enabled = True
+            logger.info("span profiler on")
+        else:
+            span_profiler.enabled = False
+            span_profiler.log_report()
+            span_profiler.export_chrome_trace(time.strftime(
+                "lightful_trace_%Y%m%d_%H%M%S.json"))
+
+    def toggle_profile_capture(self):
+        profile_capture.toggle()
+
+    def toggle_cprofile_capture(self):
+        profile_capture.toggle(use_cprofile=True)
+
+    def report_task_costs(self):
+        """ turn on per task timing, or log the top tasks if it's on """
+        for scheduler in [self.midi_scheduler, self.animation_scheduler]:
+            if scheduler.cost_accountant is None:
+                scheduler.enable_cost_accounting()
+                logger.info(scheduler.name + ": timing tasks, press again "
+                            "for a report")
+            else:
+                scheduler.log_cost_report()
 
     def send_note_on_off_event1(self):
         self.send_note_on_off_event(pitch=58, channel=1)
@@ -222,9 +312,19 @@ class LightfulKeyboardShortcuts:
         Timer(0.4, self.send_note_off_event, [pitch, channel]).start()
 
     def send_note_on_event(self, pitch, channel):
-        note_on = rtmidi.MidiMessage().noteOn(channel, pitch, 100)
+        note_on = MidiMessage.note_on(channel, pitch, 100)
         self.midi_monitor.send_midi_message(note_on)
 
     def send_note_off_event(self, pitch, channel):
-        note_off = rtmidi.MidiMessage().noteOff(channel, pitch)
-        self.midi_monitor.send_midi_message(note_off)
\ No newline at end of file
+        note_off = MidiMessage.note_off(channel, pitch)
+        self.midi_monitor.send_midi_message(note_off)
+
+
+def _log_edit_result(future):
+    try:
+        result = future.result()
+    except Exception as error:  # noqa
+        logger.error("editing MIDI file failed: " + str(error))
+        return
+    logger.info("wrote {} in {:.2f}s".format(", ".join(result["outputs"]),
+                                             result["seconds"]))
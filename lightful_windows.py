@@ -34,38 +34,32 @@ def exit():
 class VirtualNeopixelWindow(window.Window):
     """ TODO: Fill me in """
 
-    def start(self):
+    def start(self, layout):
+        """ Set up a sprite for every mapped pixel in the layout (see
+        PixelLayout) """
         self.batch = graphics.Batch()
         self.particles = list()
         self.particle_image = image.load('media/images/particle.png')
         self.particle_sprites = []
         self.time_to_draw_next_frame = time.time()
 
-        # set up pixels! (just 10x10 grid for now)
-        rows = 20
-        cols = 4
-        # remember that rows counterintuitively corresponds to height, cols to
-        # width
-        # add 2 for buffer space for rows and cols
-        row_increment = 1.0 * self.height / (rows + 0.25)
-        col_increment = 1.0 * self.width / (cols + 0.25)
-        for x in range(0, cols):
-            for y in range(0, rows):
-
-                # for odd columns, the light strip is reversed downward, so
-                # flip y position
-                if x % 2 == 1:
-                    y = rows - y - 1
-
-                # add one so don't start at edge of screen
-                xpos = col_increment * (x + 0.25)
-                # add one so don't start at edge of screen
-                ypos = row_increment * (y + 0.25)
-
-                s = sprite.Sprite(
-                    self.particle_image, x=xpos, y=ypos, batch=self.batch)
-                s.scale = 1.5
-                self.particle_sprites.append(s)
+        # place pixels using their layout x/y coordinates. layout units are
+        # treated as the spacing between neighbouring pixels, with a quarter
+        # unit of buffer space so we don't start at the edge of the screen
+        self.sprite_positions = layout.mapped_positions.tolist()
+        xy = layout.coordinates[layout.mapped_positions][:, :2]
+        mins = xy.min(axis=0)
+        spans = xy.max(axis=0) - mins
+        col_increment = 1.0 * self.width / (spans[0] + 1.25)
+        row_increment = 1.0 * self.height / (spans[1] + 1.25)
+        for x, y in (xy - mins).tolist():
+            xpos = col_increment * (x + 0.25)
+            ypos = row_increment * (y + 0.25)
+
+            s = sprite.Sprite(
+                self.particle_image, x=xpos, y=ypos, batch=self.batch)
+            s.scale = 1.5
+            self.particle_sprites.append(s)
 
     def on_draw(self):
         now = time.time()
@@ -78,15 +72,15 @@ class VirtualNeopixelWindow(window.Window):
 
     # todo: this is happening on separate thread so might cause problems
     def update_with_colors(self, color_array):
-        # remove invalid colors since I accidentally added useless pixels in
-        # hanging_door show get rid of first 10 and 50-60 (dead pixels)
-        new_color_array = color_array[10:50]
-        new_color_array.extend(color_array[60:])
-        num_sprites = len(self.particle_sprites)
+        # only pixels that are part of the layout get drawn (e.g. dead pixels
+        # at the start of a strip are skipped)
+        num_colors = len(color_array)
 
-        for index, color in enumerate(new_color_array):
-            if index >= num_sprites:
-                return
+        for particle_sprite, position in zip(self.particle_sprites,
+                                     self.sprite_positions):
+            if position >= num_colors:
+                continue
+            color = color_array[position]
 
             # blend in a bit of white to better match the base white
             # of the ping pong balls we're trying to simulate
@@ -97,4 +91,4 @@ class VirtualNeopixelWindow(window.Window):
                 (color[2] + base_white) / 2,
             )
 
-            self.particle_sprites[index].color = color
+            particle_sprite.color = color
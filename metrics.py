@@ -0,0 +1,307 @@
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger("global")
+
+"""Counters, gauges and histograms for the controller, published in the
+Prometheus text format by MetricsServer.
+
+Updating a metric is a plain attribute update with no locking, so it's
+cheap enough for the main loop (the GIL keeps values consistent enough for
+monitoring, if a rare increment from another thread gets lost that's fine).
+Values that already live somewhere (e.g. a scheduler's task count) are
+registered as functions instead and only read when scraped.
+
+Usage:
+    frames = metrics.counter("lightful_frames_total", "Frames rendered")
+    frames.inc()
+    metrics.gauge_function("lightful_scheduler_tasks", "Active tasks",
+                           lambda: len(scheduler.task_wrappers),
+                           scheduler=scheduler.name)
+"""
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# in seconds
+DEFAULT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 1.0)
+
+
+class _Value:
+    """ A counter or gauge """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class _FunctionValue:
+    """ A counter or gauge read from a function when scraped """
+
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+    def get(self):
+        return self.function()
+
+
+class _Histogram:
+    """Counts observations into buckets (upper bounds, plus an implicit
+    +Inf bucket).
+
+    Attributes:
+        bucket_counts: observations per bucket (not cumulative).
+        sum: total of all observations.
+        count: number of observations.
+    """
+
+    __slots__ = ('buckets', 'bucket_counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        return self.count
+
+    def quantile(self, fraction):
+        """ Estimate a quantile (e.g. 0.95) by interpolating within its
+        bucket, None if nothing was observed """
+        return histogram_quantile(self.buckets, self.bucket_counts, fraction)
+
+
+def histogram_quantile(buckets, bucket_counts, fraction):
+    """ Estimate a quantile from (non cumulative) bucket counts, like
+    Prometheus' histogram_quantile """
+    count = sum(bucket_counts)
+    if count == 0:
+        return None
+    rank = fraction * count
+    cumulative = 0
+    for index, bucket_count in enumerate(bucket_counts):
+        if cumulative + bucket_count >= rank and bucket_count > 0:
+            if index == len(buckets):
+                return buckets[-1]  # +Inf bucket, report the highest bound
+            lower = buckets[index - 1] if index > 0 else 0.0
+            upper = buckets[index]
+            return lower + (upper - lower) * \
+                (rank - cumulative) / bucket_count
+        cumulative += bucket_count
+    return buckets[-1]
+
+
+class _Family:
+    """ All metrics sharing a name (one per set of label values) """
+
+    def __init__(self, name, metric_type, help_text):
+        self.name = name
+        self.metric_type = metric_type
+        self.help_text = help_text
+        # label items tuple -> metric
+        self.metrics = OrderedDict()
+
+
+class MetricsRegistry:
+    """ Creates and keeps track of metrics (see above) """
+
+    def __init__(self):
+        self.__families = OrderedDict()
+        # only guards creating metrics, never updating them
+        self.__lock = threading.Lock()
+
+    def counter(self, name, help_text, **labels):
+        """ A counter (only goes up). Returns the existing one if a counter
+        with the same name and labels was already created """
+        return self.__metric(name, COUNTER, help_text, labels, _Value)
+
+    def gauge(self, name, help_text, **labels):
+        return self.__metric(name, GAUGE, help_text, labels, _Value)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, **labels):
+        return self.__metric(name, HISTOGRAM, help_text, labels,
+                             lambda: _Histogram(buckets))
+
+    def counter_function(self, name, help_text, function, **labels):
+        """ A counter read from function() when scraped (replaces any
+        previous function for the same name and labels) """
+        return self.__metric(name, COUNTER, help_text, labels,
+                             lambda: _FunctionValue(function), replace=True)
+
+    def gauge_function(self, name, help_text, function, **labels):
+        """ A gauge read from function() when scraped (replaces any
+        previous function for the same name and labels) """
+        return self.__metric(name, GAUGE, help_text, labels,
+                             lambda: _FunctionValue(function), replace=True)
+
+    def snapshot(self):
+        """ Current values: {name: {label items tuple: value}}. Histograms
+        are given as the _Histogram itself """
+        snapshot = {}
+        for family in list(self.__families.values()):
+            values = {}
+            for label_items, metric in list(family.metrics.items()):
+                if family.metric_type == HISTOGRAM:
+                    values[label_items] = metric
+                else:
+                    values[label_items] = _safe_get(metric)
+            snapshot[family.name] = values
+        return snapshot
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+        lines = []
+        for family in list(self.__families.values()):
+            lines.append("# HELP {} {}".format(
+                family.name, family.help_text.replace("\n", " ")))
+            lines.append("# TYPE {} {}".format(family.name,
+                                               family.metric_type))
+            for label_items, metric in list(family.metrics.items()):
+                if family.metric_type == HISTOGRAM:
+                    lines.extend(_render_histogram(family.name, label_items,
+                                                   metric))
+                    continue
+                value = _safe_get(metric)
+                if value is None:
+                    continue
+                lines.append(family.name + _render_labels(label_items) +
+                             " " + _render_number(value))
+        return "\n".join(lines) + "\n"
+
+    def __metric(self, name, metric_type, help_text, labels, create,
+                 replace=False):
+        label_items = tuple(sorted(labels.items()))
+        family = self.__families.get(name)
+        if family is not None:
+            metric = family.metrics.get(label_items)
+            if metric is not None and not replace:
+                return metric
+
+        with self.__lock:
+            family = self.__families.get(name)
+            if family is None:
+                family = _Family(name, metric_type, help_text)
+                self.__families[name] = family
+            elif family.metric_type != metric_type:
+                raise ValueError("metric " + name + " is a " +
+                                 family.metric_type + ", not a " +
+                                 metric_type)
+            metric = family.metrics.get(label_items)
+            if metric is None or replace:
+                metric = create()
+                family.metrics[label_items] = metric
+            return metric
+
+
+def _safe_get(metric):
+    try:
+        return metric.get()
+    except Exception as error:  # noqa
+        # a broken metric function shouldn't break the whole scrape
+        logger.error("failed to read metric: " + str(error))
+        return None
+
+
+def _render_labels(label_items, extra_items=()):
+    items = label_items + tuple(extra_items)
+    if not items:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in items) + "}"
+
+
+def _render_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _render_histogram(name, label_items, histogram):
+    lines = []
+    cumulative = 0
+    bounds = histogram.buckets + (float("inf"),)
+    for bound, bucket_count in zip(bounds, histogram.bucket_counts):
+        cumulative += bucket_count
+        lines.append(name + "_bucket" + _render_labels(
+            label_items, [("le", _render_number(float(bound)))]) + " " +
+            str(cumulative))
+    lines.append(name + "_sum" + _render_labels(label_items) + " " +
+                 repr(histogram.sum))
+    lines.append(name + "_count" + _render_labels(label_items) + " " +
+                 str(histogram.count))
+    return lines
+
+
+class MetricsServer:
+    """ Serves a registry's metrics over HTTP (at /metrics) from a
+    background thread, for Prometheus to scrape """
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self.registry = registry
+        self.address = (host, port)
+        self.__server = None
+        self.__thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # don't fill the curses log with every scrape
+
+        self.__server = ThreadingHTTPServer(self.address, Handler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever,
+                                         name="metrics server")
+        self.__thread.daemon = True
+        self.__thread.start()
+        logger.info("serving metrics on http://{}:{}/metrics".format(
+            *self.__server.server_address[:2]))
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+            self.__thread = None
+
+
+# shared registry for the whole app (see span_profiler)
+metrics = MetricsRegistry()
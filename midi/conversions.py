@@ -1,10 +1,12 @@
-import mido
-import rtmidi
 import logging
 
+import numpy
+
 logger = logging.getLogger("global")
 
-# Convert between seconds and MIDI ticks
+# Convert between seconds and MIDI ticks. The _array versions convert a
+# whole array of times at once, for bulk paths like compiling a file's
+# events (they round exactly like the scalar ones)
 
 def convert_to_ticks(time_in_seconds, tempo, ticks_per_beat):
     """Convert time in seconds to MIDI ticks"""
@@ -17,50 +19,43 @@ def convert_to_seconds(ticks, tempo, ticks_per_beat):
     ticks_per_second = tempo * 1e-6 / ticks_per_beat
     return ticks * ticks_per_second
 
-# Convert between MIDI messages from the mido and rtmidi libraries
-
-def convert_to_rt(mido_message):
-    """ Convert a mido message to an rtmidi message """
-    if mido_message.type == 'note_on':
-        return rtmidi.MidiMessage().noteOn(
-            mido_message.channel, mido_message.note, mido_message.velocity)
-    elif mido_message.type == 'note_off':
-        return rtmidi.MidiMessage().noteOff(
-            mido_message.channel, mido_message.note)
-    elif mido_message.type == 'control_change':
-        return rtmidi.MidiMessage().controllerEvent(
-            mido_message.channel, mido_message.control, mido_message.value)
-    return None
 
+def convert_to_ticks_array(times_in_seconds, tempo, ticks_per_beat):
+    """Convert an array of times in seconds to (int64) MIDI ticks"""
+    ticks_per_second = tempo * 1e-6 / ticks_per_beat
+    return numpy.rint(numpy.asarray(times_in_seconds, dtype=numpy.float64) /
+                      ticks_per_second).astype(numpy.int64)
 
-def convert_to_mido(rtmidi_message, time):
-    """ Convert an rtmidi message plus corresponding delta time into a mido
-    message """
-    m = rtmidi_message
-    if m.isNoteOn():
-        return mido.Message(
-            'note_on',
-            channel=m.getChannel(),
-            note=m.getNoteNumber(),
-            velocity=m.getVelocity(),
-            time=time
-        )
-    elif m.isNoteOff():
-        return mido.Message(
-            'note_off',
-            channel=m.getChannel(),
-            note=m.getNoteNumber(),
-            velocity=0,
-            time=time
-        )
-    elif m.isController():
-        if m.getControllerNumber() == 64:  # sustain pedal
-            return mido.Message(
-                'control_change',
-                channel=m.getChannel(),
-                control=64,
-                value=m.getControllerValue(),
-                time=time
-            )
 
-    logger.error("received unknown/unimplemented midi message: " + str(m))
+def convert_to_seconds_array(ticks, tempo, ticks_per_beat):
+    """Convert an array of MIDI ticks to times in seconds"""
+    ticks_per_second = tempo * 1e-6 / ticks_per_beat
+    return numpy.asarray(ticks, dtype=numpy.float64) * ticks_per_second
+
+
+def convert_to_seconds_with_tempo_map(ticks, tempo_ticks, tempos,
+                                      ticks_per_beat, initial_tempo=500000):
+    """Convert a sorted array of MIDI ticks to seconds, following tempo
+    changes: tempos[i] applies from tempo_ticks[i] (sorted) on, and
+    initial_tempo before the first change.
+
+    Seconds are summed step by step from one tick to the next, the way
+    iterating a mido.MidiFile does, so given the ticks of every message in
+    a file the results are exactly mido's.
+    """
+    ticks = numpy.asarray(ticks, dtype=numpy.int64)
+    if not len(ticks):
+        return numpy.zeros(0)
+    # each step (from the previous tick, 0 for the first) runs at the tempo
+    # in effect at its start
+    step_starts = numpy.concatenate(([0], ticks[:-1]))
+    step_tempos = numpy.full(len(ticks), initial_tempo, dtype=numpy.float64)
+    if len(tempo_ticks):
+        change_index = numpy.searchsorted(
+            numpy.asarray(tempo_ticks, dtype=numpy.int64), step_starts,
+            side="right") - 1
+        changed = change_index >= 0
+        step_tempos[changed] = numpy.asarray(
+            tempos, dtype=numpy.float64)[change_index[changed]]
+    steps = (ticks - step_starts) * (step_tempos * 1e-6 / ticks_per_beat)
+    return numpy.cumsum(steps)
@@ -1,76 +1,265 @@
 import logging
+import struct
 
+import numpy
 from mido import MidiFile
-from mido import MidiTrack
+
+from midi import events
+from midi.recording_writer import encode_variable_length
 
 logger = logging.getLogger("global")
 
+"""MIDI file editing.
+
+A file is loaded once into columnar arrays (one record per message, see
+EDIT_DTYPE) and filters are vectorized operations on those columns. Any
+number of filters run over a single copy of the arrays, with messages they
+remove dropped in one go at the end, so applying several filters costs
+about as much as one and no per-message objects are created until the
+result is written.
+
+Notes and controllers are what filters edit. Everything else (tempo,
+program changes, other meta messages) is kept as is, in its original
+track and position.
+
+Usage:
+    editor = MidiEditor("recording1.mid")
+    editor.save("recording1_low.mid", [TransposeFilter(-12),
+                                       QuantizeFilter(editor.ticks_per_beat
+                                                      // 4)])
+"""
+
 DEFAULT_TEMPO = 500000
 DEFAULT_TICKS_PER_BEAT = 9600
 
+# kind of messages filters don't edit (see above)
+OTHER = 255
+
+EDIT_DTYPE = numpy.dtype([
+    ("track", "<u2"),
+    ("tick", "<i8"),  # absolute, in the file's ticks
+    ("order", "<i8"),  # position in the file, keeps same tick order stable
+    ("kind", "u1"),  # events.NOTE_ON etc, or OTHER
+    ("channel", "u1"),
+    ("data1", "u1"),  # note or controller number
+    ("data2", "u1"),  # velocity or controller value
+    ("other", "<i4"),  # index of an OTHER message, -1 for the rest
+])
+
+_STATUS_BY_KIND = {events.NOTE_OFF: 0x80, events.NOTE_ON: 0x90,
+                   events.CONTROL_CHANGE: 0xB0}
+_END_OF_TRACK = b"\xff\x2f\x00"
+
 
 class MidiFilter:
     """ Base abstract class for filtering Midi notes in a file """
 
-    def filter_note_on(self, mido_message):
-        """ Takes in a 'note on' and returns a new 'note on'
+    def filter_events(self, edited_events, keep):
+        """ Edit the columns of edited_events (an EDIT_DTYPE array) in
+        place, and clear keep (a bool array) for events to remove.
         Subclasses can optionally override """
-        return mido_message
+        pass
 
-    def filter_note_off(self, mido_message):
-        """ See 'filter_note_on' """
-        return mido_message
+
+def _notes(edited_events, note_range=None, channels=None):
+    """ Mask of note on/off events, optionally only those with notes in
+    note_range (a range) and on channels """
+    kinds = edited_events["kind"]
+    mask = (kinds == events.NOTE_ON) | (kinds == events.NOTE_OFF)
+    if note_range is not None:
+        mask &= _in_range(edited_events["data1"], note_range)
+    if channels is not None:
+        mask &= numpy.isin(edited_events["channel"], list(channels))
+    return mask
+
+
+def _in_range(values, value_range):
+    if value_range.step == 1:
+        return (values >= value_range.start) & (values < value_range.stop)
+    return numpy.isin(values, list(value_range))
 
 
 class RangeVelocityFilter(MidiFilter):
     """ Increase/decrease velocity of notes in range. All notes
     in this range will be affected using the same multiplier """
 
-    def __init__(self, note_range, multiplier):
+    def __init__(self, note_range, multiplier, channels=None):
         self.note_range = note_range
         self.multiplier = multiplier
+        self.channels = channels
+
+    def filter_events(self, edited_events, keep):
+        mask = _notes(edited_events, self.note_range, self.channels) & \
+            (edited_events["kind"] == events.NOTE_ON)
+        # in floats, so multiplying can't wrap around before clipping
+        velocities = edited_events["data2"][mask].astype(numpy.float64) * \
+            self.multiplier
+        edited_events["data2"][mask] = numpy.clip(
+            numpy.rint(velocities), 0, 127)
+
+
+class TransposeFilter(MidiFilter):
+    """ Shift notes (optionally only those in note_range/on channels) by a
+    number of semitones. Notes shifted out of MIDI's range are removed """
+
+    def __init__(self, semitones, note_range=None, channels=None):
+        self.semitones = semitones
+        self.note_range = note_range
+        self.channels = channels
 
-    def filter_note_on(self, mido_message):
-        new_message = mido_message.copy()
-        if mido_message.note in self.note_range:
-            new_message.velocity = round(mido_message.velocity * self.multiplier)
-        return new_message
+    def filter_events(self, edited_events, keep):
+        mask = _notes(edited_events, self.note_range, self.channels)
+        notes = edited_events["data1"][mask].astype(numpy.int16) + \
+            self.semitones
+        in_range = (notes >= 0) & (notes <= 127)
+        edited_events["data1"][mask] = numpy.clip(notes, 0, 127)
+        keep[numpy.flatnonzero(mask)[~in_range]] = False
+
+
+class QuantizeFilter(MidiFilter):
+    """ Move notes towards the nearest multiple of grid (in the file's
+    ticks, e.g. ticks_per_beat // 4 for sixteenth notes). strength 1 snaps
+    notes onto the grid, 0.5 moves them half way """
+
+    def __init__(self, grid, strength=1.0, channels=None):
+        self.grid = grid
+        self.strength = strength
+        self.channels = channels
+
+    def filter_events(self, edited_events, keep):
+        mask = _notes(edited_events, channels=self.channels)
+        ticks = edited_events["tick"][mask]
+        snapped = numpy.rint(ticks / self.grid) * self.grid
+        edited_events["tick"][mask] = numpy.rint(
+            ticks + (snapped - ticks) * self.strength)
+
+
+class ChannelSplitFilter(MidiFilter):
+    """ Move each channel's notes and controllers (all channels, or only
+    channels) to a track of its own, added after the existing tracks """
+
+    def __init__(self, channels=None):
+        self.channels = channels
+
+    def filter_events(self, edited_events, keep):
+        playable = edited_events["kind"] != OTHER
+        channels = self.channels
+        if channels is None:
+            channels = numpy.unique(edited_events["channel"][playable])
+        first_new_track = _track_count(edited_events["track"])
+        channel_column = edited_events["channel"]
+        new_tracks = edited_events["track"].copy()
+        for index, channel in enumerate(channels):
+            new_tracks[playable & (channel_column == channel)] = \
+                first_new_track + index
+        edited_events["track"] = new_tracks
 
 
 class MidiEditor:
     """ Applies effects/filters to contents of a MIDI file
-    e.g. mute every note """
-    def __init__(self, input_file_name, output_file_name):
-        self.__input_file = MidiFile(input_file_name)
-        self.__messages = []
-        for track in self.__input_file.tracks:
-            for msg in track:
-                self.__messages.append(msg)
-        self.output_file_name = output_file_name
-        self.__output_file = MidiFile(ticks_per_beat=DEFAULT_TICKS_PER_BEAT)
+    e.g. mute every note (see above) """
 
-        # assume single track for now
-        self.__track = MidiTrack()
-        self.__output_file.tracks.append(self.__track)
+    def __init__(self, input_file_name, output_file_name=None):
+        input_file = MidiFile(input_file_name)
+        self.ticks_per_beat = input_file.ticks_per_beat
+        self.file_type = input_file.type
+        self.output_file_name = output_file_name
+        self.__events, self.__other_messages = _load(input_file)
         self.__applied_filters = []
 
     def apply_filter(self, midifilter):
-        """ loop through MIDI messages and applies filters """
+        """ Add a filter to apply (with any others) when saving """
         self.__applied_filters.append(midifilter)
 
-        filtered_messages = []
-        for mido_message in self.__messages:
-            logger.info("message: " + str(mido_message))
-            if mido_message.type == 'note_on':
-                mido_message = midifilter.filter_note_on(mido_message)
-            elif mido_message.type == 'note_off':
-                mido_message = midifilter.filter_note_off(mido_message)
+    def edited_events(self, filters=()):
+        """ EDIT_DTYPE array of the file's events with applied filters and
+        filters run over it, sorted by track and time """
+        all_filters = self.__applied_filters + list(filters)
+        edited = self.__events.copy()
+        keep = numpy.ones(len(edited), dtype=bool)
+        for midifilter in all_filters:
+            midifilter.filter_events(edited, keep)
+        edited = edited[keep]
+        edited = edited[numpy.lexsort(
+            (edited["order"], edited["tick"], edited["track"]))]
+        logger.info("applied {} filters to {} messages".format(
+            len(all_filters), len(edited)))
+        return edited
+
+    def save(self, output_file_name=None, filters=()):
+        """ Save the edited file, with applied filters plus filters (which,
+        unlike apply_filter, only affect this save) """
+        output_file_name = output_file_name or self.output_file_name
+        edited = self.edited_events(filters)
+        track_numbers = edited["track"]
+        track_count = _track_count(track_numbers)
+        bounds = numpy.searchsorted(track_numbers,
+                                    numpy.arange(track_count + 1))
+        tracks = [self.__track_bytes(edited[bounds[i]:bounds[i + 1]])
+                  for i in range(track_count)]
+        file_type = 1 if track_count > 1 else self.file_type
+        with open(output_file_name, "wb") as midi_file:
+            midi_file.write(b"MThd" + struct.pack(
+                ">IHHH", 6, file_type, track_count, self.ticks_per_beat))
+            for track in tracks:
+                midi_file.write(b"MTrk" + struct.pack(">I", len(track)))
+                midi_file.write(track)
+
+    def __track_bytes(self, track_events):
+        ticks = track_events["tick"]
+        deltas = numpy.diff(ticks).tolist()
+        if len(ticks):
+            deltas.insert(0, int(ticks[0]))
+        parts = []
+        for delta, kind, channel, data1, data2, other in zip(
+                deltas, track_events["kind"].tolist(),
+                track_events["channel"].tolist(),
+                track_events["data1"].tolist(),
+                track_events["data2"].tolist(),
+                track_events["other"].tolist()):
+            parts.append(encode_variable_length(delta))
+            if kind == OTHER:
+                parts.append(_message_bytes(self.__other_messages[other]))
+            else:
+                parts.append(bytes((_STATUS_BY_KIND[kind] | channel, data1,
+                                    data2)))
+        parts.append(b"\x00" + _END_OF_TRACK)
+        return b"".join(parts)
+
+
+def _track_count(track_numbers):
+    return int(track_numbers.max()) + 1 if len(track_numbers) else 1
+
 
-            if mido_message is not None:
-                filtered_messages.append(mido_message)
+def _load(input_file):
+    """ (EDIT_DTYPE array, OTHER messages) for a mido MidiFile, without
+    the tracks' end of track messages (they're added back on save) """
+    rows = []
+    other_messages = []
+    order = 0
+    for track_number, track in enumerate(input_file.tracks):
+        tick = 0
+        for message in track:
+            tick += message.time
+            order += 1
+            if message.type == 'end_of_track':
+                continue
+            event = events.event_from_mido(message)
+            if message.type == 'note_off':
+                # keep the release velocity (playback doesn't use it)
+                event = event[:3] + (message.velocity,)
+            if event is None:
+                rows.append((track_number, tick, order, OTHER, 0, 0, 0,
+                             len(other_messages)))
+                other_messages.append(message)
+            else:
+                rows.append((track_number, tick, order) + event + (-1,))
+    return numpy.array(rows, dtype=EDIT_DTYPE), other_messages
 
-        self.__messages = filtered_messages
 
-    def save(self):
-        self.__track.extend(self.__messages)
-        self.__output_file.save(self.output_file_name)
+def _message_bytes(message):
+    """ A mido message as written in a track (after its delta time) """
+    if message.type == 'sysex':
+        data = bytes(message.data) + b"\xf7"
+        return b"\xf0" + encode_variable_length(len(data)) + data
+    return bytes(message.bytes())
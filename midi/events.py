@@ -0,0 +1,77 @@
+import logging
+
+import numpy
+
+from midi.message import MidiMessage
+
+logger = logging.getLogger("global")
+
+"""Compact MIDI events: one numpy record per event, sorted by tick, instead
+of one message object per event. Used for playback of files (see
+midi_cache and PlayMidiTask), where MidiMessages are only created for
+events as they're played.
+
+Channels are stored as given by the source (e.g. mido's), and become
+MidiMessage channels as they are.
+"""
+
+NOTE_OFF = 0
+NOTE_ON = 1
+CONTROL_CHANGE = 2
+
+EVENT_DTYPE = numpy.dtype([
+    ("tick", "<i8"),
+    ("kind", "u1"),
+    ("channel", "u1"),
+    ("data1", "u1"),  # note or controller number
+    ("data2", "u1"),  # velocity or controller value
+])
+
+
+def empty_events():
+    return numpy.zeros(0, dtype=EVENT_DTYPE)
+
+
+def events_from_tuples(event_tuples):
+    """ Sorted events array from (tick, kind, channel, data1, data2)
+    tuples. Events on the same tick keep their order """
+    events = numpy.array(list(event_tuples), dtype=EVENT_DTYPE)
+    return sort_events(events)
+
+
+def sort_events(events):
+    return events[numpy.argsort(events["tick"], kind="stable")]
+
+
+def event_from_mido(mido_message):
+    """ (kind, channel, data1, data2) for a mido message, None if it's not
+    a kind of message we play """
+    if mido_message.type == 'note_on':
+        return (NOTE_ON, mido_message.channel, mido_message.note,
+                mido_message.velocity)
+    elif mido_message.type == 'note_off':
+        return (NOTE_OFF, mido_message.channel, mido_message.note, 0)
+    elif mido_message.type == 'control_change':
+        return (CONTROL_CHANGE, mido_message.channel, mido_message.control,
+                mido_message.value)
+    return None
+
+
+def to_message(kind, channel, data1, data2):
+    """ MidiMessage for an event's fields """
+    if kind == NOTE_ON:
+        return MidiMessage.note_on(channel, data1, data2)
+    elif kind == NOTE_OFF:
+        return MidiMessage.note_off(channel, data1)
+    elif kind == CONTROL_CHANGE:
+        return MidiMessage.control_change(channel, data1, data2)
+    logger.error("unknown midi event kind: " + str(kind))
+    return None
+
+
+def events_to_messages(events):
+    """ MidiMessages for a slice of an events array """
+    return [to_message(kind, channel, data1, data2)
+            for kind, channel, data1, data2 in zip(
+                events["kind"].tolist(), events["channel"].tolist(),
+                events["data1"].tolist(), events["data2"].tolist())]
@@ -1,66 +1,148 @@
 import logging
 from time import time
 
-import rtmidi
+import numpy
 from pymaybe import maybe
 
-from midi.conversions import convert_to_seconds
+from midi import events
 from midi.conversions import convert_to_ticks
-from midi.metronome import MetronomeSyncedTask
+from midi.message import NOTE_OFF
+from midi.message import NOTE_ON
 from midi.metronome import MetronomeTask
-from midi.player import PlayMidiTask
+from scheduler.scheduler import Task
 
 logger = logging.getLogger("global")
 
 
-class MidiLoopPlayer:
-    def __init__(self, metronome, midi_monitor, midi_scheduler, channel, notes_by_tick, tempo, ticks_per_beat):
-        # ok why the heck do we need to have every single dependency
-        # that MidiLooper has? too much responsibility!!
+class LoopBuffer:
+    """One channel's loop, as a sorted events array (see midi.events).
+
+    Events recorded while the loop plays are collected separately and
+    merged in at the end of each loop pass, so what's just been played
+    live isn't echoed back until the next pass.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.events = events.empty_events()
+        self.__recorded = []
+
+    def record(self, tick, kind, data1, data2):
+        self.__recorded.append((tick, kind, self.channel, data1, data2))
+
+    def merge_recorded(self):
+        """ Merge events recorded since the last call into the loop.
+        Returns whether there were any """
+        if not self.__recorded:
+            return False
+        recorded = events.events_from_tuples(self.__recorded)
+        self.__recorded = []
+        self.events = events.sort_events(
+            numpy.concatenate((self.events, recorded)))
+        return True
+
+
+class LoopPlaybackTask(Task):
+    """Plays every playing channel's loop, in time with the metronome.
+
+    The playing loops are merged into one sorted events array, and a single
+    cursor walks it once per loop pass. The array is only rebuilt when a
+    channel starts or stops playing, or recorded events get merged in.
+    """
+
+    def __init__(self, metronome, midi_monitor, loop_ticks):
         self.__metronome = metronome
         self.__midi_monitor = midi_monitor
-        self.__midi_scheduler = midi_scheduler
-        self.notes_by_tick = notes_by_tick
-        self.channel = channel
-        self.__play_task = MetronomeSyncedTask(
-            self.metronome,
-            PlayMidiTask(
-                self.notes_by_tick,
-                self.__midi_monitor,
-                tempo,
-                ticks_per_beat
-            )
-        )
-        self.__is_playing = False
+        self.loop_ticks = loop_ticks
+        self.buffers = {}  # channel -> LoopBuffer
+        self.playing_channels = set()
+        self.__events = events.empty_events()
+        self.__ticks = self.__events["tick"]
+        self.__position = 0  # index of the next event to play
+        self.__last_tick = None
+
+    def buffer(self, channel):
+        """ The channel's LoopBuffer, created if needed """
+        loop_buffer = self.buffers.get(channel)
+        if loop_buffer is None:
+            loop_buffer = LoopBuffer(channel)
+            self.buffers[channel] = loop_buffer
+        return loop_buffer
+
+    def set_playing(self, channel, is_playing):
+        if is_playing:
+            self.playing_channels.add(channel)
+        else:
+            self.playing_channels.discard(channel)
+        self.__rebuild()
 
-        # track all active notes
-        self.__active_notes = []
+    def start(self):
+        self.__last_tick = None
 
-    def play(self):
-        """Begin playing notes"""
-        if self.__is_playing:
+    def tick(self, time):
+        current_tick = self.__metronome.current_tick
+        last_tick = self.__last_tick
+        if last_tick is None:
+            last_tick = current_tick - 1
+            self.__position = self.__index_after(last_tick)
+        if current_tick == last_tick:
             return
-        self.__midi_scheduler.add(self.__play_task)
-        self.__is_playing = True
-
-    def mute(self):
-        """Mute notes"""
-        if not self.__is_playing:
+        self.__last_tick = current_tick
+
+        if current_tick < last_tick:
+            # loop pass is over: play the rest of it, then start over
+            self.__play_up_to(self.loop_ticks - 1)
+            if any([loop_buffer.merge_recorded()
+                    for loop_buffer in self.buffers.values()]):
+                self.__rebuild()
+            self.__position = 0
+        self.__play_up_to(current_tick)
+
+    def is_finished(self, time):
+        return False
+
+    def __play_up_to(self, tick):
+        end = self.__index_after(tick)
+        if end <= self.__position:
             return
-        self.__midi_scheduler.remove(self.__play_task)
-        self.__is_playing = False
-
-    def stop_all_pending_notes_since_tick(self, tick):
-        pass
+        due = self.__events[self.__position:end]
+        self.__position = end
+        for message in events.events_to_messages(due):
+            if message is not None:
+                self.__midi_monitor.send_midi_message(message)
+
+    def __index_after(self, tick):
+        return int(numpy.searchsorted(self.__ticks, tick, side="right"))
+
+    def __rebuild(self):
+        playing = [self.buffers[channel].events
+                   for channel in sorted(self.playing_channels)
+                   if channel in self.buffers]
+        self.__events = events.sort_events(numpy.concatenate(
+            playing)) if playing else events.empty_events()
+        self.__ticks = self.__events["tick"]
+        if self.__last_tick is not None:
+            self.__position = self.__index_after(self.__last_tick)
 
 
 class MidiLoopRecorder:
+    """Records live input (channel 1) into a channel's LoopBuffer, at the
+    metronome's current tick. Recording into a buffer that already has a
+    loop overdubs it.
+
+    With quantize_ticks, note ons are moved to the nearest multiple of it
+    (and their note offs by as much, so notes keep their length).
+    """
 
-    def __init__(self, metronome, midi_monitor, channel):
+    def __init__(self, metronome, midi_monitor, loop_buffer, loop_ticks,
+                 quantize_ticks=None):
         self.__metronome = metronome
         self.__midi_monitor = midi_monitor
-        self.channel = channel
-        self.notes_by_tick = {}
+        self.__loop_buffer = loop_buffer
+        self.__loop_ticks = loop_ticks
+        self.__quantize_ticks = quantize_ticks
+        self.channel = loop_buffer.channel
+        self.__shifts_by_note = {}
         self.__is_recording = False
 
     def start(self):
@@ -76,47 +158,69 @@ class MidiLoopRecorder:
     def is_recording(self):
         return self.__is_recording
 
-    def received_midi(self, rtmidi_message):
-        if rtmidi_message.getChannel() != 1:
+    def received_midi(self, message):
+        if message.channel != 1:
             # assume only channel one has real time user input. TODO: enum this?
             return
 
-        current_tick = self.__metronome.current_tick
-
-        m = rtmidi_message
-        if m.isNoteOn() or m.isNoteOff() or \
-                (m.isController() and m.getControllerNumber() == 64):
-            notes = self.notes_by_tick.get(current_tick, [])
-            m.setChannel(self.channel)
-
-            if m.isNoteOn():
-                # notes seem slightly scaled down in volume when recorded
-                # make up for that here:
-                m.multiplyVelocity(1.1)
+        m = message
+        if m.kind == NOTE_ON:
+            kind = events.NOTE_ON
+        elif m.kind == NOTE_OFF:
+            kind = events.NOTE_OFF
+        elif m.is_sustain_pedal():
+            kind = events.CONTROL_CHANGE
+        else:
+            return
 
-            notes.append(m)
-            self.notes_by_tick[current_tick] = notes
+        # observers after this one see the message as coming from the
+        # recorded channel (e.g. the looper channel MIDI file recorders)
+        m.channel = self.channel
+        if m.kind == NOTE_ON:
+            # notes seem slightly scaled down in volume when recorded
+            # make up for that here:
+            m.multiply_velocity(1.1)
+
+        tick = self.__metronome.current_tick
+        if self.__quantize_ticks and kind != events.CONTROL_CHANGE:
+            if kind == events.NOTE_ON:
+                shift = round(tick / self.__quantize_ticks) * \
+                    self.__quantize_ticks - tick
+                self.__shifts_by_note[m.data1] = shift
+            else:
+                shift = self.__shifts_by_note.pop(m.data1, 0)
+            tick = (tick + shift) % self.__loop_ticks
+        self.__loop_buffer.record(tick, kind, m.data1, m.data2)
 
 
 class MidiLooper:
     """Allows recording and looped playback of MIDI"""
 
     def __init__(self, tempo, ticks_per_beat, beats_per_measure, midi_monitor,
-                 midi_scheduler):
+                 midi_scheduler, quantize_ticks=None, transport=None):
+        """
+        Args:
+            transport: the (shared) transport to keep time with, see
+                MetronomeTask.
+            quantize_ticks: if given, recorded notes are moved to the
+                nearest multiple of this many ticks (e.g. ticks_per_beat // 2
+                for eighth notes).
+        """
         self.tempo = tempo  # reminder: nanoseconds per beat
         self.ticks_per_beat = ticks_per_beat
         self.beats_per_measure = beats_per_measure
+        self.quantize_ticks = quantize_ticks
         self.start_time = time()
-        # TODO: metronome should be DI'ed since loopers and players
-        # will share the same one
         self.metronome = MetronomeTask(
             tempo=self.tempo,
             ticks_per_beat=self.ticks_per_beat,
-            beats_per_measure=self.beats_per_measure
+            beats_per_measure=self.beats_per_measure,
+            transport=transport
         )
         self.__midi_monitor = midi_monitor
         self.__midi_scheduler = midi_scheduler
-        self.__play_tasks = {}
+        self.__playback_task = LoopPlaybackTask(
+            self.metronome, midi_monitor, self.ticks_per_measure())
         self.current_channel = -1
         self.__recorders = {}
 
@@ -128,42 +232,41 @@ class MidiLooper:
 
     def seconds_per_measure(self):
         """returns number of seconds in a measure"""
-        return convert_to_seconds(
-            ticks=self.ticks_per_measure(),
-            tempo=self.tempo,
-            ticks_per_beat=self.ticks_per_beat
-        )
+        return self.metronome.seconds_per_measure()
 
     def start(self):
         if self.is_started is True:
             return
         self.is_started = True
         self.__midi_scheduler.add(self.metronome)
+        # added after the metronome so it's ticked after it
+        self.__midi_scheduler.add(self.__playback_task)
 
     def record(self, start_time, channel):
         """ Start recording
         start_time: global start time
         """
         self.current_channel = channel
-        recorder = MidiLoopRecorder(
-            metronome=self.metronome,
-            midi_monitor=self.__midi_monitor,
-            channel=channel
-        )
-        self.__recorders[channel] = recorder
-        recorder.start()
+        self.__record(channel)
 
         delta_time = time() - start_time
         self.delta_ticks = convert_to_ticks(delta_time, self.tempo,
                                             self.ticks_per_beat)
 
+    def overdub(self, channel):
+        """ Start recording on top of a channel's existing loop """
+        if self.is_recording(channel):
+            return
+        self.current_channel = channel
+        self.__record(channel)
+
     def is_recording(self, channel):
         recorder = self.__recorders.get(channel)
         if recorder is not None:
             return recorder.is_recording()
 
     def has_been_recorded(self, channel):
-        return self.__recorders.get(channel) is not None
+        return channel in self.__playback_task.buffers
 
     def save_record(self, channel):
         """ Save active recording """
@@ -171,24 +274,13 @@ class MidiLooper:
 
     def play(self, channel):
         """ Play last saved recording """
-        self.__play_tasks[channel] = MetronomeSyncedTask(
-            self.metronome,
-            PlayMidiTask(
-                self.__recorders.get(channel).notes_by_tick,
-                self.__midi_monitor,
-                self.tempo,
-                self.ticks_per_beat
-            )
-        )
-        self.__midi_scheduler.add(self.__play_tasks[channel])
+        self.__playback_task.set_playing(channel, True)
 
     def is_playing(self, channel):
-        playing =  self.__play_tasks.get(channel) is not None
-        return playing
+        return channel in self.__playback_task.playing_channels
 
     def pause(self, channel):
-        self.__midi_scheduler.remove(self.__play_tasks[channel])
-        self.__play_tasks[channel] = None
+        self.__playback_task.set_playing(channel, False)
 
         # a little hacky? end all active notes on a specific channel when
         # looper is paused. is it hacky?
@@ -196,6 +288,20 @@ class MidiLooper:
 
     def stop(self):
         logger.info("stopping!")
-        for task in self.__play_tasks:
-            self.__midi_scheduler.remove(task) 
+        for recorder in self.__recorders.values():
+            recorder.stop()
+        self.__midi_scheduler.remove(self.__playback_task)
         self.__midi_scheduler.remove(self.metronome)
+        self.metronome.stop()
+
+    def __record(self, channel):
+        maybe(self.__recorders.get(channel)).stop()
+        recorder = MidiLoopRecorder(
+            metronome=self.metronome,
+            midi_monitor=self.__midi_monitor,
+            loop_buffer=self.__playback_task.buffer(channel),
+            loop_ticks=self.ticks_per_measure(),
+            quantize_ticks=self.quantize_ticks
+        )
+        self.__recorders[channel] = recorder
+        recorder.start()
@@ -0,0 +1,129 @@
+import logging
+
+import rtmidi
+
+logger = logging.getLogger("global")
+
+"""The MIDI message passed around inside the app.
+
+rtmidi (and mido) messages are only created where MIDI leaves or enters
+the app: reading from or sending to a MIDI port (see MidiMonitor) and
+reading or writing files. Everywhere else a MidiMessage is a plain object
+with four slots, so checking what a message is costs an attribute read
+rather than a call into rtmidi.
+
+Channels are 1-16 like rtmidi's (and the same out of range channels wrap
+around the same way, e.g. channel 0 is channel 16). A note on with zero
+velocity is a note off, like rtmidi's isNoteOn/isNoteOff treat it.
+"""
+
+# message kinds (the status byte without the channel)
+OTHER = 0x00  # anything the app doesn't handle (pitch bend etc)
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+
+SUSTAIN_PEDAL = 64  # controller number
+
+NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#",
+              "B"]
+
+
+class MidiMessage:
+    """A note on/off or controller change.
+
+    Attributes:
+        kind: NOTE_ON, NOTE_OFF, CONTROL_CHANGE or OTHER.
+        channel: 1-16.
+        data1: note or controller number.
+        data2: velocity (0 for note offs) or controller value.
+    """
+
+    __slots__ = ('kind', 'channel', 'data1', 'data2')
+
+    def __init__(self, kind, channel, data1=0, data2=0):
+        self.kind = kind
+        self.channel = channel
+        self.data1 = data1
+        self.data2 = data2
+
+    @classmethod
+    def note_on(cls, channel, note, velocity):
+        if velocity == 0:
+            return cls(NOTE_OFF, _valid_channel(channel), note, 0)
+        return cls(NOTE_ON, _valid_channel(channel), note, velocity)
+
+    @classmethod
+    def note_off(cls, channel, note):
+        return cls(NOTE_OFF, _valid_channel(channel), note, 0)
+
+    @classmethod
+    def control_change(cls, channel, controller, value):
+        return cls(CONTROL_CHANGE, _valid_channel(channel), controller, value)
+
+    @classmethod
+    def from_rtmidi(cls, rtmidi_message):
+        m = rtmidi_message
+        if m.isNoteOn():
+            return cls(NOTE_ON, m.getChannel(), m.getNoteNumber(),
+                       m.getVelocity())
+        elif m.isNoteOff():
+            return cls(NOTE_OFF, m.getChannel(), m.getNoteNumber(), 0)
+        elif m.isController():
+            return cls(CONTROL_CHANGE, m.getChannel(),
+                       m.getControllerNumber(), m.getControllerValue())
+        return cls(OTHER, m.getChannel())
+
+    def to_rtmidi(self):
+        if self.kind == NOTE_ON:
+            return rtmidi.MidiMessage().noteOn(self.channel, self.data1,
+                                               self.data2)
+        elif self.kind == NOTE_OFF:
+            return rtmidi.MidiMessage().noteOff(self.channel, self.data1)
+        elif self.kind == CONTROL_CHANGE:
+            return rtmidi.MidiMessage().controllerEvent(
+                self.channel, self.data1, self.data2)
+        logger.error("can't convert to rtmidi: " + str(self))
+        return None
+
+    def copy(self):
+        return MidiMessage(self.kind, self.channel, self.data1, self.data2)
+
+    def is_note_on(self):
+        return self.kind == NOTE_ON
+
+    def is_note_off(self):
+        return self.kind == NOTE_OFF
+
+    def is_sustain_pedal(self):
+        return self.kind == CONTROL_CHANGE and self.data1 == SUSTAIN_PEDAL
+
+    def multiply_velocity(self, multiplier):
+        """ Scale a note's velocity (rounded, capped at 127) """
+        if self.kind == NOTE_ON:
+            self.data2 = min(127, int(self.data2 * multiplier + 0.5))
+
+    def __eq__(self, other):
+        return isinstance(other, MidiMessage) and \
+            (self.kind, self.channel, self.data1, self.data2) == \
+            (other.kind, other.channel, other.data1, other.data2)
+
+    def __repr__(self):
+        if self.kind in (NOTE_ON, NOTE_OFF):
+            return "<MidiMessage {} ch{} {} vel {}>".format(
+                "note on" if self.kind == NOTE_ON else "note off",
+                self.channel, note_name(self.data1), self.data2)
+        elif self.kind == CONTROL_CHANGE:
+            return "<MidiMessage controller ch{} {}={}>".format(
+                self.channel, self.data1, self.data2)
+        return "<MidiMessage other ch{}>".format(self.channel)
+
+
+def note_name(note):
+    """ e.g. C4 for middle C (60), like rtmidi's getMidiNoteName """
+    return NOTE_NAMES[note % 12] + str(note // 12 - 1)
+
+
+def _valid_channel(channel):
+    """ Wrap channels outside of 1-16 the way rtmidi does """
+    return ((channel - 1) & 0x0F) + 1
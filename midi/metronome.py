@@ -1,76 +1,94 @@
-from AppKit import NSSound
 import logging
+import math
 
-from midi.conversions import convert_to_seconds
-from midi.conversions import convert_to_ticks
+from midi.metronome_audio import metronome_audio
 from midi.time_keeper import TimeKeeper
+from midi.transport import TempoMap
+from midi.transport import Transport
 from scheduler.scheduler import Task
 
 logger = logging.getLogger("global")
 
+# how far ahead of the transport clicks are scheduled. Main loop passes
+# further apart than this make clicks late
+CLICK_LOOKAHEAD = 0.1
+
 
 class MetronomeTask(Task, TimeKeeper):
     """Metronome that plays audio beats based on tempo and time
     signature. Also serves as a time-keeper for other systems that want
     to keep in sync with a common beat.
-    """
 
-    current_tick = 0  # TimeKeeper abstract property
-    tempo = 0  # TimeKeeper abstract property
+    Time comes from a Transport (see transport.py), so the position is
+    always read from the clock rather than counted in ticks, and stays
+    right however late the main loop gets. Given a shared transport (e.g.
+    the session's, see LightfulKeyboardShortcuts), its tempo and ticks per
+    beat are used instead of tempo and ticks_per_beat, and measures are
+    counted from when it started. Clicks are handed to the audio
+    backend (see metronome_audio.py) ahead of time, for the clock time of
+    their beat.
+    """
 
-    def __init__(self, tempo, ticks_per_beat, beats_per_measure):
-        self.tempo = tempo
-        self.ticks_per_beat = ticks_per_beat
+    def __init__(self, tempo, ticks_per_beat, beats_per_measure,
+                 transport=None, audio_backend=None):
         self.beats_per_measure = beats_per_measure
-        self.first_tick = 0
-        self.current_tick = 0
+        self.transport = transport or Transport(
+            TempoMap(tempo, ticks_per_beat), beats_per_measure)
+        self.ticks_per_beat = self.transport.ticks_per_beat
+        self.audio_backend = audio_backend
+        self.__next_beat = 0  # next beat to schedule a click for
+
+    @property
+    def tempo(self):
+        return self.transport.tempo()
 
-        # whoa, ObjC!
-        self.sound = NSSound.alloc().initWithContentsOfFile_byReference_(
-            "media/audio/metronome.wav", False
-        )
+    @property
+    def current_tick(self):
+        """ Tick within the current measure """
+        return self.transport.tick() % self.ticks_per_measure()
+
+    @property
+    def current_time(self):
+        """ Seconds into the current measure """
+        beat_in_measure = self.transport.beat() % self.beats_per_measure
+        return beat_in_measure * self.transport.tempo() * 1e-6
 
     def start(self):
-        self.first_tick = 0
-        self.current_tick = 0
+        """ Start the transport, unless it's shared and already running """
+        if not self.transport.is_started():
+            self.transport.start()
+        self.__next_beat = math.ceil(self.transport.position() /
+                                     self.ticks_per_beat)
+
+    def stop(self):
+        """ Drop clicks already scheduled (call when removing the task) """
+        self.__backend().cancel_clicks()
 
     def tick(self, time):
         if self.is_finished(time):
             # we're done already, so just return
             return
 
-        current_tick = convert_to_ticks(time, self.tempo, self.ticks_per_beat)
-
-        # mod current tick by beats in a measure
-        current_tick = current_tick % self.ticks_per_measure()
-
-        if current_tick > self.current_tick + 1:
-            logger.error("tick jump: " + str(current_tick - self.current_tick))
-
-        if current_tick == self.current_tick:
-            # don't handle same tick twice (this violates requirement that
-            # tasks be deterministic, but it's not a huge deal in this case)
-            return
-        self.current_tick = current_tick
-
-        if current_tick % self.ticks_per_beat == 0:
-            # logger.info("playing")
-            self._play_beat()
+        transport = self.transport
+        now = transport.clock()
+        horizon = transport.tempo_map.ticks_at(
+            transport.elapsed() + CLICK_LOOKAHEAD)
+        while self.__next_beat * self.ticks_per_beat <= horizon:
+            click_time = transport.clock_time_at(
+                self.__next_beat * self.ticks_per_beat)
+            self.__next_beat += 1
+            if click_time < now - CLICK_LOOKAHEAD:
+                continue  # stalled for a while, don't play a burst of clicks
+            self.__backend().schedule_click(click_time)
 
     def ticks_per_measure(self):
         return self.beats_per_measure * self.ticks_per_beat
 
     def seconds_per_measure(self):
-        return convert_to_seconds(self.ticks_per_measure(), self.tempo, self.ticks_per_beat)
-
-    def _play_beat(self):
-        self.sound.stop()
-        self.sound.play()
+        return self.transport.tempo() * 1e-6 * self.beats_per_measure
 
-    @property
-    def current_time(self):
-        return convert_to_seconds(self.current_tick, self.tempo,
-                                  self.ticks_per_beat)
+    def __backend(self):
+        return self.audio_backend or metronome_audio.backend
 
     def is_finished(self, time):
         return False  # never finished for now
@@ -81,7 +99,9 @@ class MetronomeTask(Task, TimeKeeper):
 
 
 class MetronomeSyncedTask(Task):
-    """Sync a task with a metronome"""
+    """Sync a task with a metronome: the task's time is how far into the
+    metronome's measure we are (read from its transport, so unlike the
+    metronome's ticks it isn't quantized) """
 
     def __init__(self, metronome, task):
         """
@@ -0,0 +1,232 @@
+import heapq
+import logging
+import threading
+import time
+import wave
+from abc import ABC
+from abc import abstractmethod
+from collections import deque
+
+import numpy
+
+logger = logging.getLogger("global")
+
+"""Metronome click output.
+
+The metronome schedules each click a little ahead of time, at the clock
+time the transport says its beat falls on (see MetronomeTask), and an
+AudioBackend plays it then. So how late a main loop pass runs only
+decides how early a click is scheduled, not when it's heard.
+
+Backends:
+    null: plays nothing, just keeps the click times (headless runs)
+    file: renders the clicks into a WAV file when closed, at exactly
+        their scheduled times (for checking timing without speakers)
+    appkit: plays through macOS' NSSound (needs pyobjc)
+
+The click sound is decoded once (load_click) and shared by the backends
+that need its samples. All times are on time.perf_counter's clock, like
+the Transport's default.
+
+Usage:
+    metronome_audio.use(create_audio_backend("file", "clicks.wav"))
+    ...
+    metronome_audio.close()
+"""
+
+DEFAULT_CLICK_FILE = "media/audio/metronome.wav"
+BACKEND_NAMES = ["auto", "null", "file", "appkit"]
+
+_click_cache = {}
+
+
+class Click:
+    """ A decoded click sound: mono int16 samples at sample_rate """
+
+    def __init__(self, samples, sample_rate):
+        self.samples = samples
+        self.sample_rate = sample_rate
+
+    @property
+    def seconds(self):
+        return len(self.samples) / self.sample_rate
+
+
+def load_click(file_name=DEFAULT_CLICK_FILE):
+    """ Decode a 16 bit PCM WAV file (mixed down to mono), once per file """
+    click = _click_cache.get(file_name)
+    if click is None:
+        with wave.open(file_name, "rb") as wav_file:
+            if wav_file.getsampwidth() != 2:
+                raise ValueError(file_name + " isn't 16 bit PCM")
+            channels = wav_file.getnchannels()
+            frames = wav_file.readframes(wav_file.getnframes())
+            samples = numpy.frombuffer(frames, dtype="<i2")
+            if channels > 1:
+                samples = samples.reshape(-1, channels).mean(axis=1).astype(
+                    numpy.int16)
+            click = Click(samples, wav_file.getframerate())
+        _click_cache[file_name] = click
+    return click
+
+
+class AudioBackend(ABC):
+    """ Plays clicks at scheduled times """
+
+    @abstractmethod
+    def schedule_click(self, at_time):
+        """ Play a click at at_time (perf_counter clock). Clicks are
+        scheduled in order, and at_time may already be (slightly) past """
+        pass
+
+    def cancel_clicks(self):
+        """ Forget clicks scheduled but not played yet """
+        pass
+
+    def close(self):
+        pass
+
+
+class NullAudioBackend(AudioBackend):
+    """ Silent: remembers the latest clicks' times (for headless runs and
+    benchmarks) """
+
+    def __init__(self, history=1000):
+        self.scheduled_clicks = deque(maxlen=history)
+
+    def schedule_click(self, at_time):
+        self.scheduled_clicks.append(at_time)
+
+
+class FileAudioBackend(AudioBackend):
+    """ Renders clicks into a WAV file (written on close), with silence
+    between them so the file plays them back at their scheduled times.
+    The file starts at the first click """
+
+    def __init__(self, file_name, click=None):
+        self.file_name = file_name
+        self.click = click or load_click()
+        self.__click_times = []
+
+    def schedule_click(self, at_time):
+        self.__click_times.append(at_time)
+
+    def close(self):
+        if not self.__click_times:
+            return
+        samples = render_clicks(self.__click_times, self.click)
+        with wave.open(self.file_name, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.click.sample_rate)
+            wav_file.writeframes(samples.astype("<i2").tobytes())
+        logger.info("wrote {} metronome clicks to {}".format(
+            len(self.__click_times), self.file_name))
+        self.__click_times = []
+
+
+def render_clicks(click_times, click):
+    """ int16 samples with click mixed in at each time (relative to the
+    first) """
+    offsets = numpy.rint((numpy.asarray(click_times) - click_times[0]) *
+                         click.sample_rate).astype(numpy.int64)
+    click_length = len(click.samples)
+    mixed = numpy.zeros(int(offsets[-1]) + click_length, dtype=numpy.int32)
+    for offset in offsets.tolist():
+        mixed[offset:offset + click_length] += click.samples
+    return numpy.clip(mixed, -32768, 32767).astype(numpy.int16)
+
+
+class AppKitAudioBackend(AudioBackend):
+    """ Plays clicks with NSSound from a timer thread that wakes up for
+    each scheduled click (so the main loop never waits on it) """
+
+    def __init__(self, click_file_name=DEFAULT_CLICK_FILE):
+        from AppKit import NSSound  # only on macOS, with pyobjc
+        # whoa, ObjC!
+        self.sound = NSSound.alloc().initWithContentsOfFile_byReference_(
+            click_file_name, False)
+        self.__click_times = []  # heap
+        self.__condition = threading.Condition()
+        self.__is_closed = False
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="metronome audio")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def schedule_click(self, at_time):
+        with self.__condition:
+            heapq.heappush(self.__click_times, at_time)
+            self.__condition.notify()
+
+    def cancel_clicks(self):
+        with self.__condition:
+            self.__click_times = []
+
+    def close(self):
+        with self.__condition:
+            self.__is_closed = True
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__is_closed:
+                    if self.__click_times:
+                        wait = self.__click_times[0] - time.perf_counter()
+                        if wait <= 0:
+                            heapq.heappop(self.__click_times)
+                            break
+                        self.__condition.wait(wait)
+                    else:
+                        self.__condition.wait()
+                if self.__is_closed:
+                    return
+            self.sound.stop()
+            self.sound.play()
+
+
+def create_audio_backend(name="auto", file_name=None):
+    """ Backend by name (see above). auto is appkit where it's available,
+    null elsewhere """
+    if name == "auto":
+        try:
+            return AppKitAudioBackend()
+        except ImportError:
+            logger.info("no AppKit, metronome will be silent")
+            return NullAudioBackend()
+    elif name == "null":
+        return NullAudioBackend()
+    elif name == "file":
+        return FileAudioBackend(file_name or "metronome_clicks.wav")
+    elif name == "appkit":
+        return AppKitAudioBackend()
+    raise ValueError("unknown audio backend: " + name)
+
+
+class MetronomeAudio:
+    """ The backend metronomes play through, created on first use unless
+    one was chosen (e.g. from the command line) """
+
+    def __init__(self):
+        self.__backend = None
+
+    @property
+    def backend(self):
+        if self.__backend is None:
+            self.__backend = create_audio_backend()
+        return self.__backend
+
+    def use(self, backend):
+        self.close()
+        self.__backend = backend
+
+    def close(self):
+        if self.__backend is not None:
+            self.__backend.close()
+            self.__backend = None
+
+
+# shared by all metronomes (see span_profiler)
+metronome_audio = MetronomeAudio()
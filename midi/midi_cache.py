@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+
+import numpy
+
+from midi import events
+from midi.smf_reader import StreamingMidiFileReader
+
+logger = logging.getLogger("global")
+
+"""Compiled MIDI file cache.
+
+Compiling a MIDI file into a sorted events array (see events.py) means
+parsing every message, which is slow for long recordings. The compiled
+array is saved next to the file ('<file>.events.npy', plus a small
+'<file>.events.json' describing it) and memory mapped on later loads. The
+cache is rebuilt whenever the MIDI file's size or modification time
+changes, or it was compiled for a different ticks_per_beat.
+"""
+
+CACHE_VERSION = 1
+
+
+def cache_file_names(file_name):
+    """ (events file name, metadata file name) of a MIDI file's cache """
+    return file_name + ".events.npy", file_name + ".events.json"
+
+
+def load_events(file_name, ticks_per_beat):
+    """ Events array (read-only, possibly memory mapped) and tempo for a
+    MIDI file, compiling and caching it if needed """
+    cached = _load_cached(file_name, ticks_per_beat)
+    if cached is not None:
+        return cached
+
+    reader = StreamingMidiFileReader(file_name)
+    compiled_events = events.sort_events(reader.events_array(ticks_per_beat))
+    logger.info("compiled {} events from {}".format(len(compiled_events),
+                                                    file_name))
+    _save_cache(file_name, ticks_per_beat, compiled_events, reader.tempo)
+    return compiled_events, reader.tempo
+
+
+def _source_stamp(file_name):
+    stat = os.stat(file_name)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _load_cached(file_name, ticks_per_beat):
+    events_file_name, meta_file_name = cache_file_names(file_name)
+    try:
+        with open(meta_file_name) as meta_file:
+            meta = json.load(meta_file)
+        if meta.get("version") != CACHE_VERSION or \
+                meta.get("source") != _source_stamp(file_name) or \
+                meta.get("ticks_per_beat") != ticks_per_beat:
+            return None
+        cached_events = numpy.load(events_file_name, mmap_mode="r")
+    except (OSError, ValueError):
+        return None  # missing or unreadable, just recompile
+    if cached_events.dtype != events.EVENT_DTYPE:
+        return None
+    return cached_events, meta["tempo"]
+
+
+def _save_cache(file_name, ticks_per_beat, compiled_events, tempo):
+    events_file_name, meta_file_name = cache_file_names(file_name)
+    meta = {
+        "version": CACHE_VERSION,
+        "source": _source_stamp(file_name),
+        "ticks_per_beat": ticks_per_beat,
+        "tempo": tempo,
+        "count": len(compiled_events),
+    }
+    try:
+        # write to temporary files first so a crash never leaves a cache
+        # that looks valid but isn't
+        with open(events_file_name + ".tmp", "wb") as events_file:
+            numpy.save(events_file, compiled_events)
+        os.replace(events_file_name + ".tmp", events_file_name)
+        with open(meta_file_name + ".tmp", "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_file_name + ".tmp", meta_file_name)
+    except OSError as error:
+        logger.warning("couldn't cache compiled " + file_name + ": " +
+                       str(error))
@@ -1,10 +1,22 @@
 import logging
+import time
 
 import rtmidi
 from pymaybe import maybe
 
+from latency import note_latency
+from metrics import metrics
+from midi.message import MidiMessage
+from midi.message import NOTE_OFF
+from midi.message import NOTE_ON
+
 logger = logging.getLogger("global")
 
+midi_in_metric = metrics.counter("lightful_midi_messages_received_total",
+                                 "MIDI messages received from the piano")
+midi_out_metric = metrics.counter("lightful_midi_messages_sent_total",
+                                  "MIDI messages sent to the piano")
+
 
 class MidiMonitor:
 
@@ -55,34 +67,43 @@ class MidiMonitor:
             if rtmidi_message is None:
                 return
 
-            self.handle_midi_message(rtmidi_message)
+            midi_in_metric.inc()
+            arrival_time = time.perf_counter()
+            message = MidiMessage.from_rtmidi(rtmidi_message)
+            self.handle_midi_message(message, arrival_time=arrival_time)
 
-    def send_midi_message(self, rtmidi_message):
-        """ Send a MIDI message """
-        self.__midi_out.sendMessage(rtmidi_message)
-        self.handle_midi_message(rtmidi_message)
+    def send_midi_message(self, message):
+        """ Send a MIDI message (a MidiMessage) """
+        self.__midi_out.sendMessage(message.to_rtmidi())
+        midi_out_metric.inc()
+        self.handle_midi_message(message)
 
-    def handle_midi_message(self, rtmidi_message):
+    def handle_midi_message(self, message, arrival_time=None):
+        """ Dispatch a MidiMessage to observers. arrival_time
+        (time.perf_counter() seconds) is when the message came in, for
+        latency tracking; defaults to now """
 
         # don't bother handling sustain pedal value changes unless its
         # state changed between on and off
         is_redundant = False
 
-        rtmidi_message = rtmidi_message # set var in function scope
-        if rtmidi_message.isController() and \
-                rtmidi_message.getControllerNumber() == 64:
-            sustain_value = rtmidi_message.getControllerValue()
+        if message.is_sustain_pedal():
+            sustain_value = message.data2
             SUSTAIN_ON_THRESHOLD = 64
             is_active = (sustain_value > SUSTAIN_ON_THRESHOLD)
             is_redundant = \
                 (is_active == self.__is_sustain_pedal_active)
             self.__is_sustain_pedal_active = is_active
-            rtmidi_message = rtmidi.MidiMessage.controllerEvent(rtmidi_message.getChannel(), 64, 127 if is_active else 0)
+            message = MidiMessage.control_change(
+                message.channel, message.data1, 127 if is_active else 0)
 
-        self._track_note(rtmidi_message)
+        self._track_note(message)
 
+        previous_event = note_latency.midi_received(
+            arrival_time or time.perf_counter())
         for observer in self.__observers:
-            observer.received_midi(rtmidi_message)
+            observer.received_midi(message)
+        note_latency.midi_dispatched(previous_event)
 
     def register(self, observer):
         """ Register an observer for handling incoming MIDI events (multiple
@@ -98,27 +119,27 @@ class MidiMonitor:
     def end_all_notes(self, channel):
         """End all active notes on a given channel"""
         for pitch in self.__active_notes_by_channel.get(channel, []).copy():
-            message = rtmidi.MidiMessage().noteOff(channel, pitch)
+            message = MidiMessage.note_off(channel, pitch)
             self.handle_midi_message(message)
 
         # TODO: we could also suppress off messages for notes
         # no longer in the active notes list for cleanliness's sake.
         self.__active_notes_by_channel[channel] = set()
 
-    def _track_note(self, rtmidi_message):
+    def _track_note(self, message):
         """Track notes' off/on state"""
-        m = rtmidi_message
-        if not m.isNoteOn() and not m.isNoteOff():
+        kind = message.kind
+        if kind != NOTE_ON and kind != NOTE_OFF:
             return
 
-        channel = m.getChannel()
-        pitch = m.getNoteNumber()
+        channel = message.channel
+        pitch = message.data1
         pitches = self.__active_notes_by_channel.get(channel, None)
         if not pitches:
             pitches = set()
             self.__active_notes_by_channel[channel] = pitches
 
-        if m.isNoteOn():
+        if kind == NOTE_ON:
             pitches.add(pitch)
         else:
             pitches.discard(pitch)
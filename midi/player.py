@@ -1,9 +1,13 @@
 import logging
 
 import mido
+import numpy
 
-from midi.conversions import convert_to_rt
+from midi import events
+from midi import midi_cache
 from midi.conversions import convert_to_ticks
+from midi.conversions import convert_to_ticks_array
+from midi.smf_reader import StreamingMidiFileReader
 from scheduler.scheduler import Task
 
 logger = logging.getLogger("global")
@@ -12,33 +16,67 @@ logger = logging.getLogger("global")
 class PlayMidiTask(Task):
     """ Plays a MIDI file """
     @classmethod
-    def withfile(cls, file_name, midi_monitor, ticks_per_beat):
-        """ Load MIDI from file """
-        midi_file = mido.MidiFile(file_name)
-        return cls.with_mido_events(list(midi_file), midi_monitor,
-                                    ticks_per_beat)
+    def withfile(cls, file_name, midi_monitor, ticks_per_beat, stream=False,
+                 transport=None):
+        """Load MIDI from file.
+
+        By default the file is compiled into an events array that's cached
+        next to it (see midi_cache), so replaying a file is just a memory
+        map. With stream, events are instead read from the file as they're
+        played, for very long files.
+        """
+        if stream:
+            reader = StreamingMidiFileReader(file_name)
+            return PlayMidiTask(reader, midi_monitor=midi_monitor,
+                                tempo=reader.tempo,
+                                ticks_per_beat=ticks_per_beat,
+                                transport=transport)
+        compiled_events, tempo = midi_cache.load_events(file_name,
+                                                        ticks_per_beat)
+        return PlayMidiTask(compiled_events, midi_monitor=midi_monitor,
+                            tempo=tempo, ticks_per_beat=ticks_per_beat,
+                            transport=transport)
 
     @classmethod
     def with_mido_events(cls, mido_events, midi_monitor, ticks_per_beat):
         tempo = cls.__get_tempo(mido_events)
-        return PlayMidiTask(cls.__create_rtmidi_events_by_tick(mido_events,
-                                                               tempo,
-                                                               ticks_per_beat),
+        return PlayMidiTask(cls.__create_events(mido_events, tempo,
+                                                ticks_per_beat),
                             midi_monitor=midi_monitor,
                             tempo=tempo,
                             ticks_per_beat=ticks_per_beat)
 
-    # TODO: abstract 'list of midi notes' into an object
-    def __init__(self, rtmidi_events_by_tick, midi_monitor, tempo,
-                 ticks_per_beat):
-        """ mido_events - List of mido events to play """
+    def __init__(self, events_to_play, midi_monitor, tempo, ticks_per_beat,
+                 loop_ticks=None, transport=None):
+        """
+        Args:
+            events_to_play: a sorted events array (see midi.events), a
+                StreamingMidiFileReader, or a dict of MidiMessages keyed
+                by tick (which may keep growing while it plays, e.g. while
+                the looper is recording).
+            loop_ticks: for looping playback (e.g. synced to a metronome
+                measure), the loop length. When time wraps around, the
+                events at the end of the loop that haven't been played yet
+                are played before starting over.
+            transport: if given, play from the transport's position when
+                started instead of the time the task is ticked with. The
+                file keeps its own tempo: its beats are scaled by the
+                ratio of the transport's tempo to the file's.
+        """
         self.__midi_out = midi_monitor
 
         self.tempo = tempo
         self.ticks_per_beat = ticks_per_beat
-        self.__rtmidi_events_by_tick = rtmidi_events_by_tick
-        self.__last_tick = -1
-
+        self.loop_ticks = loop_ticks
+        self.transport = transport
+        self.__start_position = 0  # transport position when started
+        if isinstance(events_to_play, dict):
+            self.__cursor = _TickDictCursor(events_to_play)
+        elif isinstance(events_to_play, StreamingMidiFileReader):
+            self.__cursor = _StreamCursor(events_to_play, ticks_per_beat)
+        else:
+            self.__cursor = _EventsCursor(events_to_play)
+        self.__last_tick = None
 
     # TODO: put this in a general utility location
     @classmethod
@@ -50,26 +88,30 @@ class PlayMidiTask(Task):
         return tempo_message.tempo
 
     @classmethod
-    def __create_rtmidi_events_by_tick(cls, mido_events, tempo, ticks_per_beat):
-        """Given a list of mido events, keys them by MIDI tick number (relative
-        to first event)"""
-        cumulative_time = 0
-        events_by_tick_dict = {}
-        for event in mido_events:
-            rtmidi_event = convert_to_rt(event)
-            if rtmidi_event is None:
-                continue
-            cumulative_time += event.time
-            current_tick = convert_to_ticks(cumulative_time, tempo,
-                                            ticks_per_beat)
-            current_tick_events = events_by_tick_dict.get(current_tick, [])
-            current_tick_events.append(rtmidi_event)
-            events_by_tick_dict[current_tick] = current_tick_events
-        return events_by_tick_dict
+    def __create_events(cls, mido_events, tempo, ticks_per_beat):
+        """Given a list of mido events (with times in seconds), creates a
+        sorted events array with ticks relative to the first event"""
+        cumulative_times = numpy.cumsum(
+            [mido_event.time for mido_event in mido_events])
+        event_tuples = []
+        event_indexes = []
+        for index, mido_event in enumerate(mido_events):
+            event = events.event_from_mido(mido_event)
+            if event is not None:
+                event_tuples.append((0,) + event)
+                event_indexes.append(index)
+        compiled_events = numpy.array(event_tuples, dtype=events.EVENT_DTYPE)
+        compiled_events["tick"] = convert_to_ticks_array(
+            cumulative_times[numpy.array(event_indexes, dtype=numpy.int64)],
+            tempo, ticks_per_beat)
+        return events.sort_events(compiled_events)
 
     def start(self):
         """ Play the MIDI """
         self.__last_stored_time = 0
+        self.__last_tick = None
+        if self.transport is not None:
+            self.__start_position = self.transport.position()
         self.is_muted = False
         logger.info("MidiPlayer -> play")
 
@@ -82,24 +124,122 @@ class PlayMidiTask(Task):
             # we're done already, so just return
             return
 
-        current_tick = convert_to_ticks(time, self.tempo, self.ticks_per_beat)
-        if current_tick > self.__last_tick + 1:
-            logger.error("tick jump: " + str(current_tick - self.__last_tick))
+        current_tick = self.__current_tick(time)
+        last_tick = self.__last_tick
+        if last_tick is None:
+            # just started: play from the start (time and the transport
+            # position count from when we started), so a late first tick
+            # doesn't drop the first notes. A loop joined part way through
+            # only plays what's due right now
+            last_tick = -1 if self.loop_ticks is None else current_tick - 1
 
-        if current_tick == self.__last_tick:
+        if current_tick == last_tick:
             # don't handle same tick twice (this violates requirement that
             # tasks be deterministic, but it's not a huge deal in this case)
             return
         self.__last_tick = current_tick
 
-        if current_tick not in self.__rtmidi_events_by_tick:
-            return
-        messages_to_send = self.__rtmidi_events_by_tick[current_tick]
-
-        for rtmidi_message in messages_to_send:
-            if rtmidi_message is not None and not self.is_muted:
-                self.__midi_out.send_midi_message(rtmidi_message)
+        # play everything since the last tick, even if ticks were skipped
+        if current_tick > last_tick:
+            messages_to_send = self.__cursor.between(last_tick, current_tick)
+        else:
+            # time wrapped around (looping) or was reset
+            messages_to_send = []
+            if self.loop_ticks is not None:
+                messages_to_send += self.__cursor.between(
+                    last_tick, self.loop_ticks - 1)
+            messages_to_send += self.__cursor.between(-1, current_tick)
+
+        for message in messages_to_send:
+            if message is not None and not self.is_muted:
+                self.__midi_out.send_midi_message(message)
 
     def is_finished(self, time):
-        # TODO: need to get last event to figure out when to finish
-        return False
+        """ Finished once the last event has been played (never when
+        looping, or playing a dict that may still grow) """
+        return self.loop_ticks is None and self.__last_tick is not None and \
+            self.__cursor.is_done(self.__last_tick)
+
+    def __current_tick(self, time):
+        if self.transport is None:
+            return convert_to_ticks(time, self.tempo, self.ticks_per_beat)
+        position = self.transport.position() - self.__start_position
+        beats = position / self.transport.ticks_per_beat * \
+            self.transport.tempo() / self.tempo
+        tick = int(round(beats * self.ticks_per_beat))
+        if self.loop_ticks is not None:
+            tick %= self.loop_ticks
+        return tick
+
+
+class _EventsCursor:
+    """ Finds the events due in a sorted events array by binary search """
+
+    def __init__(self, events_array):
+        self.__events = events_array
+        self.__ticks = events_array["tick"]
+
+    def between(self, after_tick, up_to_tick):
+        """ MidiMessages for events with after_tick < tick <= up_to_tick
+        """
+        start = numpy.searchsorted(self.__ticks, after_tick, side="right")
+        end = numpy.searchsorted(self.__ticks, up_to_tick, side="right")
+        if start >= end:
+            return []
+        return events.events_to_messages(self.__events[start:end])
+
+    def is_done(self, played_tick):
+        """ Whether every event is at or before played_tick """
+        return not len(self.__ticks) or self.__ticks[-1] <= played_tick
+
+
+class _StreamCursor:
+    """ Reads events from a StreamingMidiFileReader as they become due """
+
+    def __init__(self, reader, ticks_per_beat):
+        self.__reader = reader
+        self.__ticks_per_beat = ticks_per_beat
+        self.__restart()
+
+    def between(self, after_tick, up_to_tick):
+        if after_tick < self.__position:
+            self.__restart()  # went back in time, read from the top
+        messages = []
+        while self.__next_event is not None and \
+                self.__next_event[0] <= up_to_tick:
+            tick, kind, channel, data1, data2 = self.__next_event
+            if tick > after_tick:
+                messages.append(events.to_message(kind, channel, data1,
+                                                  data2))
+            self.__next_event = next(self.__events, None)
+        self.__position = up_to_tick
+        return messages
+
+    def is_done(self, played_tick):
+        return self.__next_event is None and self.__position >= played_tick
+
+    def __restart(self):
+        self.__events = self.__reader.events(self.__ticks_per_beat)
+        self.__next_event = next(self.__events, None)
+        self.__position = -1
+
+
+class _TickDictCursor:
+    """ Looks up events in a dict of MidiMessages keyed by tick """
+
+    def __init__(self, events_by_tick):
+        self.__events_by_tick = events_by_tick
+
+    def between(self, after_tick, up_to_tick):
+        events_by_tick = self.__events_by_tick
+        if up_to_tick - after_tick == 1:
+            return list(events_by_tick.get(up_to_tick, ()))
+        messages = []
+        for tick in sorted(events_by_tick):
+            if after_tick < tick <= up_to_tick:
+                messages.extend(events_by_tick[tick])
+        return messages
+
+    def is_done(self, played_tick):
+        return False  # more events may be added
+
@@ -2,10 +2,10 @@ import logging
 import sys
 from time import time
 
-import mido
-
-from midi.conversions import convert_to_mido
 from midi.conversions import convert_to_ticks
+from midi.message import NOTE_OFF
+from midi.message import NOTE_ON
+from midi.recording_writer import recording_writer
 
 logger = logging.getLogger("global")
 
@@ -14,29 +14,31 @@ DEFAULT_TICKS_PER_BEAT = 9600
 
 
 class MidiRecorder:
-    """ Records incoming MIDI """
+    """Records incoming MIDI.
+
+    Events are streamed to a journal on disk by the shared recording writer
+    (see recording_writer.py) as they arrive, and the MIDI file is written
+    from it in the background on stop, so a crash loses at most the last
+    second of a recording.
+    """
 
     def __init__(self, file_name, midi_monitor, tempo=DEFAULT_TEMPO,
-                 ticks_per_beat=DEFAULT_TICKS_PER_BEAT, channel=None):
+                 ticks_per_beat=DEFAULT_TICKS_PER_BEAT, channel=None,
+                 writer=recording_writer):
         self.file_name = file_name
         self.__midi_monitor = midi_monitor
         self.tempo = tempo
         self.ticks_per_beat = ticks_per_beat
         self.channel = channel
-        self.__midi_file = mido.MidiFile(ticks_per_beat=self.ticks_per_beat)
-
-        # add track
-        self.__track = mido.MidiTrack()  # single track implementation for now
-        self.__midi_file.tracks.append(self.__track)
-
-        # set the tempo
-        self.__track.append(mido.MetaMessage('set_tempo', tempo=self.tempo))
+        self.__writer = writer
+        self.__journal = None
         self.__last_message_time = None
 
     def start(self):
         """ Begins recording of all MIDI events """
         logger.info("MidiRecorder: begin recording midi events")
-        self.recorded_notes = []
+        self.__journal = self.__writer.open(self.file_name, self.tempo,
+                                            self.ticks_per_beat)
         self.__midi_monitor.register(self)
         self.__start_time = time()
         self.__last_message_time = self.__start_time
@@ -48,52 +50,57 @@ class MidiRecorder:
         return self.__last_message_time is not None
 
     def stop(self, save_to_file=True):
+        """ Stops recording. The file is saved by the writer thread shortly
+        after """
         logger.info("MidiRecorder: finished recording midi events, "
-                    "saved recording to " + self.file_name)
+                    "saving recording to " + self.file_name)
         self.__midi_monitor.unregister(self)
-        if save_to_file:
-            self.__midi_file.save(self.file_name)
-        self.recorded_notes = list(self.__midi_file)
+        self.__writer.close(self.__journal, save=save_to_file)
+        self.__journal = None
         self.__last_message_time = None
 
-    def received_midi(self, rtmidi_message):
-        if self.channel is not None and \
-           self.channel != rtmidi_message.getChannel():
+    def received_midi(self, message):
+        if self.channel is not None and self.channel != message.channel:
             return
 
-        if not is_recognized_rtmidi_message(rtmidi_message):
+        if not is_recognized_message(message):
             logger.error("received an unknown midi message")
             return
 
-        if (rtmidi_message.isController() and
-                rtmidi_message.getControllerNumber() == 64):
+        if message.is_sustain_pedal():
             # values taken from
             # https://www.cs.cmu.edu/~music/cmsip/readings/Standard-MIDI-file-format-updated.pdf
-            is_pedal_on = rtmidi_message.getControllerValue() >= 64
+            is_pedal_on = message.data2 >= 64
             if self.__last_saved_is_pedal_on == is_pedal_on:
                 # ignore pedal events that don't actually change its on state
                 return
             self.__last_saved_is_pedal_on = is_pedal_on
 
-        # logger.info("Recorder received msg: " + str(rtmidi_message))
+        # logger.info("Recorder received msg: " + str(message))
+
+        channel = message.channel
+        if channel > 0x0F:
+            logger.error("can't record a message on channel " + str(channel))
+            return
 
         now = time()
         tick_delta = convert_to_ticks(now - self.__last_message_time,
                                       self.tempo, self.ticks_per_beat)
         self.__last_message_time = now
 
-        mido_message = convert_to_mido(rtmidi_message, tick_delta)
-        self.__track.append(mido_message)
+        # channels are written as they are (see midi.events)
+        self.__writer.append(self.__journal, tick_delta,
+                             message.kind | channel, message.data1,
+                             message.data2)
 
 
-def is_recognized_rtmidi_message(rtmidi_message):
-    """ Is the input type string a midi type we recognize """
-    m = rtmidi_message
-    if m.isNoteOn() or m.isNoteOff():
+def is_recognized_message(message):
+    """ Is the message a kind of midi message we record """
+    if message.kind == NOTE_ON or message.kind == NOTE_OFF:
+        return True
+    elif message.is_sustain_pedal():
         return True
-    elif m.isController():
-        if m.getControllerNumber() == 64:  # sustain pedal
-            return True
 
-    logger.error("received unknown/unimplemented midi message: " + str(m))
+    logger.error("received unknown/unimplemented midi message: " +
+                 str(message))
     return False
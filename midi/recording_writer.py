@@ -0,0 +1,229 @@
+import glob
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+
+logger = logging.getLogger("global")
+
+"""Crash-safe streaming of MIDI recordings to disk.
+
+Recorders hand each event (delta ticks plus its 3 MIDI bytes) to a shared
+RecordingWriter, whose background thread appends it to a journal file next
+to the recording ('<file>.journal') and flushes journals to disk every
+flush_interval seconds. The journal body is already in SMF track encoding,
+so finishing a recording is just wrapping it in a header and a single
+track, and nothing grows in memory however long a session runs.
+
+If the app dies mid-recording, the journal is left behind and
+recover_recordings() turns it into the MIDI file it would have saved (up
+to the last complete event that reached disk).
+"""
+
+JOURNAL_SUFFIX = ".journal"
+_JOURNAL_MAGIC = b"LFJ1"
+_JOURNAL_HEADER = struct.Struct("<4sII")  # magic, tempo, ticks per beat
+_EVENT_SIZE = 3  # status + 2 data bytes (all events we record have 2)
+
+_META_TEMPO = b"\xff\x51\x03"
+_END_OF_TRACK = b"\x00\xff\x2f\x00"
+
+
+def journal_file_name(file_name):
+    return file_name + JOURNAL_SUFFIX
+
+
+def encode_variable_length(value):
+    """ SMF variable length quantity bytes for a non-negative int """
+    encoded = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        encoded.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(encoded)
+
+
+class _Journal:
+    """ A recording being written. Only the writer thread touches file """
+
+    def __init__(self, file_name, tempo, ticks_per_beat):
+        self.file_name = file_name
+        self.journal_file_name = journal_file_name(file_name)
+        self.tempo = tempo
+        self.ticks_per_beat = ticks_per_beat
+        self.file = None
+        self.is_dirty = False
+
+
+class RecordingWriter:
+    """Writes recordings' journals from one background thread shared by all
+    recorders (e.g. the four looper channel recorders), so the main loop
+    never touches the disk.
+
+    The queue is unbounded: recorded notes are never dropped, and MIDI input
+    is far too slow to outrun the disk.
+    """
+
+    def __init__(self, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        self.__queue = queue.Queue()
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__journals = []  # open journals, only used by the thread
+
+    def open(self, file_name, tempo, ticks_per_beat):
+        """ Start a journal for a recording to be saved as file_name.
+        Returns the handle to append to and close """
+        journal = _Journal(file_name, tempo, ticks_per_beat)
+        self.__ensure_running()
+        self.__queue.put((self.__open, journal))
+        return journal
+
+    def append(self, journal, tick_delta, status, data1, data2):
+        """ Queue an event for writing. Never blocks """
+        self.__queue.put((self.__append,
+                          journal, tick_delta, status, data1, data2))
+
+    def close(self, journal, save=True):
+        """ Finish a journal: turn it into its MIDI file (or discard it if
+        not save) once everything queued before has been written """
+        self.__queue.put((self.__close, journal, save))
+
+    def stop(self):
+        """ Write everything queued (including finishing closed journals)
+        and stop the thread. Journals still open stay on disk """
+        with self.__lock:
+            thread = self.__thread
+            self.__thread = None
+        if thread is not None:
+            self.__queue.put(None)
+            thread.join()
+
+    def __ensure_running(self):
+        with self.__lock:
+            if self.__thread is not None:
+                return
+            self.__thread = threading.Thread(target=self.__run,
+                                             name="recording writer")
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def __run(self):
+        last_flush_time = time.time()
+        while True:
+            timeout = max(0, last_flush_time + self.flush_interval -
+                          time.time())
+            try:
+                job = self.__queue.get(timeout=timeout)
+            except queue.Empty:
+                job = ()
+            if job is None:
+                break
+            if job:
+                try:
+                    job[0](*job[1:])
+                except Exception as error:  # noqa
+                    # keep writing other recordings
+                    logger.error("recording writer failed: " + str(error))
+            if time.time() - last_flush_time >= self.flush_interval:
+                self.__flush()
+                last_flush_time = time.time()
+        self.__flush()
+        for journal in self.__journals:
+            journal.file.close()
+        self.__journals = []
+
+    def __open(self, journal):
+        journal.file = open(journal.journal_file_name, "wb")
+        journal.file.write(_JOURNAL_HEADER.pack(
+            _JOURNAL_MAGIC, journal.tempo, journal.ticks_per_beat))
+        journal.is_dirty = True
+        self.__journals.append(journal)
+
+    def __append(self, journal, tick_delta, status, data1, data2):
+        journal.file.write(encode_variable_length(tick_delta) +
+                           bytes((status, data1, data2)))
+        journal.is_dirty = True
+
+    def __close(self, journal, save):
+        self.__journals.remove(journal)
+        journal.file.close()
+        if save:
+            finalize_journal(journal.journal_file_name, journal.file_name)
+            logger.info("saved recording to " + journal.file_name)
+        else:
+            os.remove(journal.journal_file_name)
+
+    def __flush(self):
+        for journal in self.__journals:
+            if journal.is_dirty:
+                journal.file.flush()
+                os.fsync(journal.file.fileno())
+                journal.is_dirty = False
+
+
+def finalize_journal(journal_name, file_name):
+    """ Write a journal's recording as a MIDI file (replacing file_name
+    atomically) and delete the journal. A truncated last event, from a
+    crash mid-write, is left out """
+    with open(journal_name, "rb") as journal_file:
+        header = journal_file.read(_JOURNAL_HEADER.size)
+        body = journal_file.read()
+    if len(header) < _JOURNAL_HEADER.size:
+        raise ValueError(journal_name + " has no journal header")
+    magic, tempo, ticks_per_beat = _JOURNAL_HEADER.unpack(header)
+    if magic != _JOURNAL_MAGIC:
+        raise ValueError(journal_name + " isn't a recording journal")
+
+    body = body[:_complete_length(body)]
+    track = b"\x00" + _META_TEMPO + tempo.to_bytes(3, "big") + body + \
+        _END_OF_TRACK
+    # format 1 with a single track, like mido saves by default
+    midi_bytes = b"MThd" + struct.pack(">IHHH", 6, 1, 1, ticks_per_beat) + \
+        b"MTrk" + struct.pack(">I", len(track)) + track
+
+    with open(file_name + ".tmp", "wb") as midi_file:
+        midi_file.write(midi_bytes)
+        midi_file.flush()
+        os.fsync(midi_file.fileno())
+    os.replace(file_name + ".tmp", file_name)
+    os.remove(journal_name)
+
+
+def _complete_length(body):
+    """ Length of the journal body up to its last complete event """
+    position = 0
+    complete = 0
+    while position < len(body):
+        # skip the variable length delta
+        while position < len(body) and body[position] & 0x80:
+            position += 1
+        position += 1 + _EVENT_SIZE
+        if position > len(body):
+            break
+        complete = position
+    return complete
+
+
+def recover_recordings(directory="."):
+    """ Turn journals left behind by a crash into their MIDI files. Returns
+    the recovered file names """
+    recovered = []
+    for journal_name in sorted(glob.glob(
+            os.path.join(directory, "*" + JOURNAL_SUFFIX))):
+        file_name = journal_name[:-len(JOURNAL_SUFFIX)]
+        try:
+            finalize_journal(journal_name, file_name)
+        except (OSError, ValueError) as error:
+            logger.error("couldn't recover " + journal_name + ": " +
+                         str(error))
+            continue
+        logger.warning("recovered unsaved recording " + file_name)
+        recovered.append(file_name)
+    return recovered
+
+
+# shared by all recorders (see span_profiler)
+recording_writer = RecordingWriter()
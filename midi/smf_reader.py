@@ -0,0 +1,250 @@
+import heapq
+import logging
+import struct
+
+import numpy
+
+from midi.conversions import convert_to_seconds_with_tempo_map
+from midi.conversions import convert_to_ticks
+from midi.conversions import convert_to_ticks_array
+from midi import events
+
+logger = logging.getLogger("global")
+
+"""Streaming Standard MIDI File reader.
+
+mido parses a whole file into message objects before anything can be
+played. This reader instead walks each track's bytes lazily (one open file
+per track, merged by time), so even very long recordings start playing
+immediately with constant memory.
+
+Timing matches iterating a mido.MidiFile: file ticks are turned into
+seconds following the file's tempo changes, then into playback ticks at the
+file's first tempo (like PlayMidiTask always has). events_array() does
+the same conversion for a whole file in one go.
+"""
+
+DEFAULT_TEMPO = 500000
+
+_META = 0xFF
+_SYSEX = 0xF0
+_SYSEX_ESCAPE = 0xF7
+_META_TEMPO = 0x51
+_META_END_OF_TRACK = 0x2F
+
+_NOTE_OFF = 0x80
+_NOTE_ON = 0x90
+_CONTROL_CHANGE = 0xB0
+# channel messages with a single data byte (program change, channel
+# pressure), the rest have two
+_ONE_DATA_BYTE = (0xC0, 0xD0)
+
+
+class SmfError(Exception):
+    """ The file isn't a valid (or supported) Standard MIDI File """
+    pass
+
+
+class _TrackReader:
+    """ Reads one track chunk's events, buffered, from its own file """
+
+    def __init__(self, file_name, offset, length, buffer_size=65536):
+        self.__file = open(file_name, "rb")
+        self.__file.seek(offset)
+        self.__remaining = length
+        self.__buffer = b""
+        self.__position = 0
+        self.__buffer_size = buffer_size
+
+    def close(self):
+        self.__file.close()
+
+    def at_end(self):
+        return self.__position >= len(self.__buffer) and \
+            self.__remaining <= 0
+
+    def read_byte(self):
+        if self.__position >= len(self.__buffer):
+            self.__fill()
+        byte = self.__buffer[self.__position]
+        self.__position += 1
+        return byte
+
+    def read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            if self.__position >= len(self.__buffer):
+                self.__fill()
+            chunk = self.__buffer[self.__position:
+                                  self.__position + size - len(data)]
+            self.__position += len(chunk)
+            data.extend(chunk)
+        return bytes(data)
+
+    def read_variable_length(self):
+        value = 0
+        while True:
+            byte = self.read_byte()
+            value = (value << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return value
+
+    def __fill(self):
+        if self.__remaining <= 0:
+            raise SmfError("track ended in the middle of an event")
+        self.__buffer = self.__file.read(
+            min(self.__buffer_size, self.__remaining))
+        if not self.__buffer:
+            raise SmfError("file ended in the middle of a track")
+        self.__remaining -= len(self.__buffer)
+        self.__position = 0
+
+
+def _track_events(file_name, track_index, offset, length):
+    """ Yields (file tick, track index, sequence, tempo or None, event or
+    None) for every message in a track but its end. Messages that are
+    neither tempo changes nor playable still count as steps in time (like
+    they do iterating a mido.MidiFile) """
+    reader = _TrackReader(file_name, offset, length)
+    try:
+        tick = 0
+        sequence = 0
+        running_status = None
+        while not reader.at_end():
+            tick += reader.read_variable_length()
+            status = reader.read_byte()
+            if status < 0x80:
+                # running status: the byte we read is already data
+                if running_status is None:
+                    raise SmfError("data byte without a status")
+                data1 = status
+                status = running_status
+            elif status < 0xF0:
+                running_status = status
+                data1 = reader.read_byte()
+            else:
+                running_status = None
+                data1 = None
+
+            tempo = None
+            event = None
+            if status == _META:
+                meta_type = reader.read_byte()
+                data = reader.read(reader.read_variable_length())
+                if meta_type == _META_END_OF_TRACK:
+                    return
+                if meta_type == _META_TEMPO and len(data) == 3:
+                    tempo = int.from_bytes(data, "big")
+            elif status in (_SYSEX, _SYSEX_ESCAPE):
+                reader.read(reader.read_variable_length())
+            else:
+                kind = status & 0xF0
+                channel = status & 0x0F
+                data2 = None if kind in _ONE_DATA_BYTE else reader.read_byte()
+                if kind == _NOTE_ON:
+                    event = (events.NOTE_ON, channel, data1, data2)
+                elif kind == _NOTE_OFF:
+                    event = (events.NOTE_OFF, channel, data1, 0)
+                elif kind == _CONTROL_CHANGE:
+                    event = (events.CONTROL_CHANGE, channel, data1, data2)
+            yield (tick, track_index, sequence, tempo, event)
+            sequence += 1
+    finally:
+        reader.close()
+
+
+class StreamingMidiFileReader:
+    """Reads a MIDI file's playable events lazily.
+
+    Attributes:
+        tempo: the file's first tempo (the tempo events are played at).
+        file_ticks_per_beat: the file's own tick resolution.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.__tracks = []  # (offset, length) of each track chunk
+        with open(file_name, "rb") as midi_file:
+            header = midi_file.read(14)
+            if len(header) < 14 or header[:4] != b"MThd":
+                raise SmfError(file_name + " isn't a MIDI file")
+            header_length, _, track_count, division = struct.unpack(
+                ">IHHH", header[4:14])
+            if division & 0x8000:
+                raise SmfError("SMPTE timing isn't supported")
+            self.file_ticks_per_beat = division
+            midi_file.seek(8 + header_length)
+            while len(self.__tracks) < track_count:
+                chunk_header = midi_file.read(8)
+                if len(chunk_header) < 8:
+                    break
+                chunk_type, length = struct.unpack(">4sI", chunk_header)
+                if chunk_type == b"MTrk":
+                    self.__tracks.append((midi_file.tell(), length))
+                midi_file.seek(length, 1)
+        self.tempo = self.__first_tempo()
+
+    def events(self, ticks_per_beat):
+        """ Yields (tick, kind, channel, data1, data2) for every playable
+        event in time order, with ticks at ticks_per_beat (see above) """
+        tempo = DEFAULT_TEMPO
+        seconds = 0.0
+        last_file_tick = 0
+        for file_tick, _, _, new_tempo, event in self.__merged():
+            if file_tick > last_file_tick:
+                # same arithmetic as mido, so ticks round the same way
+                seconds += (file_tick - last_file_tick) * \
+                    (tempo * 1e-6 / self.file_ticks_per_beat)
+                last_file_tick = file_tick
+            if new_tempo is not None:
+                tempo = new_tempo
+            if event is not None:
+                yield (convert_to_ticks(seconds, self.tempo,
+                                        ticks_per_beat),) + event
+
+    def events_array(self, ticks_per_beat):
+        """ All of events() as an events array, with every event's tick
+        converted at once (instead of one at a time) """
+        file_ticks = []
+        tempo_ticks = []
+        tempos = []
+        event_indexes = []
+        event_rows = []
+        for index, (file_tick, _, _, tempo, event) in enumerate(
+                self.__merged()):
+            file_ticks.append(file_tick)
+            if tempo is not None:
+                tempo_ticks.append(file_tick)
+                tempos.append(tempo)
+            if event is not None:
+                event_indexes.append(index)
+                event_rows.append((0,) + event)
+        # every message is a step in time (see _track_events), so convert
+        # all their ticks and keep the events'
+        seconds = convert_to_seconds_with_tempo_map(
+            file_ticks, tempo_ticks, tempos, self.file_ticks_per_beat,
+            initial_tempo=DEFAULT_TEMPO)
+        compiled_events = numpy.array(event_rows, dtype=events.EVENT_DTYPE)
+        compiled_events["tick"] = convert_to_ticks_array(
+            seconds[numpy.array(event_indexes, dtype=numpy.int64)],
+            self.tempo, ticks_per_beat)
+        return compiled_events
+
+    def __merged(self):
+        return heapq.merge(*[
+            _track_events(self.file_name, index, offset, length)
+            for index, (offset, length) in enumerate(self.__tracks)])
+
+    def __first_tempo(self):
+        """ Tempo set at the very start of the file (before any notes) """
+        merged = self.__merged()
+        try:
+            for file_tick, _, _, tempo, _ in merged:
+                if tempo is not None:
+                    return tempo
+                break  # something else came first
+        finally:
+            merged.close()
+        logger.error("unexpected: " + self.file_name + " doesn't start "
+                     "with a tempo, using the default")
+        return DEFAULT_TEMPO
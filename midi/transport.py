@@ -0,0 +1,140 @@
+import bisect
+import logging
+import time
+
+logger = logging.getLogger("global")
+
+"""Musical time (ticks, beats, measures) from a monotonic clock.
+
+A Transport answers "where are we?" from the clock whenever it's asked,
+instead of counting scheduler ticks, so a late main loop pass just sees a
+later position (and a busy loop can't drift). Tempo changes are kept in a
+TempoMap; with a constant tempo a position costs a multiplication, with
+tempo changes a binary search over them.
+
+Usage:
+    transport = Transport(TempoMap(tempo=500000, ticks_per_beat=50),
+                          beats_per_measure=4)
+    transport.start()
+    ...
+    transport.tick(), transport.beat(), transport.measure_phase()
+"""
+
+
+class TempoMap:
+    """Tempo changes over (musical) ticks.
+
+    Tempos are in MIDI's microseconds per beat (e.g. 500000 for 120bpm),
+    ticks at ticks_per_beat.
+    """
+
+    def __init__(self, tempo, ticks_per_beat):
+        self.ticks_per_beat = ticks_per_beat
+        # parallel lists, one entry per tempo segment
+        self.__ticks = [0]
+        self.__seconds = [0.0]
+        self.__tempos = [tempo]
+
+    @property
+    def tempo(self):
+        """ The first tempo """
+        return self.__tempos[0]
+
+    def set_tempo(self, tick, tempo):
+        """ Change the tempo from tick onwards (replacing any later
+        changes) """
+        seconds = self.seconds_at(tick)
+        index = bisect.bisect_left(self.__ticks, tick)
+        del self.__ticks[index:]
+        del self.__seconds[index:]
+        del self.__tempos[index:]
+        self.__ticks.append(tick)
+        self.__seconds.append(seconds)
+        self.__tempos.append(tempo)
+
+    def tempo_at(self, tick):
+        return self.__tempos[self.__segment(self.__ticks, tick)]
+
+    def seconds_at(self, tick):
+        """ Seconds from tick 0 to tick (a float is fine) """
+        index = self.__segment(self.__ticks, tick)
+        return self.__seconds[index] + (tick - self.__ticks[index]) * \
+            self.__tempos[index] * 1e-6 / self.ticks_per_beat
+
+    def ticks_at(self, seconds):
+        """ (Fractional) tick reached after seconds """
+        index = self.__segment(self.__seconds, seconds)
+        return self.__ticks[index] + (seconds - self.__seconds[index]) * \
+            self.ticks_per_beat / (self.__tempos[index] * 1e-6)
+
+    @staticmethod
+    def __segment(starts, value):
+        """ Index of the tempo segment value (ticks or seconds) is in """
+        if len(starts) == 1:
+            return 0  # constant tempo, the common case
+        return max(0, bisect.bisect_right(starts, value) - 1)
+
+
+class Transport:
+    """ The position of a piece of music being played, read from a clock
+    (see above) """
+
+    def __init__(self, tempo_map, beats_per_measure=4,
+                 clock=time.perf_counter):
+        self.tempo_map = tempo_map
+        self.beats_per_measure = beats_per_measure
+        self.clock = clock
+        self.__start_time = None
+
+    def start(self):
+        """ (Re)start from the beginning """
+        self.__start_time = self.clock()
+
+    def is_started(self):
+        return self.__start_time is not None
+
+    @property
+    def ticks_per_beat(self):
+        return self.tempo_map.ticks_per_beat
+
+    def ticks_per_measure(self):
+        return self.ticks_per_beat * self.beats_per_measure
+
+    def elapsed(self):
+        """ Seconds since start (0 if not started) """
+        if self.__start_time is None:
+            return 0.0
+        return self.clock() - self.__start_time
+
+    def clock_time_at(self, tick):
+        """ Clock time at which tick is (or was) reached, for scheduling
+        things ahead of time (see metronome_audio.py) """
+        return self.__start_time + self.tempo_map.seconds_at(tick)
+
+    def position(self):
+        """ Fractional ticks since start """
+        return self.tempo_map.ticks_at(self.elapsed())
+
+    def tick(self):
+        """ Current tick (the nearest, like convert_to_ticks) """
+        return int(round(self.position()))
+
+    def beat(self):
+        """ Fractional beats since start """
+        return self.position() / self.ticks_per_beat
+
+    def measure_phase(self):
+        """ Progress through the current measure, from 0 up to 1 """
+        return self.beat() / self.beats_per_measure % 1.0
+
+    def tempo(self):
+        """ Tempo right now """
+        return self.tempo_map.tempo_at(self.position())
+
+    def seconds_per_measure(self):
+        """ Length of a measure at the current tempo """
+        return self.tempo() * 1e-6 * self.beats_per_measure
+
+    def set_tempo(self, tempo):
+        """ Change tempo from now on """
+        self.tempo_map.set_tempo(self.position(), tempo)
@@ -0,0 +1,223 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+from midi import midi_cache
+from midi.editor import ChannelSplitFilter
+from midi.editor import MidiEditor
+from midi.editor import QuantizeFilter
+from midi.editor import RangeVelocityFilter
+from midi.editor import TransposeFilter
+
+logger = logging.getLogger("global")
+
+"""Batch processing of MIDI files (e.g. every rehearsal recording), in
+parallel worker processes instead of one at a time inside the controller.
+
+Each file is loaded once and saved through every filter chain as
+'<name>_<chain name>.mid' (see MidiEditor). Chains are given as
+NAME=FILTER[+FILTER...], where a filter is one of:
+    velocity:LOW-HIGH:MULTIPLIER  scale velocity of notes LOW to HIGH-1
+    transpose:SEMITONES
+    quantize:PER_BEAT[:STRENGTH]  e.g. quantize:4 for sixteenth notes
+    split-channels                each channel's notes on its own track
+
+Without any chains, the baseline/melody split of the edit MIDI file
+shortcut is used. With --prerender, the playback cache of the input and
+every output is compiled too (see midi_cache.py), so the show starts
+playing them without parsing.
+
+Usage:
+    python midi_batch.py rehearsals/ --jobs 4 --prerender
+    python midi_batch.py recording1.mid --chain low=transpose:-12+quantize:4
+"""
+
+DEFAULT_CHAINS = [
+    ("baseline", ["velocity:0-70:0"]),
+    ("melody", ["velocity:70-255:0"]),
+]
+
+# ticks_per_beat the controller plays files at (see
+# LightfulKeyboardShortcuts.play_recorded_midi_file)
+DEFAULT_PLAYBACK_TICKS_PER_BEAT = 50
+
+
+def parse_chain(chain_spec):
+    """ (name, filter specs) for a NAME=FILTER[+FILTER...] chain, raising
+    ValueError if it's invalid """
+    name, separator, filters = chain_spec.partition("=")
+    if not separator or not name or not filters:
+        raise ValueError("expected NAME=FILTER[+FILTER...]: " + chain_spec)
+    filter_specs = filters.split("+")
+    for filter_spec in filter_specs:
+        create_filter(filter_spec, ticks_per_beat=1)  # validate
+    return name, filter_specs
+
+
+def create_filter(filter_spec, ticks_per_beat):
+    """ MidiFilter for a filter spec (see above) """
+    name, _, arguments = filter_spec.partition(":")
+    arguments = arguments.split(":") if arguments else []
+    try:
+        if name == "velocity" and len(arguments) == 2:
+            low, high = arguments[0].split("-")
+            return RangeVelocityFilter(range(int(low), int(high)),
+                                       float(arguments[1]))
+        elif name == "transpose" and len(arguments) == 1:
+            return TransposeFilter(int(arguments[0]))
+        elif name == "quantize" and len(arguments) in (1, 2):
+            grid = max(1, ticks_per_beat // int(arguments[0]))
+            strength = float(arguments[1]) if len(arguments) == 2 else 1.0
+            return QuantizeFilter(grid, strength)
+        elif name == "split-channels" and not arguments:
+            return ChannelSplitFilter()
+    except ValueError:
+        pass
+    raise ValueError("invalid filter: " + filter_spec)
+
+
+def output_file_name(file_name, chain_name, output_directory=None):
+    stem, extension = os.path.splitext(file_name)
+    if output_directory is not None:
+        stem = os.path.join(output_directory, os.path.basename(stem))
+    return "{}_{}{}".format(stem, chain_name, extension)
+
+
+def process_file(file_name, chains, output_directory=None,
+                 prerender_ticks_per_beat=None):
+    """ Apply every chain to a file (in a worker process). Returns a dict
+    with the outputs written and the time each step took """
+    timings = []
+    start = time.perf_counter()
+    editor = MidiEditor(file_name)
+    timings.append(("load", time.perf_counter() - start))
+
+    outputs = []
+    for chain_name, filter_specs in chains:
+        step_start = time.perf_counter()
+        filters = [create_filter(filter_spec, editor.ticks_per_beat)
+                   for filter_spec in filter_specs]
+        output = output_file_name(file_name, chain_name, output_directory)
+        editor.save(output, filters)
+        outputs.append(output)
+        timings.append((chain_name, time.perf_counter() - step_start))
+
+    if prerender_ticks_per_beat is not None:
+        step_start = time.perf_counter()
+        for midi_file_name in [file_name] + outputs:
+            midi_cache.load_events(midi_file_name, prerender_ticks_per_beat)
+        timings.append(("prerender", time.perf_counter() - step_start))
+
+    return {
+        "file_name": file_name,
+        "outputs": outputs,
+        "timings": timings,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def find_midi_files(paths, chains, recursive=False):
+    """ MIDI files given directly or found in the given directories,
+    leaving out earlier outputs of the chains """
+    output_suffixes = tuple("_" + chain_name for chain_name, _ in chains)
+    file_names = []
+    for path in paths:
+        if not os.path.isdir(path):
+            file_names.append(path)
+            continue
+        for directory, subdirectories, names in os.walk(path):
+            if not recursive:
+                subdirectories[:] = []
+            for name in sorted(names):
+                stem, extension = os.path.splitext(name)
+                if extension.lower() in (".mid", ".midi") and \
+                        not stem.endswith(output_suffixes):
+                    file_names.append(os.path.join(directory, name))
+    return file_names
+
+
+def run_batch(file_names, chains, jobs=None, output_directory=None,
+              prerender_ticks_per_beat=None, progress=print):
+    """ Process files in a pool of jobs worker processes (one per CPU by
+    default), reporting each file as it finishes. Returns (results,
+    failures) where failures are (file name, error) """
+    results = []
+    failures = []
+    if output_directory is not None:
+        os.makedirs(output_directory, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(process_file, file_name, chains,
+                            output_directory, prerender_ticks_per_beat):
+            file_name for file_name in file_names}
+        for done_count, future in enumerate(as_completed(futures), 1):
+            file_name = futures[future]
+            try:
+                result = future.result()
+            except Exception as error:  # noqa
+                failures.append((file_name, error))
+                progress("[{}/{}] {} failed: {}: {}".format(
+                    done_count, len(futures), file_name,
+                    type(error).__name__, error))
+                continue
+            results.append(result)
+            progress("[{}/{}] {} {:.2f}s ({})".format(
+                done_count, len(futures), file_name, result["seconds"],
+                ", ".join("{} {:.0f}ms".format(step, seconds * 1000)
+                          for step, seconds in result["timings"])))
+    return results, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Apply MIDI editor filter chains to many files in "
+        "parallel")
+    parser.add_argument("paths", nargs="+",
+                        help="MIDI files and/or directories of them")
+    parser.add_argument("--chain", action="append", type=_chain_argument,
+                        help="NAME=FILTER[+FILTER...], repeatable (default: "
+                        "the baseline/melody split)")
+    parser.add_argument("--jobs", type=int,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--output-dir",
+                        help="write outputs here instead of next to inputs")
+    parser.add_argument("--recursive", action="store_true",
+                        help="also look for MIDI files in subdirectories")
+    parser.add_argument("--prerender", action="store_true",
+                        help="also compile the playback cache of every "
+                        "input and output")
+    parser.add_argument("--ticks-per-beat", type=int,
+                        default=DEFAULT_PLAYBACK_TICKS_PER_BEAT,
+                        help="ticks per beat to prerender playback at")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    chains = args.chain or DEFAULT_CHAINS
+    file_names = find_midi_files(args.paths, chains, args.recursive)
+    if not file_names:
+        print("no MIDI files found")
+        return 1
+
+    start = time.perf_counter()
+    results, failures = run_batch(
+        file_names, chains, jobs=args.jobs, output_directory=args.output_dir,
+        prerender_ticks_per_beat=args.ticks_per_beat if args.prerender
+        else None)
+    print("processed {} files ({} failed) in {:.2f}s".format(
+        len(file_names), len(failures), time.perf_counter() - start))
+    return 1 if failures else 0
+
+
+def _chain_argument(chain_spec):
+    try:
+        return parse_chain(chain_spec)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
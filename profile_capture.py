@@ -0,0 +1,144 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger("global")
+
+
+class ProfileCapture:
+    """Profiles the running app on demand, e.g. from a keyboard shortcut in
+    the middle of a performance, so the state that causes a slowdown isn't
+    lost restarting with profiling on.
+
+    A background thread samples the main loop thread's call stack every
+    sample_interval seconds, which costs the main loop next to nothing. The
+    samples are written as collapsed stacks ('outer;inner;innermost count'
+    lines), the input format of flamegraph.pl and https://www.speedscope.app.
+
+    With use_cprofile, the profiled thread also runs cProfile for exact
+    call counts and times, written as a pstats file (python -m pstats, or
+    snakeviz). cProfile roughly doubles the cost of Python function calls
+    while it's on.
+
+    Usage:
+        capture = ProfileCapture()
+        capture.start()  # on the thread to profile
+        ...
+        capture.stop()  # writes lightful_profile_<timestamp>.* files
+    """
+
+    def __init__(self, sample_interval=0.005, file_prefix="lightful_profile"):
+        self.sample_interval = sample_interval
+        self.file_prefix = file_prefix
+        self.sample_count = 0
+        self.__samples = Counter()
+        self.__profile = None
+        self.__thread = None
+        self.__running = False
+        self.__target_thread_id = None
+        self.__start_time = None
+
+    @property
+    def is_running(self):
+        return self.__running
+
+    def start(self, use_cprofile=False):
+        """ Start profiling the calling thread """
+        if self.__running:
+            return
+        self.__samples = Counter()
+        self.sample_count = 0
+        self.__target_thread_id = threading.get_ident()
+        self.__start_time = time.strftime("%Y%m%d_%H%M%S")
+        self.__running = True
+
+        self.__thread = threading.Thread(target=self.__sample_loop,
+                                         name="profile sampler")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+        if use_cprofile:
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+        logger.info("profile capture started (sampling every {} ms{})".format(
+            self.sample_interval * 1000, ", with cProfile" if use_cprofile
+            else ""))
+
+    def stop(self):
+        """ Stop profiling and write the results, returns the names of the
+        files written """
+        if not self.__running:
+            return []
+        self.__running = False
+        if self.__profile is not None:
+            self.__profile.disable()
+        self.__thread.join()
+        self.__thread = None
+
+        file_names = []
+        base_name = self.file_prefix + "_" + self.__start_time
+        collapsed_file_name = base_name + ".collapsed.txt"
+        self.write_collapsed_stacks(collapsed_file_name)
+        file_names.append(collapsed_file_name)
+        logger.info("wrote " + str(self.sample_count) + " stack samples to " +
+                    collapsed_file_name)
+
+        if self.__profile is not None:
+            pstats_file_name = base_name + ".pstats"
+            self.__profile.dump_stats(pstats_file_name)
+            file_names.append(pstats_file_name)
+            logger.info("wrote cProfile stats to " + pstats_file_name)
+            self.__log_top_functions()
+            self.__profile = None
+        return file_names
+
+    def toggle(self, use_cprofile=False):
+        if self.__running:
+            self.stop()
+        else:
+            self.start(use_cprofile=use_cprofile)
+
+    def write_collapsed_stacks(self, file_name):
+        with open(file_name, "w") as collapsed_file:
+            for stack, count in self.__samples.most_common():
+                collapsed_file.write(
+                    ";".join(_frame_name(code) for code in stack) + " " +
+                    str(count) + "\n")
+
+    def __sample_loop(self):
+        while self.__running:
+            time.sleep(self.sample_interval)
+            frame = sys._current_frames().get(self.__target_thread_id)
+            if frame is None:
+                continue  # profiled thread is gone
+            # code objects are cheap to hash, so names are only formatted
+            # when writing
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            self.__samples[tuple(stack)] += 1
+            self.sample_count += 1
+
+    def __log_top_functions(self, count=10):
+        stream = io.StringIO()
+        stats = pstats.Stats(self.__profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(count)
+        for line in stream.getvalue().splitlines():
+            if line.strip():
+                logger.info(line)
+
+
+def _frame_name(code):
+    return os.path.basename(code.co_filename) + ":" + code.co_name
+
+
+# shared capture for the whole app (see span_profiler)
+profile_capture = ProfileCapture()
@@ -1,69 +1,225 @@
+import functools
+import json
 import logging
+import os
+import threading
 import time
+from array import array
 from collections import OrderedDict
 
 logger = logging.getLogger("global")
 
 
-class Profiler:
+class _NullSpan:
+    """ Span handed out while profiling is disabled. Does nothing """
 
-    def __init__(self, seconds_per_average=2):
-        self.last_recorded_time = time.time()
-        self.times_by_id = OrderedDict()
-        self.seconds_per_average = seconds_per_average
-        self.last_printed_average_time = None
-        self.enabled = True
+    def __enter__(self):
+        return self
 
-    def time(self, identifier):
-        """ Print delta time since last time() call """
-        # TODO: im sure I can think of a better name of this function...
-        if not self.enabled:
-            return
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
 
-        logger.info(str(identifier) + ": " +
-                    str(self.increment_time_and_get_delta()))
 
-    def avg(self, identifier):
-        """ Print average time deltas for identifier using frequency specified
-        by seconds_per_average. For use with heavily looping areas """
-        if not self.enabled:
-            return
+_NULL_SPAN = _NullSpan()
 
-        delta_time = self.increment_time_and_get_delta()
 
-        if identifier not in self.times_by_id:
-            self.times_by_id[identifier] = (0, 0, 0)
+class _Span:
+    """ Times the code run inside a 'with' block """
 
-        cumulative_time, counter, max_time = self.times_by_id[identifier]
-        cumulative_time += delta_time
-        max_time = max(delta_time, max_time)
-        counter += 1
-        self.times_by_id[identifier] = (cumulative_time, counter, max_time)
+    __slots__ = ('profiler', 'label_id', 'start')
 
-        now = time.time()
+    def __init__(self, profiler, label_id):
+        self.profiler = profiler
+        self.label_id = label_id
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record_span(self.label_id, self.start,
+                                  time.perf_counter() - self.start)
+        return False
+
+
+class SpanProfiler:
+    """Records timed spans (e.g. a frame, or one system's share of a frame)
+    into a preallocated ring buffer.
 
-        if self.last_printed_average_time is None:
-            self.last_printed_average_time = now
+    Unlike averages, the recorded spans show tail latency: per label
+    percentiles reveal the occasional long frame, and the whole buffer can be
+    exported as a Chrome trace (chrome://tracing or https://ui.perfetto.dev)
+    to see how nested spans add up in the frames that ran long.
 
-        if (now > self.last_printed_average_time +
-                self.seconds_per_average):
-            logger.info("Average Times: ")
-            for identifier, triplet in self.times_by_id.items():
-                cumulative_time, counter, max_time = triplet
+    Usage:
+        with span_profiler.span("animation scheduler"):
+            animation_scheduler.tick()
 
-                DISPLAY_LEN = 20
-                fixed_length_id = str(identifier).ljust(DISPLAY_LEN)[:DISPLAY_LEN]
-                logger.info(fixed_length_id + ": " +
-                            "%.3f" % (cumulative_time / counter * 1000) + "ms" +
-                            " max: %.3f" % (max_time * 1000) + "ms")
+        @profiled("push pixels")
+        def push_pixels(self): ...
 
-                # reset back to nothing (but still keep keys around to maintain
-                # original order for OrderedDict)
-                self.times_by_id[identifier] = (0, 0, 0)
-            self.last_printed_average_time = now
+    Spans cost next to nothing while the profiler is disabled (the default).
 
-    def increment_time_and_get_delta(self):
+    Attributes:
+        enabled: whether spans are being recorded.
+        capacity: number of most recent spans kept.
+    """
+
+    def __init__(self, capacity=100000, seconds_per_report=2):
+        self.enabled = False
+        self.capacity = capacity
+        self.seconds_per_report = seconds_per_report
+
+        self.__labels = []
+        self.__label_ids = {}
+        self.__label_id_array = array("I", [0] * capacity)
+        self.__starts = array("d", [0.0] * capacity)
+        self.__durations = array("d", [0.0] * capacity)
+        self.__thread_ids = array("Q", [0] * capacity)
+        # total spans recorded (the ring buffer index is this % capacity)
+        self.__count = 0
+        self.__last_report_time = None
+
+    def span(self, label):
+        """ Context manager timing its block as a span called label """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, self.__label_id(label))
+
+    def record(self, label, start, duration):
+        """ Record a span measured elsewhere (start as time.perf_counter()
+        seconds) """
+        if not self.enabled:
+            return
+        self.record_span(self.__label_id(label), start, duration)
+
+    def record_span(self, label_id, start, duration):
+        index = self.__count % self.capacity
+        self.__label_id_array[index] = label_id
+        self.__starts[index] = start
+        self.__durations[index] = duration
+        self.__thread_ids[index] = threading.get_ident()
+        self.__count += 1
+
+    def clear(self):
+        self.__count = 0
+
+    def durations(self, label):
+        """ Recorded durations (in seconds) for label, oldest first """
+        label_id = self.__label_ids.get(label)
+        return [self.__durations[index] for index in self.__indexes()
+                if self.__label_id_array[index] == label_id]
+
+    def percentiles(self, label, percents=(50, 95, 99)):
+        """ Duration percentiles (in seconds) for label, None if no spans
+        were recorded """
+        durations = sorted(self.durations(label))
+        if not durations:
+            return None
+        return [_percentile(durations, percent) for percent in percents]
+
+    def report(self):
+        """ Per label summary of the recorded spans in the order labels were
+        first seen: label -> (count, p50, p95, p99, max) in seconds """
+        durations_by_label = OrderedDict(
+            (label, []) for label in self.__labels)
+        for index in self.__indexes():
+            label = self.__labels[self.__label_id_array[index]]
+            durations_by_label[label].append(self.__durations[index])
+
+        summary = OrderedDict()
+        for label, durations in durations_by_label.items():
+            if not durations:
+                continue
+            durations.sort()
+            summary[label] = (
+                len(durations),
+                _percentile(durations, 50),
+                _percentile(durations, 95),
+                _percentile(durations, 99),
+                durations[-1])
+        return summary
+
+    def log_report(self):
+        """ Log percentiles for every label """
+        logger.info("Span times (p50 / p95 / p99 / max):")
+        for label, (count, p50, p95, p99, max_time) in self.report().items():
+            DISPLAY_LEN = 20
+            fixed_length_label = str(label).ljust(DISPLAY_LEN)[:DISPLAY_LEN]
+            logger.info(fixed_length_label + ": " +
+                        "%.3f / %.3f / %.3f / %.3f ms" % (
+                            p50 * 1000, p95 * 1000, p99 * 1000,
+                            max_time * 1000) +
+                        " (" + str(count) + " spans)")
+
+    def maybe_log_report(self):
+        """ Log a report every seconds_per_report seconds. For use in
+        heavily looping areas """
+        if not self.enabled:
+            return
         now = time.time()
-        delta_time = now - self.last_recorded_time
-        self.last_recorded_time = now
-        return delta_time
+        if self.__last_report_time is None:
+            self.__last_report_time = now
+        elif now > self.__last_report_time + self.seconds_per_report:
+            self.log_report()
+            self.__last_report_time = now
+
+    def export_chrome_trace(self, file_name):
+        """ Write recorded spans as Chrome trace-event JSON """
+        pid = os.getpid()
+        events = []
+        for index in self.__indexes():
+            events.append({
+                "name": self.__labels[self.__label_id_array[index]],
+                "cat": "lightful",
+                "ph": "X",
+                "ts": self.__starts[index] * 1e6,
+                "dur": self.__durations[index] * 1e6,
+                "pid": pid,
+                "tid": self.__thread_ids[index],
+            })
+        with open(file_name, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"},
+                      trace_file)
+        logger.info("wrote " + str(len(events)) + " spans to " + file_name)
+
+    def __label_id(self, label):
+        label_id = self.__label_ids.get(label)
+        if label_id is None:
+            label_id = len(self.__labels)
+            self.__labels.append(label)
+            self.__label_ids[label] = label_id
+        return label_id
+
+    def __indexes(self):
+        """ Ring buffer indexes of recorded spans, oldest first """
+        if self.__count <= self.capacity:
+            return range(self.__count)
+        first = self.__count % self.capacity
+        return list(range(first, self.capacity)) + list(range(first))
+
+
+def _percentile(sorted_values, percent):
+    """ Nearest-rank percentile of an already sorted list """
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+# shared profiler for the whole app, similar to logging.getLogger("global")
+span_profiler = SpanProfiler()
+
+
+def profiled(label=None):
+    """ Decorator recording every call of a function as a span (named after
+    the function unless a label is given) """
+    def decorator(function):
+        span_label = label or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not span_profiler.enabled:
+                return function(*args, **kwargs)
+            with span_profiler.span(span_label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -4,6 +4,8 @@ import time
 from abc import abstractmethod
 from abc import ABC
 
+from latency import note_latency
+
 logger = logging.getLogger("global")
 
 
@@ -47,6 +49,73 @@ class _TaskWrapper:
         self.start_time = start_time
         self.priority = priority
         self.unique_tag = unique_tag
+        self.cost_key = None  # set by TaskCostAccountant when needed
+
+
+def describe_task(task):
+    """Describe a task by its class and the classes of any tasks it wraps
+    (e.g. 'RepeatingTask>LightEffectTask'), plus the type of light effect
+    it's running (if any)."""
+    task_types = []
+    effect_type = None
+    while task is not None:
+        task_types.append(type(task).__name__)
+        effect = getattr(task, 'effect', None)
+        if effect is not None:
+            effect_type = type(effect).__name__
+        task = getattr(task, 'task', None)
+    return '>'.join(task_types), effect_type
+
+
+class TaskCostAccountant:
+    """Aggregates the time a scheduler spends ticking its tasks, keyed by
+    (task type, effect type, unique tag), over a rolling window.
+
+    Attributes:
+        window_seconds: length of each aggregation window. Reports cover the
+            last complete window (or the current one if none completed yet).
+    """
+
+    def __init__(self, window_seconds=5):
+        self.window_seconds = window_seconds
+        self.__window_start = time.time()
+        # cost key -> [total seconds, tick count, max seconds]
+        self.__costs = {}
+        self.__last_window_costs = None
+
+    def record(self, task_wrapper, seconds):
+        key = task_wrapper.cost_key
+        if key is None:
+            task_type, effect_type = describe_task(task_wrapper.task)
+            key = (task_type, effect_type, task_wrapper.unique_tag)
+            task_wrapper.cost_key = key
+
+        cost = self.__costs.get(key)
+        if cost is None:
+            self.__costs[key] = [seconds, 1, seconds]
+        else:
+            cost[0] += seconds
+            cost[1] += 1
+            if seconds > cost[2]:
+                cost[2] = seconds
+
+    def end_tick(self, now):
+        """Roll over to a new window once the current one is over"""
+        if now - self.__window_start >= self.window_seconds:
+            self.__last_window_costs = self.__costs
+            self.__costs = {}
+            self.__window_start = now
+
+    def top(self, n=10):
+        """Most expensive task keys as a list of (key, total seconds, tick
+        count, max seconds), most expensive first"""
+        costs = self.__last_window_costs
+        if costs is None:
+            costs = self.__costs
+        ranked = sorted(costs.items(), key=lambda item: item[1][0],
+                        reverse=True)
+        return [(key, total, count, max_time)
+                for key, (total, count, max_time) in ranked[:n]]
 
 
 class Scheduler:
@@ -57,11 +126,18 @@ class Scheduler:
     Attributes:
         task_wrappers: List of task wrappers representing all tasks that
         have been scheduled.
+        name: Name used when reporting on this scheduler.
+        cost_accountant: TaskCostAccountant timing every task tick, or None
+        (the default) to skip per task timing.
     """
 
-    def __init__(self):
+    def __init__(self, name="scheduler"):
         self.task_wrappers = []
+        self.name = name
+        self.cost_accountant = None
         self.__started = False
+        # MIDI events (see latency.py) of tasks that haven't ticked yet
+        self.__latency_events = []
 
     def start(self):
         self.__started = True
@@ -95,6 +171,9 @@ class Scheduler:
 
         task_wrapper = _TaskWrapper(task, start_time, priority, unique_tag)
         self.task_wrappers.append(task_wrapper)
+        latency_event = note_latency.task_added()
+        if latency_event is not None:
+            self.__latency_events.append(latency_event)
         task.start()
 
     def remove_by_unique_tag(self, unique_tag):
@@ -140,8 +219,45 @@ class Scheduler:
         # TODO: need to implement sort by priority as well
         self.task_wrappers.sort(key=lambda task_wrapper: task_wrapper.start_time)
 
-        for task_wrapper in self.task_wrappers:
-            task_wrapper.task.tick(now - task_wrapper.start_time)
+        accountant = self.cost_accountant
+        if accountant is None:
+            for task_wrapper in self.task_wrappers:
+                task_wrapper.task.tick(now - task_wrapper.start_time)
+        else:
+            for task_wrapper in self.task_wrappers:
+                tick_start = time.perf_counter()
+                task_wrapper.task.tick(now - task_wrapper.start_time)
+                accountant.record(task_wrapper,
+                                  time.perf_counter() - tick_start)
+            accountant.end_tick(now)
+
+        if self.__latency_events:
+            note_latency.tasks_rendered(self.__latency_events)
+            self.__latency_events = []
+
+    def enable_cost_accounting(self, window_seconds=5):
+        """Start timing each task tick (see TaskCostAccountant)"""
+        if self.cost_accountant is None:
+            self.cost_accountant = TaskCostAccountant(window_seconds)
+
+    def disable_cost_accounting(self):
+        self.cost_accountant = None
+
+    def log_cost_report(self, n=10):
+        """Log the n tasks that took the most time to tick"""
+        if self.cost_accountant is None:
+            logger.info(self.name + ": task cost accounting is off")
+            return
+        logger.info(self.name + " top task costs (total / ticks / max):")
+        for key, total, count, max_time in self.cost_accountant.top(n):
+            task_type, effect_type, unique_tag = key
+            description = task_type
+            if effect_type is not None:
+                description += "(" + effect_type + ")"
+            if unique_tag is not None:
+                description += " tag=" + str(unique_tag)
+            logger.info(" %.2fms / %d / %.3fms  %s" % (
+                total * 1000, count, max_time * 1000, description))
 
     def print_state(self):
         """ Prints scheduler state (e.g. active tasks) """
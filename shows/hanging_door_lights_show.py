@@ -1,4 +1,3 @@
-import copy
 import logging
 
 from color import make_color
@@ -7,6 +6,8 @@ from light_engine.light_effect import LightEffectTaskFactory
 from light_engine.light_effect import LightSection
 from light_engine.light_effect import Meteor
 from light_engine.light_effect import SolidColor
+from light_engine.note_dispatch import NoteDispatchTable
+from midi.message import NOTE_ON
 
 logger = logging.getLogger("global")
 
@@ -19,7 +20,7 @@ YELLOW = make_color(220, 200, 60)
 class HangingDoorLightsShow:
     """Just for debugging"""
 
-    def __init__(self, scheduler, pixel_adapter, midi_monitor):
+    def __init__(self, scheduler, pixel_adapter, midi_monitor, layout):
         self.__scheduler = scheduler
         self.__pixel_adapter = pixel_adapter
         self.__midi_monitor = midi_monitor
@@ -30,10 +31,10 @@ class HangingDoorLightsShow:
         # for each song!!
         self.__is_in_end_mode = False
 
-        self.row1 = LightSection(range(10, 30))
-        self.row2 = LightSection(reversed(range(30, 50)))
-        self.row3 = LightSection(range(60, 80))
-        self.row4 = LightSection(reversed(range(80, 100)))
+        self.row1 = layout.section("row1")
+        self.row2 = layout.section("row2")
+        self.row3 = layout.section("row3")
+        self.row4 = layout.section("row4")
 
         self.row1and4 = self.row1.merged_with(self.row4)
         self.all = LightSection.merge_all(
@@ -76,6 +77,9 @@ class HangingDoorLightsShow:
                 duration=1.6
             )
 
+        self.note_dispatch = NoteDispatchTable.compile(
+            self.note_map, unique_tag=lambda pitch, channel: pitch)
+
         self.initialize_lights()
 
     def initialize_lights(self):
@@ -129,17 +133,15 @@ class HangingDoorLightsShow:
         self.__pixel_adapter.push_pixels()
         self.__pixel_adapter.wait_for_ready_state()
 
-    def received_midi(self, rtmidi_message):
-        if rtmidi_message.isNoteOn():
-            if rtmidi_message.getNoteNumber() == 0:
+    def received_midi(self, message):
+        if message.kind == NOTE_ON:
+            if message.data1 == 0:
                 # hacky special message
                 self.special_message_received()
                 return
 
-            pitch = rtmidi_message.getNoteNumber()
-            if pitch in self.note_map:
-                task = copy.copy(self.note_map[pitch])
-                self.__scheduler.add(task, unique_tag=pitch)
+            self.note_dispatch.dispatch(self.__scheduler, message.data1,
+                                        message.channel)
 
     def special_message_received(self):
         if not self.__is_in_end_mode:
@@ -161,6 +163,8 @@ class HangingDoorLightsShow:
                     duration=0.3,
                     pitch=pitch
                 )
+                self.note_dispatch.set(pitch, self.note_map[pitch],
+                                       unique_tag=pitch)
 
 
 def space_notes_out_into_section(pitches, lightsection):
@@ -1,4 +1,3 @@
-import copy
 import logging
 
 from color import make_color
@@ -8,6 +7,8 @@ from light_engine.light_effect import LightEffectTaskFactory
 from light_engine.light_effect import LightSection
 from light_engine.light_effect import Meteor
 from light_engine.light_effect import SolidColor
+from light_engine.note_dispatch import NoteDispatchTable
+from midi.message import NOTE_ON
 from midi.metronome import MetronomeSyncedTask
 
 logger = logging.getLogger("global")
@@ -25,7 +26,7 @@ PURPLE = make_color(150, 20, 140, 127)
 class SomethingJustLikeThisShow:
     """Just for debugging"""
 
-    def __init__(self, scheduler, pixel_adapter, midi_monitor):
+    def __init__(self, scheduler, pixel_adapter, midi_monitor, layout):
         self.__scheduler = scheduler
         self.__pixel_adapter = pixel_adapter
         self.__midi_monitor = midi_monitor
@@ -34,10 +35,10 @@ class SomethingJustLikeThisShow:
         self.lightfactory = LightEffectTaskFactory(self.__pixel_adapter,
             self.__midi_monitor)
 
-        self.row1 = LightSection(range(10, 30))
-        self.row2 = LightSection(reversed(range(30, 50)))
-        self.row3 = LightSection(range(60, 80))
-        self.row4 = LightSection(reversed(range(80, 100)))
+        self.row1 = layout.section("row1")
+        self.row2 = layout.section("row2")
+        self.row3 = layout.section("row3")
+        self.row4 = layout.section("row4")
 
         self.all = LightSection.merge_all(
             [self.row1, self.row2, self.row3, self.row4])
@@ -128,6 +129,12 @@ class SomethingJustLikeThisShow:
                 duration=0.5
             )
 
+        # only dedupe channel 1
+        self.note_dispatch = NoteDispatchTable.compile(
+            self.note_map,
+            unique_tag=lambda pitch, channel:
+                (pitch, channel) if channel == 1 else None)
+
         self.initialize_lights()
 
         self.looper = None
@@ -235,9 +242,9 @@ class SomethingJustLikeThisShow:
         self.__pixel_adapter.push_pixels()
         self.__pixel_adapter.wait_for_ready_state()
 
-    def received_midi(self, rtmidi_message):
-        if rtmidi_message.isNoteOn():
-            channel = rtmidi_message.getChannel()
+    def received_midi(self, message):
+        if message.kind == NOTE_ON:
+            channel = message.channel
             original_channel = channel
 
             # if a channel is recording, pretend MIDI is coming
@@ -248,12 +255,10 @@ class SomethingJustLikeThisShow:
                         channel = recording_channel
                         break
 
-            # pitch = rtmidi_message.getNoteNumber()
-            # if (pitch, channel) in self.note_map:
-            #     task = copy.copy(self.note_map[(pitch, channel)])
-            #     # only dedupe channel 1
-            #     unique_tag = (pitch, channel) if channel == 1 else None
-            #     self.__scheduler.add(task, unique_tag=unique_tag)
+            if self.looper is None:
+                self.note_dispatch.dispatch(self.__scheduler, message.data1,
+                                            channel)
+                return
 
             # EXPERIMENTAL STUFF
             section = None
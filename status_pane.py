@@ -0,0 +1,148 @@
+import curses
+import threading
+import time
+
+from latency import note_latency
+from metrics import histogram_quantile
+
+# status dashboard drawn above the curses log
+
+STATUS_PANE_HEIGHT = 4  # 3 lines of status plus a separator
+
+
+class StatusPane:
+    """Shows live performance numbers (FPS, frame time percentiles, task
+    counts, MIDI and serial rates) in a fixed curses window.
+
+    Numbers come from a metrics registry snapshot (see metrics.py), so
+    nothing extra is measured on the main loop, and the pane is redrawn
+    from its own thread refresh_rate times per second. Rates and
+    percentiles cover the time since the previous redraw.
+
+    Like CursesLogWriter, the pane only touches the screen while holding
+    screen_lock.
+    """
+
+    def __init__(self, window, registry, screen_lock, refresh_rate=2):
+        self.window = window
+        self.registry = registry
+        self.screen_lock = screen_lock
+        self.refresh_rate = refresh_rate
+        self.__running = False
+        self.__thread = None
+        self.__previous_snapshot = None
+        self.__previous_time = None
+
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="status pane")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def status_lines(self):
+        """ Status text (one string per line) for the time since the last
+        call """
+        now = time.time()
+        snapshot = self.__counter_snapshot()
+        previous = self.__previous_snapshot
+        elapsed = now - self.__previous_time if previous else 0
+        self.__previous_snapshot = snapshot
+        self.__previous_time = now
+
+        def rate(name):
+            if not elapsed:
+                return 0.0
+            return (snapshot["counters"].get(name, 0) -
+                    previous["counters"].get(name, 0)) / elapsed
+
+        def percentiles(name, fractions):
+            buckets, counts = snapshot["histograms"].get(name, ((), []))
+            if previous is not None and name in previous["histograms"]:
+                _, previous_counts = previous["histograms"][name]
+                counts = [count - previous_count for count, previous_count
+                          in zip(counts, previous_counts)]
+            return [histogram_quantile(buckets, counts, fraction)
+                    for fraction in fractions]
+
+        frame_times = percentiles("lightful_frame_seconds", (0.5, 0.95, 0.99))
+        tasks = " ".join("{} {}".format(scheduler.replace(" scheduler", ""),
+                                        count)
+                         for scheduler, count in snapshot["tasks"])
+        ack_p95, = percentiles("lightful_serial_ack_latency_seconds",
+                               (0.95,))
+        note_percentiles = note_latency.percentiles((95,))
+
+        return [
+            " {:6.1f} fps | frame p50/95/99 {} ms | tasks {}".format(
+                rate("lightful_frames_rendered_total"),
+                "/".join(_milliseconds(value) for value in frame_times),
+                tasks or "-"),
+            " midi in {:.1f}/s out {:.1f}/s | output {:.1f} KB/s, ack p95 "
+            "{} ms, {} timeouts".format(
+                rate("lightful_midi_messages_received_total"),
+                rate("lightful_midi_messages_sent_total"),
+                rate("lightful_output_bytes_sent_total") / 1000,
+                _milliseconds(ack_p95),
+                snapshot["counters"].get("lightful_serial_ack_timeouts_total",
+                                         0)),
+            " log queue {} | note latency p95 {} ms".format(
+                snapshot["counters"].get("lightful_log_queue_depth", 0),
+                _milliseconds(note_percentiles[0] if note_percentiles
+                              else None)),
+        ]
+
+    def __counter_snapshot(self):
+        """ Totals (summed over labels) of counters/gauges, and bucket
+        counts (summed over labels) of histograms """
+        counters = {}
+        histograms = {}
+        tasks = []
+        for name, values in self.registry.snapshot().items():
+            if name == "lightful_scheduler_tasks":
+                tasks = [(dict(label_items)["scheduler"], value)
+                         for label_items, value in values.items()]
+            histogram_values = [value for value in values.values()
+                                if hasattr(value, "bucket_counts")]
+            if histogram_values:
+                counts = [sum(bucket_counts) for bucket_counts in zip(
+                    *[list(value.bucket_counts)
+                      for value in histogram_values])]
+                histograms[name] = (histogram_values[0].buckets, counts)
+            else:
+                counters[name] = sum(value for value in values.values()
+                                     if value is not None)
+        return {"counters": counters, "histograms": histograms,
+                "tasks": tasks}
+
+    def __run(self):
+        while self.__running:
+            try:
+                self.__draw(self.status_lines())
+            except Exception:  # noqa
+                # keep the pane alive, there's nowhere else to report to
+                pass
+            time.sleep(1.0 / self.refresh_rate)
+
+    def __draw(self, lines):
+        with self.screen_lock:
+            height, width = self.window.getmaxyx()
+            self.window.erase()
+            for row, line in enumerate(lines[:height - 1]):
+                self.window.addstr(row, 0, line[:width - 1])
+            self.window.hline(height - 1, 0, curses.ACS_HLINE, width)
+            self.window.refresh()
+
+
+def _milliseconds(seconds):
+    if seconds is None:
+        return "-"
+    return "{:.1f}".format(seconds * 1000)
@@ -0,0 +1,167 @@
+import logging
+import time
+import tracemalloc
+from collections import Counter
+from collections import deque
+
+from scheduler.scheduler import describe_task
+
+logger = logging.getLogger("global")
+
+# tasks that are meant to run for the whole session (e.g. background
+# layers and the looper's metronome and playback)
+DEFAULT_IGNORED_TASK_TYPES = ("RepeatingTask", "MetronomeTask",
+                              "MetronomeSyncedTask", "LoopPlaybackTask")
+
+
+class TaskWatchdog:
+    """Keeps an eye on schedulers over long sessions.
+
+    Tasks that never finish (e.g. a MidiOffTask whose note off never came)
+    pile up and slow down every frame. Every check_interval seconds, the
+    watchdog records task counts by type (so growth over a session shows
+    up in reports) and flags tasks that have been alive for longer than
+    max_task_age. With reap, flagged tasks are also ended (through their
+    end() method if they have one) and removed.
+
+    Attributes:
+        history: (time, {scheduler name: Counter of task types}) for the
+            most recent checks.
+        reaped_count: number of tasks reaped so far.
+    """
+
+    def __init__(self, schedulers, max_task_age=300, reap=False,
+                 ignored_task_types=DEFAULT_IGNORED_TASK_TYPES,
+                 check_interval=30, history_size=2880):
+        """
+        Args:
+            ignored_task_types: class names of (outermost) tasks that are
+                never flagged or reaped.
+        """
+        self.schedulers = schedulers
+        self.max_task_age = max_task_age
+        self.reap = reap
+        self.ignored_task_types = set(ignored_task_types)
+        self.check_interval = check_interval
+        self.history = deque(maxlen=history_size)
+        self.reaped_count = 0
+        self.__last_check_time = time.time()
+        # ids of task wrappers already flagged, so each is only logged once
+        self.__flagged_ids = set()
+
+    def maybe_check(self):
+        """ Check every check_interval seconds. For use in the main loop """
+        now = time.time()
+        if now - self.__last_check_time >= self.check_interval:
+            self.check(now)
+
+    def check(self, now=None):
+        if now is None:
+            now = time.time()
+        self.__last_check_time = now
+
+        counts_by_scheduler = {}
+        flagged_ids = set()
+        for scheduler in self.schedulers:
+            counts = Counter()
+            stuck_tasks = []
+            for task_wrapper in scheduler.task_wrappers:
+                task_type, _ = describe_task(task_wrapper.task)
+                counts[task_type] += 1
+                if type(task_wrapper.task).__name__ in \
+                        self.ignored_task_types:
+                    continue
+                age = now - task_wrapper.start_time
+                if age > self.max_task_age:
+                    stuck_tasks.append((task_wrapper, task_type, age))
+            counts_by_scheduler[scheduler.name] = counts
+
+            for task_wrapper, task_type, age in stuck_tasks:
+                if self.reap:
+                    self.__reap(scheduler, task_wrapper.task)
+                    logger.warning("{}: reaped {} alive for {:.0f}s".format(
+                        scheduler.name, task_type, age))
+                    continue
+                flagged_ids.add(id(task_wrapper))
+                if id(task_wrapper) not in self.__flagged_ids:
+                    logger.warning("{}: {} alive for {:.0f}s, may be "
+                                   "stuck".format(scheduler.name, task_type,
+                                                  age))
+        # forget tasks that have since finished
+        self.__flagged_ids = flagged_ids
+
+        self.history.append((now, counts_by_scheduler))
+
+    def log_report(self):
+        """ Log current task counts by type, and how they changed since the
+        oldest check in history """
+        self.check()
+        first_time, first_counts = self.history[0]
+        _, counts = self.history[-1]
+        logger.info("task counts (change over the last {:.0f} min):".format(
+            (time.time() - first_time) / 60))
+        for scheduler_name, scheduler_counts in counts.items():
+            first_scheduler_counts = first_counts.get(scheduler_name,
+                                                      Counter())
+            logger.info(" {}: {} tasks".format(
+                scheduler_name, sum(scheduler_counts.values())))
+            task_types = set(scheduler_counts) | set(first_scheduler_counts)
+            for task_type in sorted(task_types):
+                count = scheduler_counts[task_type]
+                logger.info("  {:>5} ({:+d})  {}".format(
+                    count, count - first_scheduler_counts[task_type],
+                    task_type))
+        if self.reaped_count:
+            logger.info(" {} tasks reaped so far".format(self.reaped_count))
+
+    def __reap(self, scheduler, task):
+        end = getattr(task, "end", None)
+        if end is not None:
+            end()
+        scheduler.remove(task)
+        self.reaped_count += 1
+
+
+class MemorySnapshots:
+    """Diffs tracemalloc snapshots to find memory creep.
+
+    The first snapshot() starts tracemalloc (which slows allocations down
+    noticeably, so it's off until asked for) and takes a baseline. Every
+    later snapshot() logs the allocation sites that grew the most since the
+    previous one.
+    """
+
+    def __init__(self, frames=5, top=10):
+        self.frames = frames
+        self.top = top
+        self.__snapshot = None
+
+    def snapshot(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            logger.info("tracemalloc started, snapshot again later to see "
+                        "what grew")
+        snapshot = self.__take_snapshot()
+        previous_snapshot = self.__snapshot
+        self.__snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        logger.info("traced memory: {:.1f} MB (peak {:.1f} MB)".format(
+            current / 1e6, peak / 1e6))
+        if previous_snapshot is None:
+            return
+
+        logger.info("top memory growth since last snapshot:")
+        for stat in snapshot.compare_to(previous_snapshot,
+                                        "lineno")[:self.top]:
+            logger.info(" " + str(stat))
+
+    def stop(self):
+        self.__snapshot = None
+        tracemalloc.stop()
+
+    def __take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        # leave out tracemalloc's own allocations
+        return snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)])